@@ -8,6 +8,7 @@ from . import pos
 from . import bank
 from . import party
 from . import currency
+from . import company
 
 __all__ = ['register']
 
@@ -16,6 +17,7 @@ def register():
     Pool.register(
         pos.Pos,
         pos.PosSequence,
+        pos.PosLastAuthorized,
         invoice.Invoice,
         invoice.InvoiceLine,
         invoice.InvoiceExportLicense,
@@ -27,6 +29,8 @@ def register():
         bank.BankAccount,
         party.Party,
         currency.Currency,
+        company.Company,
+        company.AfipTicket,
         module='account_invoice_ar', type_='model')
     Pool.register(
         invoice.CreditInvoice,
@@ -0,0 +1,556 @@
+# This file is part of the account_invoice_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from types import SimpleNamespace
+from urllib.request import urlopen
+from datetime import datetime, timedelta, timezone
+from weakref import WeakKeyDictionary
+from xml.etree import ElementTree
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Tickets about to expire are not handed out with a pooled client
+TICKET_MARGIN = timedelta(
+    seconds=config.getint('account_invoice_ar', 'ticket_margin',
+        default=5 * 60))
+POOL_SIZE = config.getint('account_invoice_ar', 'ws_pool_size', default=4)
+# Number of WSFE batches posted concurrently
+BATCH_WORKERS = config.getint(
+    'account_invoice_ar', 'wsfe_batch_workers', default=4)
+# Milliseconds during which the WSFE requests of the same POS and voucher
+# type are gathered in one request, 0 to disable
+BATCH_WINDOW = config.getint(
+    'account_invoice_ar', 'wsfe_batch_window', default=0)
+# Seconds a WSFE batch request should last, the chunks are resized to meet it
+BATCH_LATENCY = config.getfloat(
+    'account_invoice_ar', 'wsfe_batch_latency', default=10)
+# Maximum bytes of a WSFE batch request, 0 for no limit
+BATCH_BYTES = config.getint(
+    'account_invoice_ar', 'wsfe_batch_bytes', default=1024 * 1024)
+# Seconds the maximum number of vouchers per request is kept
+BATCH_LIMIT_CACHE = config.getint(
+    'account_invoice_ar', 'wsfe_batch_limit_cache', default=24 * 60 * 60)
+# Concurrent queries and maximum queries per second to recover invoices
+RECOVER_WORKERS = config.getint(
+    'account_invoice_ar', 'recover_workers', default=4)
+RECOVER_RATE = config.getfloat(
+    'account_invoice_ar', 'recover_rate', default=10)
+RECOVER_CHUNK = config.getint(
+    'account_invoice_ar', 'recover_chunk', default=100)
+# Attributes of a web service client holding the result of a request
+WS_RESULT_ATTRS = ['Cuit', 'CAE', 'Vencimiento', 'FchVencCAE', 'EmisionTipo',
+    'Resultado', 'Obs', 'ErrMsg', 'Excepcion', 'XmlRequest', 'XmlResponse']
+
+WSDL_DIR = os.path.join(os.path.dirname(__file__), 'wsdl')
+# Seconds a downloaded WSDL is used before being downloaded again
+WSDL_REFRESH = config.getint(
+    'account_invoice_ar', 'wsdl_refresh', default=24 * 60 * 60)
+# service: (version, {mode: url})
+SERVICES = {
+    'wsfe': ('wsfev1', {
+            'homologacion': (
+                'https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL'),
+            'produccion': (
+                'https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL'),
+            }),
+    'wsfex': ('wsfexv1', {
+            'homologacion': (
+                'https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL'),
+            'produccion': (
+                'https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL'),
+            }),
+    }
+
+
+def get_ticket_expiration(ticket):
+    '''
+    Return the expiration time of a WSAA access ticket as naive UTC.
+    '''
+    if not ticket:
+        return None
+    if isinstance(ticket, str):
+        ticket = ticket.encode('utf-8')
+    try:
+        expiration = ElementTree.fromstring(ticket).findtext(
+            './/expirationTime')
+    except ElementTree.ParseError:
+        logger.warning('unable to parse WSAA access ticket')
+        return None
+    if not expiration:
+        return None
+    expiration = datetime.fromisoformat(expiration.strip())
+    if expiration.tzinfo is not None:
+        expiration = expiration.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiration
+
+
+def is_ticket_valid(expiration, margin=TICKET_MARGIN):
+    "Test if a ticket expiring at expiration can still be used"
+    return bool(expiration and expiration - margin > datetime.utcnow())
+
+
+def get_wsdl_filename(service, mode):
+    "Return the path of the bundled WSDL of the service"
+    version, _ = SERVICES[service]
+    return os.path.join(WSDL_DIR, '%s-%s.wsdl' % (version, mode))
+
+
+def get_wsdl(service, mode):
+    '''
+    Return the WSDL to connect to the service in mode.
+
+    The WSDL bundled with the module is preferred over the URL so no
+    download is needed. None is returned for unknown service or mode.
+    '''
+    if service not in SERVICES or mode not in SERVICES[service][1]:
+        return None
+    filename = get_wsdl_filename(service, mode)
+    if os.path.isfile(filename):
+        return filename
+    return SERVICES[service][1][mode]
+
+
+def get_wsdl_cache(cache):
+    "Return the directory storing the downloaded WSDL"
+    path = os.path.join(cache, 'wsdl')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def wsdl_cache_lock(cache):
+    '''
+    Serialize the writing of the WSDL stored in the cache directory.
+
+    The lock is held on a file so it is shared by all the processes.
+    '''
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(cache, '.lock'), 'a') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def fetch_wsdl(url, cache):
+    '''
+    Return the copy in the cache directory of the WSDL at url.
+
+    The copy is downloaded again after WSDL_REFRESH seconds. The download is
+    done without holding the cache lock, only the file is written under it.
+    If AFIP can not be reached, the previous copy is used.
+    '''
+    filename = os.path.basename(url.split('?')[0])
+    for service, (version, urls) in SERVICES.items():
+        for mode, service_url in urls.items():
+            if service_url == url:
+                filename = '%s-%s.wsdl' % (version, mode)
+    path = os.path.join(cache, filename)
+    if (os.path.isfile(path)
+            and time.time() - os.path.getmtime(path) < WSDL_REFRESH):
+        return path
+    try:
+        with urlopen(url, timeout=60) as response:
+            content = response.read()
+    except OSError:
+        if os.path.isfile(path):
+            logger.warning('unable to download WSDL %s, using %s',
+                url, path, exc_info=True)
+            return path
+        raise
+    with wsdl_cache_lock(cache):
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(content)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+# (wsdl, modification time, cache) of the WSDL already parsed in the cache
+_parsed_wsdl = set()
+
+
+def connect(ws, wsdl, cache):
+    '''
+    Connect the client ws to wsdl.
+
+    A WSDL URL is first downloaded to the cache directory so the client is
+    always built from a local file.
+    The client writes the parsed WSDL in the cache the first time it reads
+    a WSDL file, only this connection holds the cache lock.
+    '''
+    cache = get_wsdl_cache(cache)
+    if wsdl.startswith(('http://', 'https://')):
+        wsdl = fetch_wsdl(wsdl, cache)
+    key = (wsdl, os.path.getmtime(wsdl), cache)
+    if key in _parsed_wsdl:
+        return ws.Conectar(wsdl=wsdl, cache=cache, cacert=True)
+    with wsdl_cache_lock(cache):
+        result = ws.Conectar(wsdl=wsdl, cache=cache, cacert=True)
+    _parsed_wsdl.add(key)
+    return result
+
+
+# Position of the voucher number in the CrearFactura arguments
+_NUMBER_ARGS = {
+    'wsfe': (5, 6),
+    'wsmtxca': (5, 6),
+    'wsfex': (2,),
+    }
+
+
+class AfipPayload(namedtuple('AfipPayload', [
+            'service', 'tipo_cbte', 'punto_vta', 'cbte_nro', 'header',
+            'opcionales', 'periodo_asoc', 'cmps_asoc', 'ivas', 'tributos',
+            'items', 'permisos', 'totals', 'error'],
+        defaults=[None, None, None, None, (), (), None, (), (), (), (), (),
+            None, False])):
+    '''
+    Immutable data of an invoice to send to an AFIP web service.
+
+    header holds the arguments of CrearFactura and the other fields the
+    arguments of each call to the corresponding Agregar method.
+    totals maps the invoice fields storing the amounts sent to their value.
+    '''
+    __slots__ = ()
+
+    def set_number(self, cbte_nro):
+        "Return a copy of the payload for the voucher number"
+        header = list(self.header)
+        for index in _NUMBER_ARGS[self.service]:
+            header[index] = cbte_nro
+        return self._replace(cbte_nro=cbte_nro, header=tuple(header))
+
+    def apply(self, ws):
+        "Create the invoice in the helper ws"
+        ws.CrearFactura(*self.header)
+        for args in self.opcionales:
+            ws.AgregarOpcional(*args)
+        if self.periodo_asoc:
+            ws.AgregarPeriodoComprobantesAsociados(*self.periodo_asoc)
+        for args in self.cmps_asoc:
+            ws.AgregarCmpAsoc(*args)
+        for args in self.ivas:
+            ws.AgregarIva(*args)
+        for args in self.tributos:
+            ws.AgregarTributo(*args)
+        for args in self.items:
+            ws.AgregarItem(*args)
+        for args in self.permisos:
+            ws.AgregarPermiso(*args)
+        return ws
+
+
+class BatchChunkResult(namedtuple('BatchChunkResult', [
+            'invoices', 'approved', 'rejected'])):
+    '''
+    Outcome of the request of one chunk of a WSFE batch.
+
+    invoices are the invoices sent in the chunk, approved and rejected the
+    ones authorized or not by AFIP.
+    '''
+    __slots__ = ()
+
+
+def compress_xml(xml):
+    "Return the XML text compressed"
+    if not xml:
+        return None
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    return zlib.compress(xml)
+
+
+def decompress_xml(data):
+    "Return the XML text of compressed data"
+    if not data:
+        return None
+    data = bytes(data)
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        # stored without compression or damaged, show what can be read
+        logger.warning('unable to decompress XML', exc_info=True)
+    return data.decode('utf-8', 'replace')
+
+
+def snapshot_ws(ws):
+    '''
+    Return a copy of the result of the last request of the client ws.
+
+    The copy can be processed once the client is reused.
+    '''
+    return SimpleNamespace(
+        **{a: getattr(ws, a, None) for a in WS_RESULT_ATTRS})
+
+
+class RateLimiter(object):
+    "Space the calls to wait so they are at most rate per second"
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RequestCollector(object):
+    '''
+    Gather the payloads requested concurrently for the same key.
+
+    The first caller of a key waits window seconds and sends with its client
+    the payloads of all the callers arrived meanwhile. The others wait for
+    their part of the results.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def request(self, key, payloads, send, size=None):
+        '''
+        Return the results of send for payloads.
+
+        send is called with the list of payloads gathered, at most size, and
+        must return one result per payload.
+        '''
+        payloads = list(payloads)
+        with self._lock:
+            batch = self._pending.get(key)
+            if (batch is not None
+                    and (size is None
+                        or len(batch.payloads) + len(payloads) <= size)):
+                leader = False
+            else:
+                batch = SimpleNamespace(payloads=[], results=None,
+                    error=None, done=threading.Event())
+                self._pending[key] = batch
+                leader = True
+            start = len(batch.payloads)
+            batch.payloads.extend(payloads)
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            if len(batch.payloads) > len(payloads):
+                logger.info('gathered %s payloads in one request',
+                    len(batch.payloads))
+            try:
+                batch.results = send(batch.payloads)
+            except Exception as exception:
+                batch.error = exception
+                raise
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+        return batch.results[start:start + len(payloads)]
+
+
+class ChunkSizer(object):
+    '''
+    Size of the chunks of the batch requests by (service, mode).
+
+    The maximum number of vouchers per request given by AFIP is kept for
+    limit_cache seconds. Starting from it, the size is increased while the
+    requests last less than half of latency and decreased when they last
+    more, time out or exceed max_bytes.
+    '''
+
+    def __init__(self, latency=BATCH_LATENCY, max_bytes=BATCH_BYTES,
+            limit_cache=BATCH_LIMIT_CACHE, history=20):
+        self.latency = latency
+        self.max_bytes = max_bytes
+        self.limit_cache = limit_cache
+        self.history = history
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._sizes = {}
+        self._chunks = {}
+
+    def get_limit(self, key, fetch):
+        '''
+        Return the maximum number of vouchers per request for key.
+
+        fetch is called to query it when it is not cached.
+        '''
+        with self._lock:
+            limit, expiration = self._limits.get(key, (None, None))
+        if limit is None or expiration <= time.monotonic():
+            limit = int(fetch())
+            with self._lock:
+                self._limits[key] = (
+                    limit, time.monotonic() + self.limit_cache)
+        return limit
+
+    def get_size(self, key, limit):
+        "Return the size of the next chunk for key"
+        with self._lock:
+            return max(1, min(self._sizes.get(key, limit), limit))
+
+    def record(self, key, size, latency, nbytes=0, timeout=False):
+        '''
+        Adapt the size for key to a request of size vouchers.
+
+        Return the size of the next chunk.
+        '''
+        with self._lock:
+            current = self._sizes.get(key, size)
+            limit, _ = self._limits.get(key, (max(current, size), None))
+            if timeout:
+                next_size = size // 2
+            elif latency > self.latency:
+                next_size = int(size * self.latency / latency)
+            elif latency < self.latency / 2 and size >= current:
+                next_size = current + max(1, current // 4)
+            else:
+                next_size = current
+            if nbytes and self.max_bytes:
+                next_size = min(next_size, self.max_bytes * size // nbytes)
+            next_size = max(1, min(next_size, limit))
+            self._sizes[key] = next_size
+            self._chunks.setdefault(key, deque(maxlen=self.history)).append({
+                    'size': size,
+                    'latency': latency,
+                    'bytes': nbytes,
+                    'timeout': timeout,
+                    })
+        logger.info('%s chunk of %s vouchers in %.3fs (%s bytes%s), '
+            'next chunk of %s', key, size, latency, nbytes,
+            ', timeout' if timeout else '', next_size)
+        return next_size
+
+    def stats(self):
+        '''
+        Return by key the limit, the size of the next chunk and the last
+        chunks requested with their size, latency, bytes and timeout.
+        '''
+        with self._lock:
+            return {key: {
+                    'limit': self._limits.get(key, (None, None))[0],
+                    'size': self._sizes.get(key),
+                    'chunks': list(self._chunks.get(key, [])),
+                    }
+                for key in self._limits.keys() | self._sizes.keys()}
+
+
+class WebServicePool(object):
+    '''
+    Registry of connected AFIP web service clients.
+
+    Clients are keyed by (database, company, service, mode) and are handed
+    out to one caller at a time. They are dropped when their access ticket
+    expires or when the certification mode of the company changes.
+    '''
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._clients = WeakKeyDictionary()
+
+    @staticmethod
+    def key(company, service):
+        "Return the pool key of the service for the company"
+        database = Transaction().database.name
+        return (database, company.id, service, company.pyafipws_mode_cert)
+
+    def _evict_modes(self, key):
+        database, company, service, mode = key
+        for other in list(self._idle):
+            if (other[:3] == (database, company, service)
+                    and other[3] != mode):
+                logger.info('dropping AFIP %s clients of company %s: '
+                    'mode changed to %s', service, company, mode)
+                del self._idle[other]
+
+    def checkout(self, key):
+        '''
+        Return an idle client for key with a valid ticket or None.
+        '''
+        with self._lock:
+            self._evict_modes(key)
+            idle = self._idle.get(key, [])
+            while idle:
+                ws = idle.pop()
+                _, expiration = self._clients.get(ws, (None, None))
+                if is_ticket_valid(expiration):
+                    break
+            else:
+                return None
+        # reset the state left by the previous request
+        ws.inicializar()
+        ws.LanzarExcepciones = True
+        return ws
+
+    def add(self, key, ws, expiration):
+        '''
+        Register a new client checked out by the caller.
+        '''
+        with self._lock:
+            self._evict_modes(key)
+            self._clients[ws] = (key, expiration)
+
+    def release(self, ws):
+        '''
+        Give back a client to the pool.
+        '''
+        with self._lock:
+            key, expiration = self._clients.get(ws, (None, None))
+            if key is None or not is_ticket_valid(expiration):
+                self._clients.pop(ws, None)
+                return
+            idle = self._idle.setdefault(key, [])
+            if ws not in idle and len(idle) < self.size:
+                idle.append(ws)
+
+    def clear(self, database, company=None):
+        '''
+        Drop the idle clients of the database or of one of its companies.
+        '''
+        def match(key):
+            return key[0] == database and company in (None, key[1])
+
+        with self._lock:
+            for key in list(self._idle):
+                if match(key):
+                    del self._idle[key]
+            for ws, (key, _) in list(self._clients.items()):
+                if match(key):
+                    del self._clients[ws]
+
+
+ws_pool = WebServicePool()
+ws_collector = RequestCollector(BATCH_WINDOW / 1000)
+chunk_sizer = ChunkSizer()
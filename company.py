@@ -0,0 +1,183 @@
+# This file is part of the account_invoice_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from sql import Select
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelSQL, fields, Unique
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .afip import ws_pool, get_ticket_expiration, is_ticket_valid
+
+logger = logging.getLogger(__name__)
+
+# Tickets are renewed this long before they expire
+TICKET_REFRESH = timedelta(
+    seconds=config.getint('account_invoice_ar', 'ticket_refresh',
+        default=10 * 60))
+# Delay before trying again a renewal that did not give a newer ticket
+TICKET_RETRY = timedelta(seconds=60)
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
+        actions = iter(args)
+        companies = []
+        for records, values in zip(actions, actions):
+            if values.keys() & {'pyafipws_certificate',
+                    'pyafipws_private_key', 'pyafipws_mode_cert'}:
+                companies.extend(records)
+        super().write(*args)
+        if companies:
+            Ticket.invalidate(companies)
+
+
+class AfipTicket(ModelSQL):
+    'AFIP WSAA Access Ticket'
+    __name__ = 'account_invoice_ar.afip_ticket'
+
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    service = fields.Char('Service', required=True)
+    mode = fields.Char('Mode')
+    ticket = fields.Text('Ticket')
+    expiration = fields.DateTime('Expiration',
+        help='Expiration time of the ticket in UTC')
+
+    _tickets_cache = Cache('account_invoice_ar.afip_ticket', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_service_mode_unique',
+                Unique(t, t.company, t.service, t.mode),
+                'account_invoice_ar.msg_afip_ticket_unique'),
+            ]
+
+    @classmethod
+    def get_ticket(cls, company, service):
+        '''
+        Return a valid access ticket of the company for the service.
+
+        The ticket is looked up in memory, then in the database, and only
+        requested to WSAA when it is missing or about to expire.
+        '''
+        key = (company.id, service, company.pyafipws_mode_cert)
+        value = cls._tickets_cache.get(key)
+        if value is None:
+            with Transaction().set_context(_check_access=False):
+                tickets = cls.search([
+                        ('company', '=', company.id),
+                        ('service', '=', service),
+                        ('mode', '=', company.pyafipws_mode_cert),
+                        ], limit=1)
+            if tickets and is_ticket_valid(tickets[0].expiration):
+                ticket, = tickets
+                value = {
+                    'ticket': ticket.ticket,
+                    'expiration': ticket.expiration,
+                    'refresh_at': ticket.expiration - TICKET_REFRESH,
+                    }
+        if value is not None and datetime.utcnow() < value['refresh_at']:
+            cls._tickets_cache.set(key, value)
+            return value['ticket']
+
+        try:
+            ticket = cls.renew(company, service)
+        except Exception:
+            if value is None or not is_ticket_valid(value['expiration']):
+                raise
+            logger.warning('unable to renew AFIP %s ticket of company %s, '
+                'using the current one', service, company.id, exc_info=True)
+            value['refresh_at'] = datetime.utcnow() + TICKET_RETRY
+        else:
+            ticket, expiration = ticket
+            if value is not None and expiration <= value['expiration']:
+                refresh_at = datetime.utcnow() + TICKET_RETRY
+            else:
+                refresh_at = expiration - TICKET_REFRESH
+            value = {
+                'ticket': ticket,
+                'expiration': expiration,
+                'refresh_at': refresh_at,
+                }
+        cls._tickets_cache.set(key, value)
+        return value['ticket']
+
+    @classmethod
+    def renew(cls, company, service):
+        '''
+        Request a new ticket to WSAA, store it and return it with its
+        expiration.
+
+        It runs in its own transaction so the ticket is kept even if the
+        calling transaction is rolled back. The renewals of the same company
+        and service wait for each other and reuse the ticket just renewed.
+        '''
+        mode = company.pyafipws_mode_cert
+        domain = [
+            ('company', '=', company.id),
+            ('service', '=', service),
+            ('mode', '=', mode),
+            ]
+        lock_id = zlib.crc32(
+            ('%s:%s:%s' % (cls.__name__, company.id, service)).encode())
+        with Transaction().new_transaction() as transaction, \
+                transaction.set_context(_check_access=False):
+            # Only one process at a time asks WSAA for a ticket
+            transaction.connection.cursor().execute(*Select([
+                        transaction.database.lock_id(lock_id, timeout=True)]))
+            # A new transaction sees the ticket renewed while waiting
+            with Transaction().new_transaction() as renewal:
+                tickets = cls.search(domain, limit=1)
+                if (tickets and tickets[0].expiration
+                        and tickets[0].expiration - TICKET_REFRESH
+                        > datetime.utcnow()):
+                    # renewed meanwhile by another process
+                    ticket, = tickets
+                    return ticket.ticket, ticket.expiration
+                ta = company.pyafipws_authenticate(
+                    service=service, cache=company.get_cache_dir())
+                expiration = get_ticket_expiration(ta)
+                if tickets:
+                    ticket, = tickets
+                else:
+                    ticket = cls(
+                        company=company.id, service=service, mode=mode)
+                ticket.ticket = ta
+                ticket.expiration = expiration
+                ticket.save()
+                logger.info(
+                    'new AFIP %s ticket for company %s expiring at %s',
+                    service, company.id, expiration)
+                renewal.commit()
+                return ta, expiration
+
+    @classmethod
+    def invalidate(cls, companies):
+        '''
+        Forget the tickets and the connected clients of the companies.
+        '''
+        transaction = Transaction()
+        database = transaction.database.name
+        with transaction.set_context(_check_access=False):
+            tickets = cls.search([
+                    ('company', 'in', [c.id for c in companies]),
+                    ])
+            cls.delete(tickets)
+        cls._tickets_cache.clear()
+        for company in companies:
+            ws_pool.clear(database, company.id)
@@ -14,6 +14,8 @@ from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+from .afip import get_wsdl, connect
+
 logger = logging.getLogger(__name__)
 
 
@@ -61,6 +63,7 @@ class Rate(metaclass=PoolMeta):
         '''
         pool = Pool()
         Company = pool.get('company.company')
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
         company_id = Transaction().context.get('company')
         if not company_id:
             logger.error('The company is not defined')
@@ -68,32 +71,23 @@ class Rate(metaclass=PoolMeta):
                 'account_invoice_ar.msg_company_not_defined'))
         company = Company(company_id)
         # authenticate against AFIP:
-        ta = company.pyafipws_authenticate(service=service)
+        ta = Ticket.get_ticket(company, service)
 
         if service == 'wsfe':
             ws = WSFEv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL')
         elif service == 'wsfex':
             ws = WSFEXv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL')
         else:
             logger.critical('AFIP ws is not yet supported! %s', service)
             raise UserError(gettext(
                 'account_invoice_ar.msg_webservice_not_supported',
                 service=service))
+        WSDL = get_wsdl(service, company.pyafipws_mode_cert)
 
         cache = Company.get_cache_dir()
         ws.LanzarExcepciones = True
         try:
-            ws.Conectar(wsdl=WSDL, cache=cache, cacert=True)
+            connect(ws, WSDL, cache)
         except Exception as e:
             msg = ws.Excepcion + ' ' + str(e)
             logger.error('WSAA connecting to afip: %s' % msg)
@@ -8,11 +8,25 @@ from pyafipws import pyqr
 from io import BytesIO
 import stdnum.ar.cuit as cuit
 import logging
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from functools import partial, wraps
+from itertools import groupby
+from queue import Queue
 from datetime import date, datetime
 from calendar import monthrange
 from unicodedata import normalize
-
+from sql import Cast, Column, Null, Literal, Select, Values
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case, Coalesce, Greatest
+from sql.functions import CharLength, Function, Position, Substring, Trim
+from sql.operators import BinaryOperator, Exists, Or
+
+from trytond import backend
+from trytond.filestore import filestore
 from trytond.model import ModelSQL, Workflow, fields, ModelView, Index
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
@@ -21,14 +35,38 @@ from trytond.transaction import Transaction
 from trytond.model.exceptions import AccessError
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
-from trytond.tools import cursor_dict
-from .pos import INVOICE_TYPE_POS
+from trytond.tools import cursor_dict, grouped_slice, reduce_ids
+from .pos import INVOICE_TYPE_POS, INVOICE_TYPE_CLASS
+from .afip import (ws_pool, get_ticket_expiration, get_wsdl, connect,
+    compress_xml, decompress_xml, snapshot_ws, AfipPayload, BatchChunkResult,
+    RateLimiter, ws_collector, chunk_sizer, BATCH_WINDOW, BATCH_WORKERS,
+    RECOVER_WORKERS, RECOVER_RATE, RECOVER_CHUNK)
 from trytond.modules.account_invoice.exceptions import InvoiceNumberError
 
 logger = logging.getLogger(__name__)
 
+
+class Int4Range(Function):
+    __slots__ = ()
+    _function = 'INT4RANGE'
+
+
+class Overlap(BinaryOperator):
+    __slots__ = ()
+    _operator = '&&'
+
+
 _ZERO = Decimal('0.0')
 
+# Amount computed for AFIP: field storing the amount sent with the CAE
+AFIP_TOTALS = {
+    'pyafipws_imp_neto': 'pyafipws_cae_imp_neto',
+    'pyafipws_imp_tot_conc': 'pyafipws_cae_imp_tot_conc',
+    'pyafipws_imp_op_ex': 'pyafipws_cae_imp_op_ex',
+    'pyafipws_imp_iva': 'pyafipws_cae_imp_iva',
+    'pyafipws_imp_trib': 'pyafipws_cae_imp_trib',
+    }
+
 INVOICE_TYPE_AFIP_CODE = {
     ('out', False, 'A', False): ('1', '01-Factura A'),
     ('out', False, 'A', True): ('201', '201-Factura de Crédito MiPyme A'),
@@ -228,6 +266,19 @@ CONDICION_IVA_RECEPTOR = {
     }
 
 
+def queue_pyafipws(func):
+    "Queue the invoices requesting their CAE in background instead of func"
+    @wraps(func)
+    def wrapper(cls, invoices, *args, **kwargs):
+        to_queue = [i for i in invoices if i.is_pyafipws_async()]
+        if to_queue:
+            cls.queue_pyafipws_cae(to_queue)
+            queued = set(to_queue)
+            invoices = [i for i in invoices if i not in queued]
+        return func(cls, invoices, *args, **kwargs)
+    return wrapper
+
+
 class AfipWSTransaction(ModelSQL, ModelView):
     'AFIP WS Transaction'
     __name__ = 'account_invoice_ar.afip_transaction'
@@ -243,10 +294,125 @@ class AfipWSTransaction(ModelSQL, ModelView):
         help='Resultado procesamiento de la Solicitud, devuelto por AFIP')
     pyafipws_message = fields.Text('Mensaje', readonly=True,
         help='Mensaje de error u observación, devuelto por AFIP')
-    pyafipws_xml_request = fields.Text('Requerimiento XML', readonly=True,
-        help='Mensaje XML enviado a AFIP (depuración)')
-    pyafipws_xml_response = fields.Text('Respuesta XML', readonly=True,
-        help='Mensaje XML recibido de AFIP (depuración)')
+    pyafipws_xml_request = fields.Function(fields.Text('Requerimiento XML',
+            readonly=True, help='Mensaje XML enviado a AFIP (depuración)'),
+        'get_pyafipws_xml')
+    pyafipws_xml_response = fields.Function(fields.Text('Respuesta XML',
+            readonly=True, help='Mensaje XML recibido de AFIP (depuración)'),
+        'get_pyafipws_xml')
+    pyafipws_xml_request_data = fields.Binary('Requerimiento XML comprimido',
+        file_id='pyafipws_xml_request_id', readonly=True)
+    pyafipws_xml_request_id = fields.Char(
+        'ID Requerimiento XML comprimido', readonly=True)
+    pyafipws_xml_response_data = fields.Binary('Respuesta XML comprimida',
+        file_id='pyafipws_xml_response_id', readonly=True)
+    pyafipws_xml_response_id = fields.Char(
+        'ID Respuesta XML comprimida', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.invoice, Index.Equality()),
+                (t.id, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        xml_exist = table_h.column_exist('pyafipws_xml_request')
+        super().__register__(module_name)
+        # Migration from 7.0: compress XML
+        if xml_exist:
+            cls._migrate_pyafipws_xml()
+            table_h.drop_column('pyafipws_xml_request')
+            table_h.drop_column('pyafipws_xml_response')
+        # Migration from 7.0: move XML to the filestore
+        cls._migrate_pyafipws_xml_filestore()
+
+    @classmethod
+    def _migrate_pyafipws_xml(cls):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        prefix = transaction.database.name
+
+        def store(xml):
+            data = compress_xml(xml)
+            return filestore.set(data, prefix) if data else None
+
+        cursor.execute(*table.select(table.id,
+                where=(table.pyafipws_xml_request != Null)
+                | (table.pyafipws_xml_response != Null)))
+        ids = [i for i, in cursor]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.id,
+                    table.pyafipws_xml_request, table.pyafipws_xml_response,
+                    where=reduce_ids(table.id, sub_ids)))
+            values = Values([[id_, store(xml_request), store(xml_response)]
+                    for id_, xml_request, xml_response in cursor.fetchall()])
+            cursor.execute(*table.update(
+                    [table.pyafipws_xml_request_id,
+                        table.pyafipws_xml_response_id],
+                    [values.column2, values.column3],
+                    from_=[values], where=table.id == values.column1))
+
+    @classmethod
+    def _migrate_pyafipws_xml_filestore(cls):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        prefix = transaction.database.name
+
+        for name in ['pyafipws_xml_request', 'pyafipws_xml_response']:
+            data = Column(table, name + '_data')
+            file_id = Column(table, name + '_id')
+            cursor.execute(*table.select(table.id,
+                    where=(data != Null) & (file_id == Null)))
+            ids = [i for i, in cursor]
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.select(table.id, data,
+                        where=reduce_ids(table.id, sub_ids)))
+                values = Values([[id_, filestore.set(bytes(value), prefix)]
+                        for id_, value in cursor.fetchall()])
+                cursor.execute(*table.update(
+                        [file_id, data], [values.column2, Null],
+                        from_=[values], where=table.id == values.column1))
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [cls._compress_pyafipws_xml(v) for v in vlist]
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for records, values in zip(actions, actions):
+            args.extend((records, cls._compress_pyafipws_xml(values)))
+        super().write(*args)
+
+    @classmethod
+    def _compress_pyafipws_xml(cls, values):
+        "Compress the XML text given for the XML fields"
+        values = values.copy()
+        for name in ['pyafipws_xml_request_data',
+                'pyafipws_xml_response_data']:
+            if isinstance(values.get(name), str):
+                values[name] = compress_xml(values[name])
+        return values
+
+    @classmethod
+    def get_pyafipws_xml(cls, transactions, names):
+        result = {n: {} for n in names}
+        for values in cls.read([t.id for t in transactions],
+                [n + '_data' for n in names]):
+            for name in names:
+                result[name][values['id']] = decompress_xml(
+                    values[name + '_data'])
+        return result
 
 
 class InvoiceLine(metaclass=PoolMeta):
@@ -426,6 +592,11 @@ class Invoice(metaclass=PoolMeta):
             })
     invoice_type_tree = fields.Function(fields.Selection(INVOICE_TYPE_POS,
         'Tipo comprobante'), 'get_comprobante', searcher='search_comprobante')
+    invoice_type_code = fields.Selection(INVOICE_TYPE_POS,
+        'Código de comprobante', readonly=True,
+        help='Código AFIP del tipo de comprobante')
+    invoice_type_class = fields.Char('Clase de comprobante', size=1,
+        readonly=True, help='Letra del comprobante (A, B, C o E)')
     pyafipws_concept = fields.Selection([
         ('1', '1-Productos'),
         ('2', '2-Servicios'),
@@ -466,6 +637,33 @@ class Invoice(metaclass=PoolMeta):
         help='Código de barras para usar en la impresión', readonly=True,)
     pyafipws_number = fields.Char('Número', size=13, readonly=True,
         help='Número de factura informado a la AFIP')
+    pyafipws_cae_status = fields.Selection([
+        (None, ''),
+        ('pending', 'CAE Pending'),
+        ('rejected', 'CAE Rejected'),
+        ('failed', 'CAE Request Failed'),
+        ], 'CAE Status', readonly=True,
+        states={
+            'invisible': ~Eval('pyafipws_cae_status'),
+            },
+        help='Estado de la solicitud de CAE en segundo plano')
+    pyafipws_cae_imp_total = fields.Numeric('Total AFIP', digits=(16, 2),
+        readonly=True, help='Importe total informado a la AFIP con el CAE')
+    pyafipws_cae_imp_neto = fields.Numeric('Gravado AFIP', digits=(16, 2),
+        readonly=True)
+    pyafipws_cae_imp_tot_conc = fields.Numeric('No Gravado AFIP',
+        digits=(16, 2), readonly=True)
+    pyafipws_cae_imp_op_ex = fields.Numeric('Exento AFIP', digits=(16, 2),
+        readonly=True)
+    pyafipws_cae_imp_iva = fields.Numeric('Imp. IVA AFIP', digits=(16, 2),
+        readonly=True)
+    pyafipws_cae_imp_trib = fields.Numeric('Imp. Tributo AFIP',
+        digits=(16, 2), readonly=True)
+    pyafipws_cae_moneda_id = fields.Char('Moneda AFIP', size=3,
+        readonly=True, help='Código de moneda informado a la AFIP')
+    pyafipws_cae_moneda_ctz = fields.Numeric('Cotización AFIP',
+        digits=(12, 6), readonly=True,
+        help='Cotización de la moneda informada a la AFIP')
     transactions = fields.One2Many('account_invoice_ar.afip_transaction',
         'invoice', 'Transacciones', readonly=True)
     tipo_comprobante = fields.Selection(TIPO_COMPROBANTE, 'Comprobante',
@@ -483,18 +681,20 @@ class Invoice(metaclass=PoolMeta):
     pyafipws_incoterms = fields.Selection(INCOTERMS, 'Incoterms')
     pyafipws_licenses = fields.One2Many('account.invoice.export.license',
         'invoice', 'Export Licenses')
-    ref_pos_number = fields.Function(fields.Char('POS Number', size=5,
+    ref_pos_number = fields.Integer('POS Number',
         states={
             'required': And(Eval('type') == 'in', Eval('state') != 'draft'),
             'invisible': Eval('type') == 'out',
             'readonly': Eval('state') != 'draft',
-            }), 'get_ref_subfield', setter='set_ref_subfield')
-    ref_voucher_number = fields.Function(fields.Char('Voucher Number', size=8,
+            },
+        help='Punto de venta de la referencia')
+    ref_voucher_number = fields.Integer('Voucher Number',
         states={
             'required': And(Eval('type') == 'in', Eval('state') != 'draft'),
             'invisible': Eval('type') == 'out',
             'readonly': Eval('state') != 'draft',
-            }), 'get_ref_subfield', setter='set_ref_subfield')
+            },
+        help='Número de comprobante de la referencia')
     pos_pos_daily_report = fields.Function(fields.Boolean("POS Daily Report"),
         'on_change_with_pos_pos_daily_report')
     ref_number_from = fields.Char('From number', size=13,
@@ -509,6 +709,8 @@ class Invoice(metaclass=PoolMeta):
             'invisible': ~Eval('pos_pos_daily_report', False),
             'readonly': Eval('state') != 'draft',
             })
+    ref_range_from = fields.Integer('From number (integer)', readonly=True)
+    ref_range_to = fields.Integer('To number (integer)', readonly=True)
     party_iva_condition = fields.Selection('get_party_iva_condition',
         'Condición ante IVA', states=_states)
     party_iva_condition_string = party_iva_condition.translated(
@@ -530,15 +732,15 @@ class Invoice(metaclass=PoolMeta):
     currency_rate = fields.Numeric('Currency rate', digits=(12, 6),
         states=_states)
     pyafipws_imp_neto = fields.Function(fields.Numeric('Gravado',
-        digits=(12, 2)), 'on_change_with_pyafipws_imp_neto')
+        digits=(12, 2)), 'get_pyafipws_amounts')
     pyafipws_imp_tot_conc = fields.Function(fields.Numeric('No Gravado',
-        digits=(12, 2)), 'on_change_with_pyafipws_imp_tot_conc')
+        digits=(12, 2)), 'get_pyafipws_amounts')
     pyafipws_imp_op_ex = fields.Function(fields.Numeric('Exento',
-        digits=(12, 2)), 'on_change_with_pyafipws_imp_op_ex')
+        digits=(12, 2)), 'get_pyafipws_amounts')
     pyafipws_imp_iva = fields.Function(fields.Numeric('Imp. IVA',
-        digits=(12, 2)), 'on_change_with_pyafipws_imp_iva')
+        digits=(12, 2)), 'get_pyafipws_amounts')
     pyafipws_imp_trib = fields.Function(fields.Numeric('Imp. Tributo',
-        digits=(12, 2)), 'on_change_with_pyafipws_imp_trib')
+        digits=(12, 2)), 'get_pyafipws_amounts')
     pyafipws_cmp_asoc = fields.Many2Many('account.invoice-cmp.asoc',
         'invoice', 'cmp_asoc', 'Comprobantes asociados',
         domain=[
@@ -571,13 +773,64 @@ class Invoice(metaclass=PoolMeta):
             })
         cls.number.depends = {'pos_pos_daily_report', 'state'}
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.pyafipws_concept, Index.Equality())),
-            #Index(t, (t.tipo_comprobante, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.pos, Index.Equality()),
+                    (t.invoice_type, Index.Equality()),
+                    (t.type, Index.Equality()),
+                    (t.state, Index.Equality())),
+                Index(
+                    t,
+                    (t.pyafipws_cae_status, Index.Equality()),
+                    where=t.pyafipws_cae_status != Null),
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.invoice_date, Index.Range()),
+                    include=[
+                        t.pyafipws_cae_imp_total, t.pyafipws_cae_imp_neto,
+                        t.pyafipws_cae_imp_tot_conc,
+                        t.pyafipws_cae_imp_op_ex, t.pyafipws_cae_imp_iva,
+                        t.pyafipws_cae_imp_trib, t.pyafipws_cae_moneda_id,
+                        t.pyafipws_cae_moneda_ctz],
+                    where=t.pyafipws_cae_imp_total != Null),
+                Index(
+                    t,
+                    (t.ref_pos_number, Index.Equality()),
+                    (t.ref_voucher_number, Index.Range()),
+                    where=t.type == 'in'),
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.invoice_type_code, Index.Equality()),
+                    (t.invoice_date, Index.Range()),
+                    where=t.type == 'out'),
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.invoice_type_class, Index.Equality()),
+                    (t.invoice_date, Index.Range()),
+                    where=t.type == 'out'),
+                })
+        if backend.name != 'postgresql':
+            # PostgreSQL uses a GiST index on the range, see __register__
+            cls._sql_indexes.add(
+                Index(
+                    t,
+                    (t.pos, Index.Equality()),
+                    (t.invoice_type, Index.Equality()),
+                    (t.ref_range_from, Index.Range()),
+                    include=[t.ref_range_to],
+                    where=t.ref_range_from != Null))
 
     @classmethod
     def __register__(cls, module_name):
+        pool = Pool()
+        PosSequence = pool.get('account.pos.sequence')
+        table_h = cls.__table_handler__(module_name)
+        fill_ref_numbers = not table_h.column_exist('ref_pos_number')
+        fill_invoice_type_code = not table_h.column_exist('invoice_type_code')
         super().__register__(module_name)
         cursor = Transaction().connection.cursor()
         cursor.execute('UPDATE account_invoice SET tipo_comprobante = \'001\' '
@@ -593,6 +846,65 @@ class Invoice(metaclass=PoolMeta):
         cursor.execute('UPDATE account_invoice SET tipo_comprobante = \'111\' '
             'WHERE tipo_comprobante = \'tkc\';')
 
+        table = cls.__table__()
+
+        def is_number(part):
+            return ((part != '')
+                & (Trim(part, 'BOTH', '0123456789') == '')
+                & (CharLength(part) <= 9))
+
+        # Migration from 7.0: fill the integer range of the daily reports
+        type_ = cls.ref_range_from.sql_type().base
+        ranges = []
+        for column in [table.ref_number_from, table.ref_number_to]:
+            value = Trim(column)
+            ranges.append(Case(
+                    (is_number(value), Cast(value, type_)), else_=Null))
+        cursor.execute(*table.update(
+                [table.ref_range_from, table.ref_range_to], ranges,
+                where=(table.ref_number_from != Null)
+                & (table.ref_range_from == Null)))
+        if backend.name == 'postgresql':
+            # The overlap of the daily reports is searched with && which
+            # only a GiST index supports. It is not named like the indexes
+            # of _sql_indexes to be kept by _update_sql_indexes.
+            cursor.execute('CREATE INDEX IF NOT EXISTS '
+                '"account_invoice_ref_range_gist" ON "account_invoice" '
+                'USING GIST ('
+                'INT4RANGE("ref_range_from", "ref_range_to", \'[]\')) '
+                'WHERE "type" = \'out\' '
+                'AND "ref_range_from" IS NOT NULL '
+                'AND "ref_range_to" IS NOT NULL '
+                'AND "ref_range_from" <= "ref_range_to"')
+
+        # Migration from 7.0: fill the numbers of the references
+        if fill_ref_numbers:
+            dash = Position('-', table.reference)
+            pos_number = Substring(table.reference, 1, Greatest(dash - 1, 0))
+            voucher_number = Substring(table.reference, dash + 1)
+
+            type_ = cls.ref_pos_number.sql_type().base
+            cursor.execute(*table.update(
+                    [table.ref_pos_number, table.ref_voucher_number],
+                    [Cast(pos_number, type_), Cast(voucher_number, type_)],
+                    where=(table.type == 'in') & (dash > 0)
+                    & is_number(pos_number) & is_number(voucher_number)))
+
+        # Migration from 7.0: fill the AFIP code and class of invoice type
+        if fill_invoice_type_code:
+            sequence = PosSequence.__table__()
+            cursor.execute(*table.update(
+                    [table.invoice_type_code],
+                    [sequence.select(sequence.invoice_type,
+                            where=sequence.id == table.invoice_type)],
+                    where=table.invoice_type != Null))
+            cursor.execute(*table.update(
+                    [table.invoice_type_class],
+                    [Case(*((table.invoice_type_code == c, l)
+                                for c, l in INVOICE_TYPE_CLASS.items()),
+                            else_=Null)],
+                    where=table.invoice_type_code != Null))
+
     @staticmethod
     def default_party_iva_condition():
         return None
@@ -696,6 +1008,99 @@ class Invoice(metaclass=PoolMeta):
                 imp_iva += tax_line.amount
         return abs(imp_iva)
 
+    @classmethod
+    def get_pyafipws_amounts(cls, invoices, names):
+        '''
+        Return the AFIP amounts of the invoices computed in bulk.
+
+        The amounts stored with the CAE are returned when they exist.
+        Otherwise they are the same as the on_change_with_pyafipws_imp_*
+        methods but are aggregated from the lines and the taxes with one
+        query each instead of reading every tax group.
+        '''
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Tax = pool.get('account.tax')
+        TaxGroup = pool.get('account.tax.group')
+        line = Line.__table__()
+        line_tax = LineTax.__table__()
+        invoice_tax = InvoiceTax.__table__()
+        tax = Tax.__table__()
+        tax_group = TaxGroup.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # line amounts summed per AFIP kind of their taxes
+        line_kinds = {
+            'gravado': 'pyafipws_imp_neto',
+            'no_gravado': 'pyafipws_imp_tot_conc',
+            'exento': 'pyafipws_imp_op_ex',
+            }
+        amounts = {n: {i.id: _ZERO for i in invoices} for n in AFIP_TOTALS}
+        invoices_by_id = {}
+        for invoice in invoices:
+            if invoice.pyafipws_cae_imp_total is not None:
+                for name, stored in AFIP_TOTALS.items():
+                    amounts[name][invoice.id] = (
+                        getattr(invoice, stored) or _ZERO)
+            else:
+                invoices_by_id[invoice.id] = invoice
+        exento = {i.id for i in invoices_by_id.values()
+            if i.company.party.iva_condition in ('exento', 'monotributo')}
+
+        for sub_ids in grouped_slice(list(invoices_by_id)):
+            if set(names) & set(line_kinds.values()):
+                cursor.execute(*line.join(line_tax,
+                        condition=line_tax.line == line.id
+                        ).join(tax, condition=line_tax.tax == tax.id
+                        ).join(tax_group, condition=tax.group == tax_group.id
+                        ).select(
+                        line.invoice, tax_group.afip_kind,
+                        line.quantity, line.unit_price,
+                        where=reduce_ids(line.invoice, sub_ids)
+                        & (line.type == 'line')
+                        & tax_group.afip_kind.in_(list(line_kinds))))
+                for invoice_id, kind, quantity, unit_price in cursor:
+                    invoice = invoices_by_id[invoice_id]
+                    # same rounding as the amount of the line
+                    amount = invoice.currency.round(
+                        Decimal(str(quantity or 0))
+                        * Decimal(str(unit_price or 0)))
+                    amounts[line_kinds[kind]][invoice_id] += amount
+
+            if {'pyafipws_imp_iva', 'pyafipws_imp_trib'} & set(names):
+                cursor.execute(*invoice_tax.join(tax,
+                        condition=invoice_tax.tax == tax.id
+                        ).join(tax_group, condition=tax.group == tax_group.id
+                        ).select(
+                        invoice_tax.invoice, tax_group.afip_kind,
+                        Sum(invoice_tax.amount),
+                        where=reduce_ids(invoice_tax.invoice, sub_ids),
+                        group_by=[invoice_tax.invoice, tax_group.afip_kind]))
+                for invoice_id, kind, amount in cursor:
+                    # SQLite uses float for SUM
+                    if not isinstance(amount, Decimal):
+                        amount = invoices_by_id[invoice_id].currency.round(
+                            Decimal(str(amount)))
+                    if kind == 'gravado':
+                        amounts['pyafipws_imp_iva'][invoice_id] += amount
+                    elif kind not in line_kinds:
+                        amounts['pyafipws_imp_trib'][invoice_id] += amount
+
+        if exento:
+            untaxed_amounts = cls.get_amount(
+                cls.browse(exento), ['untaxed_amount'])['untaxed_amount']
+            for invoice_id in exento:
+                amounts['pyafipws_imp_tot_conc'][invoice_id] = _ZERO
+                amounts['pyafipws_imp_op_ex'][invoice_id] = _ZERO
+                if untaxed_amounts[invoice_id]:
+                    amounts['pyafipws_imp_neto'][invoice_id] = (
+                        untaxed_amounts[invoice_id])
+
+        return {n: {i: abs(a) for i, a in amounts[n].items()}
+            for n in names}
+
     @fields.depends('pos')
     def on_change_with_pos_pos_daily_report(self, name=None):
         if self.pos:
@@ -720,7 +1125,7 @@ class Invoice(metaclass=PoolMeta):
     @classmethod
     def search_comprobante(cls, name, clause):
         return [
-            ('invoice_type.invoice_type',) + tuple(clause[1:]),
+            ('invoice_type_code',) + tuple(clause[1:]),
             ]
 
     @classmethod
@@ -735,17 +1140,129 @@ class Invoice(metaclass=PoolMeta):
         default['pyafipws_barcode'] = None
         default['pyafipws_number'] = None
         default['pyafipws_number'] = None
+        default['pyafipws_cae_status'] = None
+        default['pyafipws_cae_imp_total'] = None
+        default['pyafipws_cae_imp_neto'] = None
+        default['pyafipws_cae_imp_tot_conc'] = None
+        default['pyafipws_cae_imp_op_ex'] = None
+        default['pyafipws_cae_imp_iva'] = None
+        default['pyafipws_cae_imp_trib'] = None
+        default['pyafipws_cae_moneda_id'] = None
+        default['pyafipws_cae_moneda_ctz'] = None
         default['pos'] = None
         default['invoice_type'] = None
         default['reference'] = None
         default['tipo_comprobante'] = ''
         return super().copy(invoices, default=default)
 
+    @classmethod
+    def _set_ref_range(cls, values):
+        "Fill in values the integer range of the reference numbers"
+        for name, column in [
+                ('ref_number_from', 'ref_range_from'),
+                ('ref_number_to', 'ref_range_to'),
+                ]:
+            if name in values:
+                value = (values[name] or '').strip()
+                values[column] = int(value) if value.isdigit() else None
+        return values
+
+    @classmethod
+    def _set_ref_numbers(cls, values, invoice=None):
+        '''
+        Keep in values the reference and its numbers in sync.
+
+        Only supplier invoices have numbers. Their reference is built from
+        the numbers when they are set, then the numbers are always parsed
+        from it.
+        '''
+        numbers = {'ref_pos_number', 'ref_voucher_number'}
+        changed = values.keys() & (numbers | {'reference', 'type'})
+        type_ = values.get('type',
+            invoice.type if invoice else cls.default_type())
+        if type_ != 'in':
+            if changed:
+                values.update(dict.fromkeys(numbers))
+            return values
+        reference = values.get('reference',
+            invoice.reference if invoice else None)
+        if 'reference' not in values and values.keys() & numbers:
+            pos_number = values.get('ref_pos_number',
+                invoice.ref_pos_number if invoice else None)
+            voucher_number = values.get('ref_voucher_number',
+                invoice.ref_voucher_number if invoice else None)
+            if any(values.get(n) for n in numbers):
+                reference = values['reference'] = '%05d-%08d' % (
+                    pos_number or 0, voucher_number or 0)
+        if changed:
+            values.update(cls.get_ref_numbers(reference))
+        return values
+
+    @staticmethod
+    def get_ref_numbers(reference):
+        "Return the POS and voucher numbers of the reference"
+        pos_number = voucher_number = None
+        if reference and '-' in reference:
+            pos_number, voucher_number = [
+                int(n) if n.isdigit() and len(n) <= 9 else None
+                for n in reference.split('-', 1)]
+        return {
+            'ref_pos_number': pos_number,
+            'ref_voucher_number': voucher_number,
+            }
+
+    @classmethod
+    def _set_invoice_type_code(cls, vlist):
+        "Fill the AFIP code and class of the invoice type in vlist"
+        PosSequence = Pool().get('account.pos.sequence')
+        sequences = {s.id: s for s in PosSequence.browse(
+                {v['invoice_type'] for v in vlist if v.get('invoice_type')})}
+        for values in vlist:
+            if 'invoice_type' not in values:
+                continue
+            code = None
+            if values['invoice_type']:
+                code = sequences[values['invoice_type']].invoice_type
+            values['invoice_type_code'] = code
+            values['invoice_type_class'] = INVOICE_TYPE_CLASS.get(code)
+        return vlist
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [cls._set_ref_numbers(cls._set_ref_range(v.copy()))
+            for v in vlist]
+        return super().create(cls._set_invoice_type_code(vlist))
+
+    @classmethod
+    def write(cls, *args):
+        numbers = {'ref_pos_number', 'ref_voucher_number'}
+        actions = iter(args)
+        args = []
+        for invoices, values in zip(actions, actions):
+            values = cls._set_ref_range(values.copy())
+            if 'reference' in values and invoices:
+                # the numbers are only parsed for supplier invoices
+                def is_in(invoice):
+                    return values.get('type', invoice.type) == 'in'
+                for _, typed in groupby(
+                        sorted(invoices, key=is_in), key=is_in):
+                    typed = list(typed)
+                    args.extend((typed,
+                            cls._set_ref_numbers(values.copy(), typed[0])))
+            elif values.keys() & (numbers | {'type'}) and invoices:
+                # the reference depends on the numbers of each invoice
+                for invoice in invoices:
+                    args.extend(([invoice],
+                            cls._set_ref_numbers(values.copy(), invoice)))
+            else:
+                args.extend((invoices, values))
+        cls._set_invoice_type_code(args[1::2])
+        super().write(*args)
+
     @classmethod
     def validate(cls, invoices):
         super().validate(invoices)
-        for invoice in invoices:
-            invoice.check_unique_daily_report()
+        cls.check_daily_reports(invoices)
 
     @classmethod
     def get_party_iva_condition(cls):
@@ -754,30 +1271,70 @@ class Invoice(metaclass=PoolMeta):
             'iva_condition']['selection']
 
     def check_unique_daily_report(self):
-        if (self.type == 'out' and self.pos and
-                self.pos.pos_daily_report is True):
-            if int(self.ref_number_from) > int(self.ref_number_to):
+        self.check_daily_reports([self])
+
+    @classmethod
+    def _ref_range_overlap(cls, table, other):
+        "Return the condition of other report overlapping the table report"
+        if backend.name == 'postgresql':
+            # Match the predicate of the GiST index created by __register__
+            return ((other.type == 'out')
+                & (other.ref_range_from != Null)
+                & (other.ref_range_to != Null)
+                & (other.ref_range_from <= other.ref_range_to)
+                & Overlap(
+                    Int4Range(other.ref_range_from, other.ref_range_to, '[]'),
+                    Int4Range(table.ref_range_from, table.ref_range_to, '[]')))
+        return ((other.ref_range_from <= table.ref_range_to)
+            & (other.ref_range_to >= table.ref_range_from))
+
+    @classmethod
+    def check_daily_reports(cls, invoices):
+        '''
+        Check that the daily reports do not overlap the range of numbers of
+        another report of the same point of sale and invoice type.
+
+        All the reports are checked with one query per slice so a whole
+        import is validated at once.
+        '''
+        table = cls.__table__()
+        other = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        reports = []
+        for invoice in invoices:
+            if not (invoice.type == 'out' and invoice.pos
+                    and invoice.pos.pos_daily_report is True):
+                continue
+            for value, number in [
+                    (invoice.ref_number_from, invoice.ref_range_from),
+                    (invoice.ref_number_to, invoice.ref_range_to),
+                    ]:
+                if value and number is None:
+                    raise UserError(gettext(
+                        'account_invoice_ar.msg_invalid_ref_number',
+                        ref_value=value))
+            if invoice.ref_range_from is None or invoice.ref_range_to is None:
+                continue
+            if invoice.ref_range_from > invoice.ref_range_to:
                 raise UserError(gettext(
                     'account_invoice_ar.msg_invalid_ref_from_to'))
-            invoices = self.search([
-                ('id', '!=', self.id),
-                ('type', '=', self.type),
-                ('pos', '=', self.pos),
-                ('invoice_type', '=', self.invoice_type),
-                ('state', '!=', 'cancelled'),
-                ])
-            for invoice in invoices:
-                if (invoice.ref_number_to is None or
-                        invoice.ref_number_from is None):
-                    continue
-                ref_number_from = int(invoice.ref_number_from)
-                ref_number_to = int(invoice.ref_number_to)
-                if ((int(self.ref_number_from) >= ref_number_from and
-                     int(self.ref_number_from) <= ref_number_to) or
-                    (int(self.ref_number_to) >= ref_number_from and
-                     int(self.ref_number_to) <= ref_number_to)):
-                    raise UserError(gettext(
-                        'account_invoice_ar.msg_reference_unique'))
+            reports.append(invoice.id)
+
+        for sub_ids in grouped_slice(reports):
+            cursor.execute(*table.join(other,
+                    condition=(other.pos == table.pos)
+                    & (other.invoice_type == table.invoice_type)
+                    & (other.type == table.type)
+                    & (other.id != table.id)
+                    ).select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (other.state != 'cancelled')
+                    & cls._ref_range_overlap(table, other),
+                    limit=1))
+            if cursor.fetchone():
+                raise UserError(gettext(
+                    'account_invoice_ar.msg_reference_unique'))
 
     @classmethod
     def view_attributes(cls):
@@ -797,7 +1354,7 @@ class Invoice(metaclass=PoolMeta):
 
     def get_comprobante(self, name):
         if self.type == 'out' and self.invoice_type:
-            return self.invoice_type.invoice_type
+            return self.invoice_type_code
         return None
 
     @fields.depends('type', 'lines', 'total_amount', 'party',
@@ -844,32 +1401,6 @@ class Invoice(metaclass=PoolMeta):
 
         return list(res)
 
-    def get_ref_subfield(self, name):
-        if self.type == 'in' and self.reference and '-' in self.reference:
-            if name == 'ref_pos_number':
-                return self.reference.split('-')[0].lstrip('0')
-            elif name == 'ref_voucher_number':
-                return self.reference.split('-')[1].lstrip('0')
-        return None
-
-    @classmethod
-    def set_ref_subfield(cls, invoices, name, value):
-        if value and not value.isdigit():
-            raise UserError(gettext(
-                'account_invoice_ar.msg_invalid_ref_number',
-                ref_value=value))
-        reference = None
-        for invoice in invoices:
-            if value and invoice.type == 'in':
-                if name == 'ref_pos_number':
-                    reference = '%05d-%08d' % (int(value or 0),
-                        int(invoice.ref_voucher_number or 0))
-                elif name == 'ref_voucher_number':
-                    reference = '%05d-%08d' % (
-                        int(invoice.ref_pos_number or 0), int(value or 0))
-                invoice.reference = reference
-        cls.save(invoices)
-
     @classmethod
     @ModelView.button
     @Workflow.transition('validated')
@@ -880,8 +1411,119 @@ class Invoice(metaclass=PoolMeta):
             elif invoice.type == 'in':
                 invoice.pre_validate_fields()
             invoice.check_vat_existance()
+        cls.check_duplicate_references(invoices)
+        cls.update_invoice_type_code(invoices)
         super().validate_invoice(invoices)
 
+    @classmethod
+    def update_invoice_type_code(cls, invoices):
+        "Store the AFIP code and class of the invoice type of invoices"
+        to_write = defaultdict(list)
+        for invoice in invoices:
+            if (invoice.invoice_type and invoice.invoice_type_code
+                    != invoice.invoice_type.invoice_type):
+                to_write[invoice.invoice_type.id].append(invoice)
+        if to_write:
+            args = []
+            for invoice_type, sub_invoices in to_write.items():
+                args.extend((sub_invoices, {'invoice_type': invoice_type}))
+            cls.write(*args)
+
+    @classmethod
+    def check_pyafipws_invoices(cls, invoices):
+        '''
+        Return the errors, by invoice id, that prevent requesting the CAE
+        of the invoices.
+
+        The checks are done with a few queries for all the invoices.
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Pos = pool.get('account.pos')
+        PosSequence = pool.get('account.pos.sequence')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Tax = pool.get('account.tax')
+        CmpAsoc = pool.get('account.invoice-cmp.asoc')
+        Company = pool.get('company.company')
+        BankAccount = pool.get('bank.account')
+        BankAccountParty = pool.get('bank.account-party.party')
+        cursor = Transaction().connection.cursor()
+
+        invoice = cls.__table__()
+        currency = Currency.__table__()
+        pos = Pos.__table__()
+        sequence = PosSequence.__table__()
+        invoice_tax = InvoiceTax.__table__()
+        tax = Tax.__table__()
+        cmp_asoc = CmpAsoc.__table__()
+        company = Company.__table__()
+        bank_account = BankAccount.__table__()
+        bank_account_party = BankAccountParty.__table__()
+
+        def empty(column):
+            return (column == Null) | (column == '')
+
+        with_pos = invoice.join(pos, condition=invoice.pos == pos.id)
+        with_type = with_pos.join(sequence,
+            condition=invoice.invoice_type == sequence.id)
+        vat_service = pos.pyafipws_electronic_invoice_service.in_(
+            ['wsfe', 'wsmtxca'])
+        company_cbu = bank_account_party.join(bank_account,
+            condition=bank_account_party.account == bank_account.id
+            ).select(bank_account_party.id,
+                where=(bank_account_party.owner == company.party)
+                & (bank_account.pyafipws_cbu == Literal(True)))
+
+        checks = [
+            (invoice, empty(invoice.pyafipws_concept),
+                gettext('account_invoice_ar.msg_missing_pyafipws_concept')),
+            (invoice, invoice.pyafipws_concept.in_(['2', '3'])
+                & (invoice.pyafipws_billing_start_date == Null)
+                & (invoice.pyafipws_billing_end_date == Null),
+                gettext(
+                    'account_invoice_ar.msg_missing_pyafipws_billing_date')),
+            (invoice.join(currency,
+                    condition=invoice.currency == currency.id),
+                empty(currency.afip_code),
+                gettext('account_invoice_ar.msg_missing_currency_afip_code')),
+            (with_pos, (pos.pyafipws_electronic_invoice_service == 'wsfex')
+                & empty(invoice.pyafipws_incoterms),
+                gettext('account_invoice_ar.msg_missing_pyafipws_incoterms')),
+            (with_type.join(company, condition=invoice.company == company.id),
+                vat_service
+                & sequence.invoice_type.in_(['201', '206', '211'])
+                & (invoice.pyafipws_cbu == Null)
+                & ~Exists(company_cbu),
+                gettext('account_invoice_ar.msg_fce_10168_cbu_emisor')),
+            (with_type, vat_service
+                & sequence.invoice_type.in_(['2', '3', '7', '8', '12', '13',
+                        '202', '203', '207', '208', '212', '213'])
+                & ((invoice.pyafipws_cmp_asoc_desde == Null)
+                    | (invoice.pyafipws_cmp_asoc_hasta == Null))
+                & ~Exists(cmp_asoc.select(cmp_asoc.id,
+                        where=cmp_asoc.invoice == invoice.id)),
+                gettext('account_invoice_ar.msg_missing_cmp_asoc')),
+            ]
+
+        errors = defaultdict(list)
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            where = reduce_ids(invoice.id, sub_ids)
+            for from_, condition, message in checks:
+                cursor.execute(*from_.select(invoice.id,
+                        where=where & condition))
+                for invoice_id, in cursor:
+                    errors[invoice_id].append(message)
+            cursor.execute(*with_pos.join(invoice_tax,
+                    condition=invoice_tax.invoice == invoice.id
+                    ).join(tax, condition=invoice_tax.tax == tax.id
+                    ).select(invoice.id, tax.name,
+                    where=where & vat_service & (tax.group == Null)))
+            for invoice_id, tax_name in cursor:
+                errors[invoice_id].append(gettext(
+                        'account_invoice_ar.msg_tax_without_group',
+                        tax=tax_name))
+        return dict(errors)
+
     def check_invoice_type(self):
         if not self.company.party.iva_condition:
             raise UserError(gettext(
@@ -921,22 +1563,59 @@ class Invoice(metaclass=PoolMeta):
 
     def _similar_domain(self, delay=None):
         # Ignore cancelled invoices when checking similarity
-        domain = super()._similar_domain(delay=None)
-        domain.append(('state', '!=', 'cancelled'))
+        domain = super()._similar_domain(delay=delay)
+        if domain is not None:
+            domain.append(('state', '!=', 'cancelled'))
         return domain
 
     @fields.depends('party', 'tipo_comprobante', 'type', 'reference')
     def on_change_reference(self):
-        if self.type == 'in':
-            invoice = self.search([
-                ('id', '!=', self.id),
-                ('type', '=', self.type),
-                ('party', '=', self.party.id),
-                ('tipo_comprobante', '=', self.tipo_comprobante),
-                ('reference', '=', self.reference),
-                ('state', '!=', 'cancelled'),
-                ])
-            if len(invoice) > 0:
+        if self.type == 'in' and self.party:
+            key = (self.party.id, self.tipo_comprobante, self.reference)
+            duplicates = self.get_duplicate_references([key])
+            if set(duplicates.get(key, [])) - {self.id}:
+                raise UserError(gettext(
+                    'account_invoice_ar.msg_reference_unique'))
+
+    @classmethod
+    def get_duplicate_references(cls, keys):
+        '''
+        Return the ids of the supplier invoices, not cancelled, for each
+        (party id, tipo_comprobante, reference) of keys which exists.
+
+        The keys are resolved by slice with one query using the index on
+        reference of account_invoice.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        keys = {k for k in keys if k[0] is not None and k[2]}
+        duplicates = defaultdict(list)
+        for sub_keys in grouped_slice(list(keys)):
+            sub_keys = list(sub_keys)
+            cursor.execute(*table.select(
+                    table.party, table.tipo_comprobante, table.reference,
+                    table.id,
+                    where=table.reference.in_({k[2] for k in sub_keys})
+                    & table.party.in_({k[0] for k in sub_keys})
+                    & (table.type == 'in')
+                    & (table.state != 'cancelled')))
+            sub_keys = set(sub_keys)
+            for party, tipo_comprobante, reference, invoice_id in cursor:
+                key = (party, tipo_comprobante, reference)
+                if key in sub_keys:
+                    duplicates[key].append(invoice_id)
+        return dict(duplicates)
+
+    @classmethod
+    def check_duplicate_references(cls, invoices):
+        "Check that no other supplier invoice has the same reference"
+        invoices = [i for i in invoices if i.type == 'in' and i.party]
+        duplicates = cls.get_duplicate_references(
+            (i.party.id, i.tipo_comprobante, i.reference) for i in invoices)
+        for invoice in invoices:
+            key = (invoice.party.id, invoice.tipo_comprobante,
+                invoice.reference)
+            if set(duplicates.get(key, [])) - {invoice.id}:
                 raise UserError(gettext(
                     'account_invoice_ar.msg_reference_unique'))
 
@@ -991,10 +1670,7 @@ class Invoice(metaclass=PoolMeta):
         invoice_type, invoice_type_desc = INVOICE_TYPE_AFIP_CODE[
             (self.type, credit_note, kind, fce)
             ]
-        sequences = PosSequence.search([
-            ('pos', '=', self.pos),
-            ('invoice_type', '=', invoice_type)
-            ])
+        sequences = PosSequence.get_sequences(self.pos, invoice_type)
         if len(sequences) == 0:
             raise UserError(gettext(
                 'account_invoice_ar.msg_missing_sequence',
@@ -1066,10 +1742,7 @@ class Invoice(metaclass=PoolMeta):
         invoice_type, invoice_type_desc = INVOICE_CREDIT_AFIP_CODE[
             (self.invoice_type.invoice_type)
             ]
-        sequences = PosSequence.search([
-            ('pos', '=', credit.pos),
-            ('invoice_type', '=', invoice_type)
-            ])
+        sequences = PosSequence.get_sequences(credit.pos, invoice_type)
         if len(sequences) == 0:
             raise UserError(gettext(
                 'account_invoice_ar.msg_missing_sequence',
@@ -1107,7 +1780,9 @@ class Invoice(metaclass=PoolMeta):
         cls.update_taxes(new_invoices)
         if refund:
             try:
-                cls.post(new_invoices)
+                # the original is cancelled only once the credit has its CAE
+                with Transaction().set_context(pyafipws_sync=True):
+                    cls.post(new_invoices)
             except Exception as e:
                 cls.delete(new_invoices)
                 raise e
@@ -1137,7 +1812,9 @@ class Invoice(metaclass=PoolMeta):
             return invoice.accounting_date or invoice.invoice_date or today
 
         invoices = sorted(invoices, key=accounting_date)
-        sequences = set()
+        to_reserve = defaultdict(list)
+        # first invoice numbered by sequence
+        firsts = {}
 
         for invoice in invoices:
             # Posted and paid invoices are tested by check_modify so we can
@@ -1158,36 +1835,95 @@ class Invoice(metaclass=PoolMeta):
 
             if not invoice.invoice_date and invoice.type == 'out':
                 invoice.invoice_date = today
-            invoice.number, invoice.sequence = invoice.get_next_number()
-            if invoice.type == 'out' and invoice.sequence not in sequences:
-                date = accounting_date(invoice)
-                # Do not need to lock the table
-                # because sequence.get_id is sequential
-                after_invoices = cls.search([
-                    ('type', '=', 'out'),
-                    ('sequence', '=', invoice.sequence),
-                    ['OR',
-                        ('accounting_date', '>', date),
-                        [
-                            ('accounting_date', '=', None),
-                            ('invoice_date', '>', date)],
-                        ],
-                    ], order=[
-                        ('accounting_date', 'DESC'),
-                        ('invoice_date', 'DESC'),
-                        ],
-                    limit=1)
-                if after_invoices:
-                    after_invoice, = after_invoices
-                    raise InvoiceNumberError(
-                        gettext('account_invoice.msg_invoice_number_after',
-                            invoice=invoice.rec_name,
-                            sequence=Sequence(invoice.sequence).rec_name,
-                            date=Lang.get().strftime(date),
-                            after_invoice=after_invoice.rec_name))
-                sequences.add(invoice.sequence)
+            sequence = (invoice.type == 'out' and invoice.invoice_type
+                and invoice.invoice_type.invoice_sequence)
+            if sequence and sequence.type == 'incremental':
+                to_reserve[sequence].append(invoice)
+            else:
+                invoice.number, invoice.sequence = invoice.get_next_number()
+                if invoice.type == 'out':
+                    firsts.setdefault(invoice.sequence, invoice)
+
+        # the invoices of each sequence are sorted by accounting date
+        for sequence, sequence_invoices in to_reserve.items():
+            numbers = cls.reserve_numbers(sequence, len(sequence_invoices))
+            for invoice, number in zip(sequence_invoices, numbers):
+                invoice.number = '%05d-%08d' % (invoice.pos.number, number)
+                invoice.sequence = sequence.id
+            firsts[sequence.id] = sequence_invoices[0]
+
+        after_invoice = cls.get_invoice_number_after({
+                s: accounting_date(i) for s, i in firsts.items()})
+        if after_invoice:
+            sequence, after_invoice = after_invoice
+            invoice = firsts[sequence]
+            raise InvoiceNumberError(
+                gettext('account_invoice.msg_invoice_number_after',
+                    invoice=invoice.rec_name,
+                    sequence=Sequence(sequence).rec_name,
+                    date=Lang.get().strftime(accounting_date(invoice)),
+                    after_invoice=after_invoice.rec_name))
         cls.save(invoices)
 
+    @classmethod
+    def reserve_numbers(cls, sequence, count):
+        '''
+        Return count numbers of the incremental sequence reserved at once.
+
+        With a SQL sequence the numbers are drawn by one statement so they
+        are contiguous unless another transaction uses the sequence at the
+        same time. Otherwise the sequence is locked and increased once.
+        '''
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        transaction = Transaction()
+        if count <= 0:
+            return []
+        if backend.Database.has_sequence():
+            cursor = transaction.connection.cursor()
+            cursor.execute('SELECT nextval(\'"%s"\') '
+                'FROM generate_series(1, %%s)' % sequence._sql_sequence_name,
+                (count,))
+            numbers = sorted(n for n, in cursor)
+            # clean cache
+            transaction.counter += 1
+        else:
+            with transaction.set_context(_check_access=False):
+                Sequence.lock([sequence])
+                sequence = Sequence(sequence.id)
+                number_next = sequence.number_next_internal
+                Sequence.write([sequence], {
+                        'number_next_internal': (number_next
+                            + sequence.number_increment * count),
+                        })
+            numbers = [number_next + sequence.number_increment * i
+                for i in range(count)]
+        return numbers
+
+    @classmethod
+    def get_invoice_number_after(cls, dates):
+        '''
+        Return the first (sequence id, invoice) found with an accounting
+        date after the date of its sequence in dates.
+
+        All the sequences are checked with a single query.
+        '''
+        if not dates:
+            return None
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        date = Coalesce(table.accounting_date, table.invoice_date)
+        cursor.execute(*table.select(table.sequence, table.id,
+                where=(table.type == 'out')
+                & Or([(table.sequence == s) & (date > d)
+                        for s, d in dates.items()]),
+                order_by=[date.desc],
+                limit=1))
+        row = cursor.fetchone()
+        if row:
+            sequence, invoice_id = row
+            return sequence, cls(invoice_id)
+
     def get_next_number(self, pattern=None):
         if self.type == 'out':
             sequence = self.invoice_type.invoice_sequence
@@ -1214,8 +1950,79 @@ class Invoice(metaclass=PoolMeta):
             line.description += ' / %s' % self.description
         return line
 
+    def is_pyafipws_async(self):
+        "Test if the CAE of the invoice is requested in background"
+        return bool(not Transaction().context.get('pyafipws_sync')
+            and self.type == 'out'
+            and self.state in {'draft', 'validated'}
+            and self.pos
+            and self.pos.pos_type == 'electronic'
+            and self.pos.pyafipws_async
+            and not self.pyafipws_cae)
+
+    @classmethod
+    def queue_pyafipws_cae(cls, invoices):
+        '''
+        Validate the invoices and queue the request of their CAE.
+        '''
+        transaction = Transaction()
+        context = transaction.context
+        # already waiting in the queue
+        invoices = [i for i in invoices if i.pyafipws_cae_status != 'pending']
+        if not invoices:
+            return
+        draft_invoices = [i for i in invoices if i.state == 'draft']
+        if draft_invoices:
+            cls.validate_invoice(draft_invoices)
+        for invoice in invoices:
+            invoice.check_invoice_type()
+        cls.write(invoices, {'pyafipws_cae_status': 'pending'})
+        with transaction.set_context(
+                queue_name='account_invoice_ar_cae',
+                queue_batch=context.get('queue_batch', True)):
+            cls.__queue__.process_pyafipws_cae(invoices)
+
+    @classmethod
+    def process_pyafipws_cae(cls, invoices):
+        '''
+        Request the CAE of the invoices queued by post.
+
+        The invoices are posted in their own transaction, so a failure does
+        not roll back the task, and their status is then updated from the
+        committed result.
+        '''
+        transaction = Transaction()
+        invoices = [i for i in invoices
+            if i.pyafipws_cae_status == 'pending'
+            and i.state in {'draft', 'validated'}]
+        if not invoices:
+            return
+        ids = [i.id for i in invoices]
+        status = 'rejected'
+        try:
+            with transaction.new_transaction() as post_transaction, \
+                    post_transaction.set_context(pyafipws_sync=True):
+                cls.post(cls.browse(ids))
+        except UserError as exception:
+            logger.warning('CAE request of invoices %s failed: %s',
+                ids, exception)
+        except Exception:
+            # keep the invoices out of pending so they can be posted again
+            logger.exception('CAE request of invoices %s failed', ids)
+            status = 'failed'
+        # read what the posting has committed
+        transaction.commit()
+        invoices = cls.browse(ids)
+        cls.write([i for i in invoices if i.pyafipws_cae], {
+                'pyafipws_cae_status': None,
+                })
+        cls.write([i for i in invoices if not i.pyafipws_cae], {
+                'pyafipws_cae_status': status,
+                })
+
     @classmethod
     @ModelView.button
+    @queue_pyafipws
     @Workflow.transition('posted')
     def post(cls, invoices):
         pool = Pool()
@@ -1249,9 +2056,8 @@ class Invoice(metaclass=PoolMeta):
             pos = invoice.pos
             if not pos or pos.pos_type != 'electronic':
                 continue
-            if (pos.pyafipws_electronic_invoice_service == 'wsfe' and
-                    invoice.invoice_type.invoice_type not in [
-                    '201', '202', '206', '211', '212', '203', '208', '213']):
+            # FCE MiPyMEs vouchers are batched like the other WSFE ones
+            if pos.pyafipws_electronic_invoice_service == 'wsfe':
                 if invoice.number and invoice.pyafipws_cae:
                     invoices_wsfe_done.append(invoice)
                 elif invoice.number:
@@ -1289,21 +2095,47 @@ class Invoice(metaclass=PoolMeta):
 
         error_afip, error_pre_afip = [], []
 
+        batches = []
+        for pos, value_dict in list(invoices_wsfe_batch.items()):
+            for key, invoices_by_type in list(value_dict.items()):
+                batches.append([i for i in invoices_by_type if not i.number])
+
+        # reject before any AFIP request the invoices that can not pass
+        pre_errors = cls.check_pyafipws_invoices(
+            invoices_wsfe_non_batch + sum(batches, []))
+        if pre_errors:
+            for i in invoices_wsfe_non_batch + sum(batches, []):
+                if i.id in pre_errors:
+                    error_pre_afip.append(i)
+                    logger.error('%s: %s Entidad: %s: %s',
+                        i.invoice_type.invoice_type_string, i.id,
+                        i.party.rec_name, ', '.join(pre_errors[i.id]))
+            invoices_wsfe_non_batch = [i for i in invoices_wsfe_non_batch
+                if i.id not in pre_errors]
+            batches = [[i for i in b if i.id not in pre_errors]
+                for b in batches]
+
+        # raise the errors of the batch payloads before posting any invoice
+        batch_payloads = cls.get_pyafipws_batch_payloads(
+            sum(batches, []), checked=True)
+
+        if invoices_wsfe_non_batch or any(batches):
+            # no lock must be held while waiting for AFIP
+            Transaction().commit()
+
         for i in invoices_wsfe_non_batch:
-            (approved, pre_rejected, rejected) = cls.post_ws(i)
+            (approved, pre_rejected, rejected) = cls.post_ws(i, checked=True)
             if rejected:
                 error_afip.append(rejected)
             if pre_rejected:
                 error_pre_afip.append(pre_rejected)
 
-        for pos, value_dict in list(invoices_wsfe_batch.items()):
-            for key, invoices_by_type in list(value_dict.items()):
-                (approved, pre_rejected, rejected) = cls.post_ws_batch(
-                        [i for i in invoices_by_type if not i.number])
-                if rejected:
-                    error_afip.append(rejected)
-                if pre_rejected:
-                    error_pre_afip.append(pre_rejected)
+        for (approved, pre_rejected, rejected) in cls.post_ws_batches(
+                batches, payloads=batch_payloads):
+            if rejected:
+                error_afip.append(rejected)
+            if pre_rejected:
+                error_pre_afip.append(pre_rejected)
 
         if invoices_wsfe_done:
             invoices_to_process.extend(invoices_wsfe_done)
@@ -1312,69 +2144,141 @@ class Invoice(metaclass=PoolMeta):
         if invoices_in:
             invoices_to_process.extend(invoices_in)
 
-        cls.save(invoices)
+        # the invoices of the batches are saved by post_ws_batch, maybe in
+        # other transactions, so the instances here are outdated
+        batch_ids = {i.id for b in batches for i in b}
+        cls.save([i for i in invoices if i.id not in batch_ids])
         super().post(invoices_to_process)
         Transaction().commit()
 
         if error_afip:
+            messages = cls.get_pyafipws_last_messages(error_afip)
             raise UserError(gettext(
                 'account_invoice_ar.msg_rejected_invoices',
                 invoices=','.join([str(i.id) for i in error_afip]),
-                msg=','.join([i.transactions[-1].pyafipws_message
-                    for i in error_afip if i.transactions])))
+                msg=','.join([messages[i.id] or ''
+                    for i in error_afip if i.id in messages])))
 
         if error_pre_afip:
             raise UserError(gettext(
                 'account_invoice_ar.msg_rejected_invoices',
                 invoices=','.join([str(i.id) for i in error_pre_afip]),
-                msg=''))
+                msg='\n'.join(['%s: %s' % (i.id, ', '.join(pre_errors[i.id]))
+                        for i in error_pre_afip if i.id in pre_errors])))
+
+    @classmethod
+    def get_pyafipws_last_messages(cls, invoices):
+        '''
+        Return the message of the last AFIP transaction of each invoice.
+        '''
+        pool = Pool()
+        AFIP_Transaction = pool.get('account_invoice_ar.afip_transaction')
+        afip_tr = AFIP_Transaction.__table__()
+        cursor = Transaction().connection.cursor()
+
+        messages = {}
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            last = afip_tr.select(Max(afip_tr.id),
+                where=reduce_ids(afip_tr.invoice, sub_ids),
+                group_by=afip_tr.invoice)
+            cursor.execute(*afip_tr.select(
+                    afip_tr.invoice, afip_tr.pyafipws_message,
+                    where=afip_tr.id.in_(last)))
+            messages.update(cursor)
+        return messages
 
     @classmethod
     def consultar_and_recover(cls, invoices):
-        for invoice in invoices:
-            ws = cls.get_ws_afip(invoice=invoice)
-            if not invoice.invoice_date:
-                raise UserError(gettext(
-                    'account_invoice_ar.msg_missing_invoice_date'))
-            ws.Reprocesar = True
-            (ws, error) = invoice.create_pyafipws_invoice(ws)
-            cbte_nro = int(invoice.number[-8:])
-            cae = ws.CompConsultar(invoice.invoice_type.invoice_type,
-                invoice.pos.number, cbte_nro, reproceso=True)
-            if cae and ws.EmisionTipo == 'CAE':
-                # la factura se recupera y puede pasar a estado posted
-                logger.info('se ha reprocesado invoice %s', invoice.id)
-                invoice.save_afip_tr(ws, msg='Reprocesar=S')
-                tipo_cbte = invoice.invoice_type.invoice_type
-                punto_vta = invoice.pos.number
-                vto = ws.Vencimiento
-                cae_due = ''.join([c for c in str(vto)
-                        if c.isdigit()])
-                bars = ''.join([str(ws.Cuit), '%03d' % int(tipo_cbte),
-                        '%05d' % int(punto_vta), str(cae), cae_due])
-                bars += invoice.pyafipws_verification_digit_modulo10(bars)
-                pyafipws_cae_due_date = vto or None
-                if '-' not in vto:
-                    pyafipws_cae_due_date = '-'.join(
-                        [vto[:4], vto[4:6], vto[6:8]])
-                invoice.pyafipws_cae = cae
-                invoice.pyafipws_barcode = bars
-                invoice.pyafipws_cae_due_date = datetime.strptime(
-                    pyafipws_cae_due_date, "%Y-%m-%d").date()
-
-                # commit()
-                cls.save([invoice])
-                Transaction().commit()
-            else:
-                invoice.number = None
-                invoice.invoice_date = None
-                # commit()
-                cls.save([invoice])
-                Transaction().commit()
-                logger.error('diferencias entre el comprobante %s '
-                    'que tiene AFIP y el de tryton.', invoice.id)
+        '''
+        Recover from AFIP the CAE of numbered invoices without CAE.
+
+        The vouchers are queried concurrently, at most RECOVER_RATE per
+        second, and the results are saved and committed by chunk. The
+        invoices which differ from AFIP lose their number.
+        '''
+        if not invoices:
+            return invoices
+        if any(not i.invoice_date for i in invoices):
+            raise UserError(gettext(
+                'account_invoice_ar.msg_missing_invoice_date'))
+
+        def service(invoice):
+            return invoice.pos.pyafipws_electronic_invoice_service
+
+        mismatches = []
+        for _, service_invoices in groupby(
+                sorted(invoices, key=service), key=service):
+            mismatches.extend(cls._consultar_and_recover(
+                    list(service_invoices)))
+        if mismatches:
+            logger.error('diferencias entre los comprobantes %s '
+                'que tiene AFIP y los de tryton.',
+                ', '.join(map(str, mismatches)))
         return invoices
 
+    @classmethod
+    def _consultar_and_recover(cls, invoices):
+        pool = Pool()
+        AFIP_Transaction = pool.get('account_invoice_ar.afip_transaction')
+        transaction = Transaction()
+
+        clients = Queue()
+        workers = max(min(RECOVER_WORKERS, len(invoices)), 1)
+        limiter = RateLimiter(RECOVER_RATE)
+
+        def consultar(payload):
+            ws = clients.get()
+            try:
+                limiter.wait()
+                payload.apply(ws)
+                cae = ws.CompConsultar(payload.tipo_cbte, payload.punto_vta,
+                    payload.cbte_nro, reproceso=True)
+                result = snapshot_ws(ws)
+                result.CAE = cae
+                return result
+            finally:
+                clients.put(ws)
+
+        errors = cls.check_pyafipws_invoices(invoices)
+        if errors:
+            raise UserError(next(iter(errors.values()))[0])
+        mismatches = []
+        try:
+            for _ in range(workers):
+                ws = cls.get_ws_afip(invoice=invoices[0])
+                ws.Reprocesar = True
+                clients.put(ws)
+            ws = clients.get()
+            payloads = [i.get_pyafipws_payload(ws, checked=True)
+                for i in invoices]
+            clients.put(ws)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for sub_invoices in grouped_slice(
+                        list(zip(invoices, payloads)), RECOVER_CHUNK):
+                    sub_invoices, sub_payloads = zip(*sub_invoices)
+                    results = executor.map(consultar, sub_payloads)
+                    afip_transactions = []
+                    for invoice, payload, result in zip(
+                            sub_invoices, sub_payloads, results):
+                        if result.CAE and result.EmisionTipo == 'CAE':
+                            # la factura se recupera y puede pasar a posted
+                            logger.info('se ha reprocesado invoice %s',
+                                invoice.id)
+                            afip_transactions.append(invoice.get_afip_tr(
+                                    result, msg='Reprocesar=S'))
+                            invoice.set_pyafipws_cae(result, payload)
+                        else:
+                            invoice.number = None
+                            invoice.invoice_date = None
+                            mismatches.append(invoice.id)
+                    AFIP_Transaction.save(afip_transactions)
+                    cls.save(sub_invoices)
+                    transaction.commit()
+        finally:
+            while not clients.empty():
+                cls.release_ws_afip(clients.get())
+        return mismatches
+
     @classmethod
     def fiscal_printer_invoice_post(cls, invoice=None):
         #TODO: Implement fiscal printer integration
@@ -1384,6 +2288,9 @@ class Invoice(metaclass=PoolMeta):
     def get_ws_afip(cls, invoice=None, batch=False):
         '''
         Connect to WSAA AFIP and get webservice wsfe or wsfex
+
+        The client is taken from the pool when possible and must be given
+        back with release_ws_afip.
         '''
         if batch is False and invoice:
             service = invoice.pos.pyafipws_electronic_invoice_service
@@ -1394,37 +2301,39 @@ class Invoice(metaclass=PoolMeta):
             raise UserError(gettext(
                 'account_invoice_ar.msg_webservice_unknown'))
 
+        company = cls.get_afip_company()
+        key = ws_pool.key(company, service)
+        ws = ws_pool.checkout(key)
+        if ws is not None:
+            ws.Reprocesar = False
+            return ws
+
         (company, ta) = cls.authenticate_afip(service=service)
-        # TODO: get wsdl url from DictField?
         if service == 'wsfe':
             ws = WSFEv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL')
         elif service == 'wsfex':
             ws = WSFEXv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL')
         else:
             logger.critical('AFIP ws is not yet supported! %s', service)
             raise UserError(gettext(
                 'account_invoice_ar.msg_webservice_not_supported',
                 service=service))
+        WSDL = get_wsdl(service, company.pyafipws_mode_cert)
 
         ws = cls.conect_afip(ws, WSDL, company.party.vat_number, ta)
+        ws_pool.add(key, ws, get_ticket_expiration(ta))
         ws.Reprocesar = False
         return ws
 
     @classmethod
-    def authenticate_afip(cls, service='wsfe'):
+    def release_ws_afip(cls, ws):
         '''
-        Authenticate to webservice WSAA
+        Give back to the pool a client obtained with get_ws_afip
         '''
+        ws_pool.release(ws)
+
+    @classmethod
+    def get_afip_company(cls):
         pool = Pool()
         Company = pool.get('company.company')
         company_id = Transaction().context.get('company')
@@ -1432,9 +2341,18 @@ class Invoice(metaclass=PoolMeta):
             logger.error('The company is not defined')
             raise UserError(gettext(
                 'account_invoice_ar.msg_company_not_defined'))
-        company = Company(company_id)
+        return Company(company_id)
+
+    @classmethod
+    def authenticate_afip(cls, service='wsfe'):
+        '''
+        Authenticate to webservice WSAA
+        '''
+        pool = Pool()
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
+        company = cls.get_afip_company()
         # authenticate against AFIP:
-        ta = company.pyafipws_authenticate(service=service)
+        ta = Ticket.get_ticket(company, service)
         return (company, ta)
 
     @classmethod
@@ -1449,7 +2367,7 @@ class Invoice(metaclass=PoolMeta):
         ws.SetTicketAcceso(ta)
         ws.Cuit = vat_number
         try:
-            ws.Conectar(wsdl=wsdl, cache=cache, cacert=True)
+            connect(ws, wsdl, cache)
         except Exception as e:
             msg = ws.Excepcion + ' ' + str(e)
             logger.error('WSAA connecting to afip: %s' % msg)
@@ -1458,45 +2376,66 @@ class Invoice(metaclass=PoolMeta):
         return ws
 
     @classmethod
-    def post_ws(cls, invoice):
+    def post_ws(cls, invoice, checked=False):
         '''
         Post non batch invoice.
+
+        The number is reserved and committed before the CAE is requested so
+        no lock is held while waiting for AFIP. It is only requested if the
+        number is the next one expected by AFIP.
+        checked is set when check_pyafipws_invoices has already been done.
         '''
         pool = Pool()
         Date = pool.get('ir.date')
+        LastAuthorized = pool.get('account.pos.last_authorized')
 
         if not invoice:
             return (None, None, None)
 
         ws = cls.get_ws_afip(invoice)
-        pre_approved = None
         approved = None
         pre_rejected = None
         rejected = None
-        error_obtained = False
 
         if not invoice.invoice_date:
             invoice.invoice_date = Date.today()
-        (ws, error) = invoice.create_pyafipws_invoice(ws, batch=False)
-        if error is False:
-            pre_approved = invoice
-        else:
-            error_obtained = True
+        payload = invoice.get_pyafipws_payload(
+            ws, batch=False, checked=checked)
+        if payload.error:
             invoice.invoice_date = None
             pre_rejected = invoice
             logger.error('%s: %s Entidad: %s',
                 invoice.invoice_type.invoice_type_string,
                 invoice.id, invoice.party.rec_name)
-
-        if pre_approved:
-            cls.set_number([invoice])
-            (ws, error) = invoice.create_pyafipws_invoice(ws, batch=False)
+        else:
+            payloads = {invoice: payload}
+            cls._reserve_ws_chunk([invoice], payloads)
+            payload = payloads[invoice]
+            cbte_nro_next = payload.cbte_nro
+            if not ws.Reprocesar:
+                cbte_nro_afip = LastAuthorized.get_last_number(ws,
+                    invoice.pos, payload.tipo_cbte, payload.service,
+                    expected=payload.cbte_nro - 1)
+                cbte_nro_next = int(cbte_nro_afip or 0) + 1
+            if payload.cbte_nro != cbte_nro_next:
+                # give back the number before raising
+                invoice.number = None
+                invoice.invoice_date = None
+                cls._finalize_ws_chunk(
+                    BatchChunkResult([invoice], [], [invoice]))
+                invoice.reset_sequence_from_ws(ws)
+                Transaction().commit()
+                cls.release_ws_afip(ws)
+                raise UserError(gettext(
+                    'account_invoice_ar.msg_invalid_invoice_number',
+                    cbte_nro=payload.cbte_nro, cbte_nro_next=cbte_nro_next))
+            payload.apply(ws)
             (ws, msg) = invoice.request_cae(ws)
-            result = invoice.process_afip_result(ws, msg=msg)
+            result = invoice.process_afip_result(snapshot_ws(ws),
+                msg=msg, payload=payload)
             if result == 'A':
                 approved = invoice
             else:
-                error_obtained = True
                 if result != 'R':
                     invoice.number = None
                     invoice.invoice_date = None
@@ -1507,23 +2446,49 @@ class Invoice(metaclass=PoolMeta):
                     rejected.invoice_type.invoice_type_string,
                     rejected.id, rejected.party.rec_name,
                     repr(ws.XmlRequest), repr(ws.XmlResponse))
-
-            # commit()
-            cls.save([invoice])
-            Transaction().commit()
-            if approved:
-                super().post([approved])
+            cls._finalize_ws_chunk(BatchChunkResult([invoice],
+                    [approved] if approved else [],
+                    [rejected] if rejected else []))
+            if rejected:
+                rejected.reset_sequence_from_ws(ws)
                 Transaction().commit()
 
-        if error_obtained and rejected:
-            rejected.reset_sequence_from_ws(ws)
-
+        cls.release_ws_afip(ws)
         return (approved, pre_rejected, rejected)
 
     @classmethod
-    def post_ws_batch(cls, invoices):
+    def get_pyafipws_batch_payloads(cls, invoices, checked=False):
+        '''
+        Return the batch AfipPayload of the invoices by id.
+
+        The invoices are checked at once by check_pyafipws_invoices unless
+        checked is set. The invoices without date are dated today.
+        '''
+        Date = Pool().get('ir.date')
+        errors = {} if checked else cls.check_pyafipws_invoices(invoices)
+        payloads = {}
+        for invoice in invoices:
+            if invoice.id in errors:
+                logger.error('%s: %s' % (
+                        invoice.rec_name, ', '.join(errors[invoice.id])))
+                payloads[invoice.id] = AfipPayload(error=True)
+                continue
+            if not invoice.invoice_date:
+                invoice.invoice_date = Date.today()
+            payloads[invoice.id] = invoice.get_pyafipws_payload(
+                None, batch=True, checked=True)
+        return payloads
+
+    @classmethod
+    def post_ws_batch(cls, invoices, batch_payloads=None):
         '''
         Post batch invoices.
+
+        batch_payloads are the batch AfipPayload by invoice id already built.
+
+        Each chunk is numbered and committed, then sent to AFIP without
+        pending changes in the transaction, and finally its results are
+        applied and committed.
         '''
         pool = Pool()
         Date = pool.get('ir.date')
@@ -1532,8 +2497,12 @@ class Invoice(metaclass=PoolMeta):
             return ([], [], [])
 
         ws = cls.get_ws_afip(batch=True)
-        reg_x_req = ws.CompTotXRequest()    # cant max. comprobantes
+        # (service, mode)
+        key = ws_pool.key(cls.get_afip_company(), 'wsfe')[2:]
+        # cant max. comprobantes
+        reg_x_req = chunk_sizer.get_limit(key, ws.CompTotXRequest)
         pre_approved = []
+        payloads = {}
         approved = []
         pre_rejected = None
         rejected = None
@@ -1545,9 +2514,12 @@ class Invoice(metaclass=PoolMeta):
             # TODO: usar try/except
             if not invoice.invoice_date:
                 invoice.invoice_date = Date.today()
-            (ws, error) = invoice.create_pyafipws_invoice(ws, batch=True)
-            if error is False:
+            payload = (batch_payloads or {}).get(invoice.id)
+            if payload is None:
+                payload = invoice.get_pyafipws_payload(ws, batch=True)
+            if not payload.error:
                 pre_approved.append(invoice)
+                payloads[invoice] = payload
             else:
                 invoice.invoice_date = None
                 if pre_rejected is None:
@@ -1556,65 +2528,226 @@ class Invoice(metaclass=PoolMeta):
                     invoice.invoice_type.invoice_type_string,
                     invoice.id, invoice.party.rec_name)
 
-        tmp_ = [pre_approved[i:i + reg_x_req] for i in
-            range(0, len(pre_approved), reg_x_req)]
-        for chunk_invoices in tmp_:
-            excepcion = False
-            ws.IniciarFacturasX()
-            invoices_added_to_ws = []
-            error_obtained = False
-            cls.set_number(chunk_invoices)
-            for invoice in chunk_invoices:
-                (ws, error) = invoice.create_pyafipws_invoice(ws, batch=True)
-                if error is False:
-                    ws.AgregarFacturaX()
-                    invoices_added_to_ws.append(invoice)
-            # CAESolicitarX
-            try:
-                cant_solicitadax = ws.CAESolicitarX()
-                logger.info('wsfe batch invoices posted: %s' %
-                    cant_solicitadax)
-            except Exception as e:
-                logger.error('CAESolicitarX msg: %s' % str(e))
-                excepcion = True
-
-            # Process results:
-            cant = 0
-            for invoice in invoices_added_to_ws:
-                ws.LeerFacturaX(cant)
-                cant += 1
-                result = 'R' if excepcion else invoice.process_afip_result(ws)
-                if result == 'A':
-                    approved.append(invoice)
-                else:
-                    error_obtained = True
-                    if result != 'R':
-                        invoice.number = None
-                        invoice.invoice_date = None
-                    if rejected is None:
-                        rejected = invoice
-                        logger.error(
-                            '%s: %s Entidad: %s\n'
-                            'XmlRequest: %s\nXmlResponse: %s\n',
-                            rejected.invoice_type.invoice_type_string,
-                            rejected.id, rejected.party.rec_name,
-                            repr(ws.XmlRequest), repr(ws.XmlResponse))
-            # commit()
-            cls.save(invoices_added_to_ws)
+        i = 0
+        while i < len(pre_approved):
+            chunk = pre_approved[i:i + chunk_sizer.get_size(key, reg_x_req)]
+            i += len(chunk)
+            result = cls._post_ws_chunk(ws, chunk, payloads, size=reg_x_req)
+            approved.extend(result.approved)
+            if result.rejected and rejected is None:
+                rejected = result.rejected[0]
+                logger.error(
+                    '%s: %s Entidad: %s\n'
+                    'XmlRequest: %s\nXmlResponse: %s\n',
+                    rejected.invoice_type.invoice_type_string,
+                    rejected.id, rejected.party.rec_name,
+                    repr(ws.XmlRequest), repr(ws.XmlResponse))
+
+        cls.release_ws_afip(ws)
+        return (approved, pre_rejected, rejected)
+
+    @classmethod
+    def _post_ws_chunk(cls, ws, invoices, payloads, size=None):
+        '''
+        Post a chunk of invoices with one CAESolicitarX.
+
+        The request runs between the transaction reserving the numbers and
+        the one applying the results, without lock. When wsfe_batch_window
+        is set, it is shared with the chunks posted meanwhile for the same
+        POS and voucher type up to size invoices. On rejection the sequence
+        is synchronized with AFIP. Return the BatchChunkResult.
+        '''
+        key = ws_pool.key(cls.get_afip_company(), 'wsfe')
+        payload = payloads[invoices[0]]
+        cls._reserve_ws_chunk(invoices, payloads)
+        chunk_payloads = [payloads[i] for i in invoices]
+        send = partial(cls._request_ws_chunk, ws, key=key[2:])
+        if BATCH_WINDOW:
+            results = ws_collector.request(
+                key + (payload.punto_vta, payload.tipo_cbte),
+                chunk_payloads, send, size=size)
+        else:
+            results = send(chunk_payloads)
+        result = cls._apply_ws_chunk(invoices, payloads, results)
+        cls._finalize_ws_chunk(result)
+        if result.rejected:
+            result.rejected[0].reset_sequence_from_ws(ws)
             Transaction().commit()
-            if approved:
-                super().post(approved)
-                Transaction().commit()
+        return result
 
-            if error_obtained and rejected:
-                rejected.reset_sequence_from_ws(ws)
+    @classmethod
+    def lock_ws_sequence(cls, invoice):
+        '''
+        Lock the numbering of the POS and voucher type of the invoice until
+        the end of the transaction.
 
-        return (approved, pre_rejected, rejected)
+        It is only held to reserve numbers or to synchronize the sequence,
+        never while waiting for AFIP.
+        '''
+        transaction = Transaction()
+        lock_id = zlib.crc32(('%s:%s:%s' % (cls.__name__,
+                    invoice.pos.id, invoice.invoice_type.id)).encode())
+        transaction.connection.cursor().execute(*Select([
+                    transaction.database.lock_id(lock_id, timeout=True)]))
+
+    @classmethod
+    def _reserve_ws_chunk(cls, invoices, payloads):
+        '''
+        Number the invoices and their payloads and commit the numbers.
+        '''
+        cls.lock_ws_sequence(invoices[0])
+        cls.set_number(invoices)
+        for invoice in invoices:
+            if (invoice.invoice_type.invoice_type in ('201', '206', '211')
+                    and not invoice.pyafipws_cbu):
+                # store the CBU sent by the payload
+                invoice.pyafipws_cbu = invoice.get_pyafipws_cbu()
+            payloads[invoice] = payloads[invoice].set_number(
+                int(invoice.number[-8:]))
+        # the invoices numbered without CAE are recovered if the request is
+        # lost
+        cls.save(invoices)
+        Transaction().commit()
+
+    @staticmethod
+    def _request_ws_chunk(ws, payloads, key=None):
+        '''
+        Send the payloads with CAESolicitarX by increasing number.
+
+        It does not use the database. The latency is recorded for the
+        (service, mode) key to size the next chunks. Return the copy of the
+        result of each payload or None if the request failed.
+        '''
+        order = sorted(range(len(payloads)),
+            key=lambda i: payloads[i].cbte_nro)
+        ws.IniciarFacturasX()
+        for i in order:
+            payloads[i].apply(ws)
+            ws.AgregarFacturaX()
+        start = time.monotonic()
+        try:
+            cant_solicitadax = ws.CAESolicitarX()
+            logger.info('wsfe batch invoices posted: %s' %
+                cant_solicitadax)
+        except Exception as e:
+            logger.error('CAESolicitarX msg: %s' % str(e))
+            if key is not None:
+                chunk_sizer.record(key, len(payloads),
+                    time.monotonic() - start, len(ws.XmlRequest or ''),
+                    timeout=(isinstance(e, TimeoutError)
+                        or 'timed out' in str(e).lower()))
+            return [None] * len(payloads)
+        if key is not None:
+            chunk_sizer.record(key, len(payloads), time.monotonic() - start,
+                len(ws.XmlRequest or ''))
+
+        results = [None] * len(payloads)
+        for cant, i in enumerate(order):
+            ws.LeerFacturaX(cant)
+            results[i] = snapshot_ws(ws)
+        return results
+
+    @classmethod
+    def _apply_ws_chunk(cls, invoices, payloads, results):
+        '''
+        Store the results of a chunk and return its BatchChunkResult.
+        '''
+        approved, rejected = [], []
+        for invoice, ws in zip(invoices, results):
+            result = ('R' if ws is None
+                else invoice.process_afip_result(
+                    ws, payload=payloads[invoice]))
+            if result == 'A':
+                approved.append(invoice)
+            else:
+                if result != 'R':
+                    invoice.number = None
+                    invoice.invoice_date = None
+                rejected.append(invoice)
+        return BatchChunkResult(invoices, approved, rejected)
+
+    @classmethod
+    def _finalize_ws_chunk(cls, result):
+        '''
+        Save and commit the invoices of a chunk then post its approved ones.
+
+        Only the invoices of the chunk are handled so the cost of a batch
+        grows linearly with its number of chunks.
+        '''
+        cls.save(result.invoices)
+        Transaction().commit()
+        if result.approved:
+            super().post(result.approved)
+            Transaction().commit()
+
+    @classmethod
+    def post_ws_batches(cls, batches, payloads=None):
+        '''
+        Post batches of invoices of different POS and voucher types.
+
+        The batches are independent so they are posted concurrently, each
+        one in its own transaction. payloads are the batch AfipPayload by
+        invoice id, they are built when not given. Return the list of results
+        of post_ws_batch.
+        '''
+        batches = [b for b in batches if b]
+        transaction = Transaction()
+        if payloads is None:
+            # the errors of the payloads are raised before any batch is posted
+            payloads = cls.get_pyafipws_batch_payloads(sum(batches, []))
+        workers = min(BATCH_WORKERS, len(batches))
+        if workers <= 1 or backend.name == 'sqlite':
+            return [cls.post_ws_batch(b, batch_payloads=payloads)
+                for b in batches]
+
+        # renew the ticket once instead of in each worker
+        cls.authenticate_afip(service='wsfe')
+        # the workers only see committed data
+        transaction.commit()
+        post = partial(cls._post_ws_batch_worker, transaction.database.name,
+            transaction.user, dict(transaction.context), payloads)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                    post, [[i.id for i in b] for b in batches]))
+        # invalidate the records cached before the workers changed them
+        transaction.counter += 1
+
+        def browse(id_):
+            return cls(id_) if id_ is not None else None
+        return [(cls.browse(approved), browse(pre_rejected), browse(rejected))
+            for approved, pre_rejected, rejected in results]
+
+    @classmethod
+    def _post_ws_batch_worker(cls, database, user, context, payloads, ids):
+        with Transaction().start(database, user, context=context):
+            invoices = cls.browse(ids)
+            approved, pre_rejected, rejected = cls.post_ws_batch(
+                invoices, batch_payloads=payloads)
+            # keep invoice date reset of the pre-rejected invoices
+            cls.save(invoices)
+            return ([i.id for i in approved],
+                pre_rejected.id if pre_rejected else None,
+                rejected.id if rejected else None)
 
     def create_pyafipws_invoice(self, ws, batch=False):
         '''
         Create invoice as pyafipws requires and call to ws.CrearFactura(args).
         '''
+        payload = self.get_pyafipws_payload(ws, batch=batch)
+        if not payload.error:
+            payload.apply(ws)
+        return (ws, payload.error)
+
+    def get_pyafipws_payload(self, ws, batch=False, checked=False):
+        '''
+        Return the AfipPayload of the invoice without changing it.
+
+        The invoice is checked by check_pyafipws_invoices unless checked is
+        set because it has already been done.
+        In batch mode, validation errors are returned as a payload with
+        error set instead of being raised and ws can be None as no request
+        is made.
+        '''
 
         def strip_accents(text):
             """
@@ -1635,27 +2768,18 @@ class Invoice(metaclass=PoolMeta):
             text = text.decode("utf-8")
             return str(text)
 
-        # verify pyafipws_concept
-        if not self.pyafipws_concept:
-            if batch:
-                logger.error('missing_pyafipws_concept:field pyafipws_concept '
-                    'is missing at invoice "%s"' % self.rec_name)
-                return (ws, True)
-            raise UserError(gettext(
-                'account_invoice_ar.msg_missing_pyafipws_concept'))
-        if (self.pyafipws_concept in ['2', '3'] and not
-                (self.pyafipws_billing_start_date or
-                    self.pyafipws_billing_end_date)):
+        # the checks are shared with the pre-flight of post
+        if not checked:
+            errors = self.check_pyafipws_invoices([self]).get(self.id)
+            if errors:
                 if batch:
-                    logger.error('missing_pyafipws_billing_date:billing_dates '
-                        'fields are missing at invoice "%s"' % self.rec_name)
-                    return (ws, True)
-                raise UserError(gettext(
-                    'account_invoice_ar.msg_missing_pyafipws_billing_date'))
+                    logger.error('%s: %s' % (self.rec_name, ', '.join(errors)))
+                    return AfipPayload(error=True)
+                raise UserError(errors[0])
         # get the electronic invoice type, point of sale and service:
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
         Date = pool.get('ir.date')
+        BankAccount = pool.get('bank.account')
         today = Date.today()
 
         # get the electronic invoice type, point of sale and service:
@@ -1665,43 +2789,18 @@ class Invoice(metaclass=PoolMeta):
 
         if service == 'wsfex' and not self.party.vat_number_afip_foreign:
             logger.error('missing_cuit_pais: %s', self.party.rec_name)
+            if batch:
+                return AfipPayload(error=True)
             raise UserError(gettext('account_invoice_ar.msg_missing_cuit_pais',
                 party=self.party.rec_name))
 
-        # get the last 8 digit of the invoice number
-        if self.number:
-            cbte_nro = int(self.number[-8:])
-        else:
-            cbte_nro = int(Sequence(
-                self.invoice_type.invoice_sequence.id).get_number_next(''))
-
-        # get the last invoice number registered in AFIP
-        if ws.Reprocesar:
-            cbte_nro_next = cbte_nro
-        elif batch:
-            cbte_nro_next = cbte_nro
-        else:
-            if service == 'wsfe':
-                cbte_nro_afip = ws.CompUltimoAutorizado(tipo_cbte, punto_vta)
-            elif service == 'wsmtxca':
-                cbte_nro_afip = ws.ConsultarUltimoComprobanteAutorizado(
-                    tipo_cbte, punto_vta)
-            elif service == 'wsfex':
-                cbte_nro_afip = ws.GetLastCMP(tipo_cbte, punto_vta)
-            cbte_nro_next = int(cbte_nro_afip or 0) + 1
-            # verify that the invoice is the next one to be registered in AFIP
-            if cbte_nro != cbte_nro_next:
-                if batch:
-                    logger.error('invalid_invoice_number: Invoice: %s, try to '
-                        'assign invoice number: %d when AFIP is waiting for '
-                        '%d' % (self.id, cbte_nro, cbte_nro_next))
-                    return (ws, True)
-                raise UserError(gettext(
-                    'account_invoice_ar.msg_invalid_invoice_number',
-                    cbte_nro=cbte_nro, cbte_nro_next=cbte_nro_next))
+        # get the last 8 digit of the invoice number, the payload of an
+        # invoice without number is numbered once its number is reserved
+        cbte_nro = int(self.number[-8:]) if self.number else None
+        reprocesar = bool(ws and ws.Reprocesar)
 
         # invoice number range (from - to) and date:
-        cbte_nro = cbt_desde = cbt_hasta = cbte_nro_next
+        cbt_desde = cbt_hasta = cbte_nro
 
         if self.invoice_date:
             fecha_cbte = self.invoice_date.strftime('%Y-%m-%d')
@@ -1725,7 +2824,7 @@ class Invoice(metaclass=PoolMeta):
                     self.currency, payment_date)
             if payments:
                 last_payment = max(payments, key=lambda x: x[0])[0]
-            elif service == 'wsfe' and ws.Reprocesar:
+            elif service == 'wsfe' and reprocesar:
                 last_payment = self.invoice_date
             else:
                 last_payment = today
@@ -1782,13 +2881,6 @@ class Invoice(metaclass=PoolMeta):
 
         # currency and rate
         moneda_id = self.currency.afip_code
-        if not moneda_id:
-            if batch:
-                logger.error('missing_currency_afip_code: Invoice: %s, '
-                    'currency afip code is not setted.' % self.id)
-                return (ws, True)
-            raise UserError(gettext(
-                'account_invoice_ar.msg_missing_currency_afip_code'))
 
         if moneda_id != "PES":
             ctz = self.currency_rate
@@ -1800,7 +2892,7 @@ class Invoice(metaclass=PoolMeta):
                     if batch:
                         logger.error('missing_currency_rate: Invoice: %s, '
                             'rate is not setted.' % self.id)
-                        return (ws, True)
+                        return AfipPayload(error=True)
                     raise UserError(gettext(
                         'account_invoice_ar.msg_missing_currency_rate'))
                 else:
@@ -1819,14 +2911,6 @@ class Invoice(metaclass=PoolMeta):
         else:
             incoterms = incoterms_ds = None
 
-        if incoterms is None and incoterms_ds is None and service == 'wsfex':
-            if batch:
-                logger.error('missing_pyafipws_incoterms: Invoice: %s '
-                    'field is not setted.' % self.id)
-                return (ws, True)
-            raise UserError(gettext(
-                'account_invoice_ar.msg_missing_pyafipws_incoterms'))
-
         if int(tipo_cbte) == 19 and tipo_expo == 1:
             permiso_existente = 'N' or 'S'  # not used now
         else:
@@ -1871,22 +2955,26 @@ class Invoice(metaclass=PoolMeta):
         # 'caea' and 'fecha_hs_gen', not implemented
         caea = fecha_hs_gen = None
 
+        opcionales, cmps_asoc, ivas, tributos, items, permisos = (
+            [], [], [], [], [], [])
+        periodo_asoc = None
+
         # create the invoice internally in the helper
         if service == 'wsfe':
-            ws.CrearFactura(concepto, tipo_doc, nro_doc, tipo_cbte, punto_vta,
+            header = (concepto, tipo_doc, nro_doc, tipo_cbte, punto_vta,
                 cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
                 imp_iva, imp_trib, imp_op_ex, fecha_cbte, fecha_venc_pago,
                 fecha_serv_desde, fecha_serv_hasta,
                 moneda_id, moneda_ctz, caea, fecha_hs_gen,
                 cancela_misma_moneda_ext, condicion_iva_receptor_id)
         elif service == 'wsmtxca':
-            ws.CrearFactura(concepto, tipo_doc, nro_doc, tipo_cbte, punto_vta,
+            header = (concepto, tipo_doc, nro_doc, tipo_cbte, punto_vta,
                 cbt_desde, cbt_hasta, imp_total, imp_tot_conc, imp_neto,
                 imp_subtotal, imp_trib, imp_op_ex, fecha_cbte,
                 fecha_venc_pago, fecha_serv_desde, fecha_serv_hasta,
                 moneda_id, moneda_ctz, obs_generales)
         elif service == 'wsfex':
-            ws.CrearFactura(tipo_cbte, punto_vta, cbte_nro, fecha_cbte,
+            header = (tipo_cbte, punto_vta, cbte_nro, fecha_cbte,
                 imp_total, tipo_expo, permiso_existente, pais_dst_cmp,
                 nombre_cliente, cuit_pais_cliente, domicilio_cliente,
                 id_impositivo, moneda_id, moneda_ctz, obs_comerciales,
@@ -1898,66 +2986,53 @@ class Invoice(metaclass=PoolMeta):
             if (self.invoice_type.invoice_type in ('201', '202', '203',
                     '206', '207', '208', '211', '212', '213')):
                 if self.invoice_type.invoice_type in ('201', '206', '211'):
-                    self.pyafipws_cbu = (self.pyafipws_cbu or
-                        self.get_pyafipws_cbu())
-                    if not self.pyafipws_cbu:
-                        raise UserError(gettext(
-                            'account_invoice_ar.msg_fce_10168_cbu_emisor'))
-                    ws.AgregarOpcional(2101,
-                        self.pyafipws_cbu.get_cbu_number())  # CBU
-                    ws.AgregarOpcional(27, self.pyafipws_transfer_mode)
+                    # the default CBU is stored when the number is reserved
+                    cbu = (self.pyafipws_cbu
+                        or BankAccount(self.get_pyafipws_cbu()))
+                    opcionales.append((2101, cbu.get_cbu_number()))  # CBU
+                    opcionales.append((27, self.pyafipws_transfer_mode))
                     # ws.AgregarOpcional(2102, "tryton")  # alias del cbu
                 if self.invoice_type.invoice_type in ('202', '203', '207',
                         '208', '212', '213'):
                     if self.pyafipws_anulacion:
-                        ws.AgregarOpcional(22, 'S')
+                        opcionales.append((22, 'S'))
                     else:
-                        ws.AgregarOpcional(22, 'N')
+                        opcionales.append((22, 'N'))
             if (self.invoice_type.invoice_type in ('2', '3', '7', '8', '12',
                     '13', '202', '203', '207', '208', '212', '213')):
-                if (not self.pyafipws_cmp_asoc and not
-                        (self.pyafipws_cmp_asoc_desde and
-                        self.pyafipws_cmp_asoc_hasta)):
-                    raise UserError(gettext(
-                        'account_invoice_ar.msg_missing_cmp_asoc'))
                 if (self.pyafipws_cmp_asoc_desde and
                         self.pyafipws_cmp_asoc_hasta):
                     cmp_asoc_desde = self.pyafipws_cmp_asoc_desde.strftime(
                         '%Y%m%d')
                     cmp_asoc_hasta = self.pyafipws_cmp_asoc_hasta.strftime(
                         '%Y%m%d')
-                    ws.AgregarPeriodoComprobantesAsociados(cmp_asoc_desde,
-                        cmp_asoc_hasta)
+                    periodo_asoc = (cmp_asoc_desde, cmp_asoc_hasta)
                 else:
                     for cmp in self.pyafipws_cmp_asoc:
                         cmp_tipo = int(cmp.invoice_type.invoice_type)
                         if cmp_tipo not in INVOICE_ASOC_AFIP_CODE[
                                 self.invoice_type.invoice_type]:
+                            if batch:
+                                logger.error('invalid_cmp_asoc: Invoice: %s'
+                                    % self.id)
+                                return AfipPayload(error=True)
                             raise UserError(gettext(
                                 'account_invoice_ar.msg_invalid_cmp_asoc'))
                         cmp_nro = int(cmp.number[-8:])
                         cmp_fecha_cbte = cmp.invoice_date.strftime('%Y-%m-%d')
                         if service != 'wsmtxca':
                             cmp_fecha_cbte = cmp_fecha_cbte.replace('-', '')
-                        ws.AgregarCmpAsoc(cmp_tipo, punto_vta, cmp_nro,
+                        cmps_asoc.append((cmp_tipo, punto_vta, cmp_nro,
                             self.company.party.tax_identifier.code,
-                            cmp_fecha_cbte)
+                            cmp_fecha_cbte))
 
             for tax_line in self.taxes:
                 tax = tax_line.tax
-                if not tax.group:
-                    if batch:
-                        logger.error('tax_without_group: Invoice: %s, tax: %s'
-                            % (self.id, tax.name))
-                        return (ws, True)
-                    raise UserError(gettext(
-                        'account_invoice_ar.msg_tax_without_group',
-                        tax=tax.name))
                 if tax.group.afip_kind == 'gravado':
                     iva_id = tax.iva_code
                     base_imp = ('%.2f' % abs(tax_line.base))
                     importe = ('%.2f' % abs(tax_line.amount))
-                    ws.AgregarIva(iva_id, base_imp, importe)
+                    ivas.append((iva_id, base_imp, importe))
                 elif tax.group.afip_kind not in ('no_gravado', 'exento'):
                     tributo_id = tax.group.tribute_id
                     desc = tax.name
@@ -1966,8 +3041,8 @@ class Invoice(metaclass=PoolMeta):
                     alic = '%.2f' % (abs(tax_line.amount) /
                         abs(tax_line.base) * 100)
                     # add the other tax detail in the helper
-                    ws.AgregarTributo(tributo_id, desc, base_imp, alic,
-                        importe)
+                    tributos.append((tributo_id, desc, base_imp, alic,
+                        importe))
 
         # analize line items - invoice detail
         # umeds
@@ -1996,21 +3071,21 @@ class Invoice(metaclass=PoolMeta):
                     #            precio, bonif, iva_id, imp_iva,
                     #            importe+imp_iva)
                     if service == 'wsfex':
-                        ws.AgregarItem(codigo, ds, qty, umed, precio,
-                            importe_total, bonif)
+                        items.append((codigo, ds, qty, umed, precio,
+                            importe_total, bonif))
 
             if service == 'wsfex':
                 for export_license in self.pyafipws_licenses:
-                    ws.AgregarPermiso(
+                    permisos.append((
                         export_license.license_id,
-                        export_license.afip_country.code)
+                        export_license.afip_country.code))
                 if int(tipo_cbte) in (20, 21):
                     for cbteasoc in self.pyafipws_cmp_asoc:
                         cbteasoc_tipo = int(cbteasoc.invoice_type.invoice_type)
                         cbteasoc_nro = int(cbteasoc.number[-8:])
-                        ws.AgregarCmpAsoc(cbteasoc_tipo, punto_vta,
+                        cmps_asoc.append((cbteasoc_tipo, punto_vta,
                             cbteasoc_nro,
-                            self.company.party.tax_identifier.code)
+                            self.company.party.tax_identifier.code))
                 if not self.lines:
                     codigo = 0
                     ds = '-'
@@ -2019,9 +3094,23 @@ class Invoice(metaclass=PoolMeta):
                     precio = Decimal('0')
                     importe_total = Decimal('0')
                     bonif = None
-                    ws.AgregarItem(codigo, ds, qty, umed, precio,
-                        importe_total, bonif)
-        return (ws, False)
+                    items.append((codigo, ds, qty, umed, precio,
+                        importe_total, bonif))
+        return AfipPayload(service=service, tipo_cbte=tipo_cbte,
+            punto_vta=punto_vta, cbte_nro=cbte_nro, header=header,
+            opcionales=tuple(opcionales), periodo_asoc=periodo_asoc,
+            cmps_asoc=tuple(cmps_asoc), ivas=tuple(ivas),
+            tributos=tuple(tributos), items=tuple(items),
+            permisos=tuple(permisos), totals={
+                'pyafipws_cae_imp_total': Decimal(imp_total),
+                'pyafipws_cae_imp_neto': imp_neto,
+                'pyafipws_cae_imp_tot_conc': imp_tot_conc,
+                'pyafipws_cae_imp_op_ex': imp_op_ex,
+                'pyafipws_cae_imp_iva': imp_iva,
+                'pyafipws_cae_imp_trib': imp_trib,
+                'pyafipws_cae_moneda_id': moneda_id,
+                'pyafipws_cae_moneda_ctz': Decimal(moneda_ctz),
+                })
 
     def request_cae(self, ws):
         '''
@@ -2054,6 +3143,14 @@ class Invoice(metaclass=PoolMeta):
         '''
         store afip XmlRequest/XmlResponse.
         '''
+        afip_tr = self.get_afip_tr(ws, msg=msg)
+        afip_tr.save()
+        return afip_tr
+
+    def get_afip_tr(self, ws, msg=''):
+        '''
+        Return the afip transaction of the last request of ws, not saved.
+        '''
         AFIP_Transaction = Pool().get('account_invoice_ar.afip_transaction')
         message = '\n'.join([ws.Obs or '', ws.ErrMsg or '', msg])
         message = message.encode('ascii', 'ignore').strip()
@@ -2067,38 +3164,23 @@ class Invoice(metaclass=PoolMeta):
         afip_tr.invoice = self
         afip_tr.pyafipws_result = ws.Resultado
         afip_tr.pyafipws_message = message.decode('utf-8')
-        afip_tr.pyafipws_xml_request = xml_request
-        afip_tr.pyafipws_xml_response = xml_response
-        afip_tr.save()
+        afip_tr.pyafipws_xml_request_data = compress_xml(xml_request)
+        afip_tr.pyafipws_xml_response_data = compress_xml(xml_response)
         return afip_tr
 
-    def process_afip_result(self, ws, msg=''):
+    def process_afip_result(self, ws, msg='', payload=None):
         '''
         Process CAE and store results
+
+        ws can be the copy of the result made by snapshot_ws.
         '''
+        LastAuthorized = Pool().get('account.pos.last_authorized')
         afip_tr = self.save_afip_tr(ws, msg)
         if ws.CAE:
-            tipo_cbte = self.invoice_type.invoice_type
-            punto_vta = self.pos.number
-
-            vto = ''
-            if isinstance(ws, WSFEv1):
-                vto = ws.Vencimiento
-            elif isinstance(ws, WSFEXv1):
-                vto = ws.FchVencCAE
-            cae_due = ''.join([c for c in str(vto)
-                    if c.isdigit()])
-            bars = ''.join([str(ws.Cuit), '%03d' % int(tipo_cbte),
-                    '%05d' % int(punto_vta), str(ws.CAE), cae_due])
-            bars = bars + self.pyafipws_verification_digit_modulo10(bars)
-            pyafipws_cae_due_date = vto or None
-            if '-' not in vto:
-                pyafipws_cae_due_date = '-'.join([vto[:4], vto[4:6], vto[6:8]])
-            self.pyafipws_cae = ws.CAE
-            self.pyafipws_barcode = bars
-            self.pyafipws_cae_due_date = datetime.strptime(
-                pyafipws_cae_due_date, "%Y-%m-%d").date()
-
+            LastAuthorized.advance(self.pos, self.invoice_type.invoice_type,
+                self.pos.pyafipws_electronic_invoice_service,
+                int(self.number[-8:]))
+            self.set_pyafipws_cae(ws, payload)
             return 'A'
 
         if afip_tr.pyafipws_message.find('502:') != -1:
@@ -2106,6 +3188,35 @@ class Invoice(metaclass=PoolMeta):
 
         return False
 
+    def set_pyafipws_cae(self, ws, payload=None):
+        '''
+        Set the CAE, its due date and the barcode from the result of ws.
+
+        The totals of the payload sent are stored with the CAE.
+        '''
+        tipo_cbte = self.invoice_type.invoice_type
+        punto_vta = self.pos.number
+        service = self.pos.pyafipws_electronic_invoice_service
+        if service == 'wsfex':
+            vto = ws.FchVencCAE or ''
+        else:
+            vto = ws.Vencimiento or ''
+        cae_due = ''.join([c for c in str(vto)
+                if c.isdigit()])
+        bars = ''.join([str(ws.Cuit), '%03d' % int(tipo_cbte),
+                '%05d' % int(punto_vta), str(ws.CAE), cae_due])
+        bars = bars + self.pyafipws_verification_digit_modulo10(bars)
+        pyafipws_cae_due_date = vto or None
+        if '-' not in vto:
+            pyafipws_cae_due_date = '-'.join([vto[:4], vto[4:6], vto[6:8]])
+        self.pyafipws_cae = ws.CAE
+        self.pyafipws_barcode = bars
+        self.pyafipws_cae_due_date = datetime.strptime(
+            pyafipws_cae_due_date, "%Y-%m-%d").date()
+        if payload and payload.totals:
+            for name, value in payload.totals.items():
+                setattr(self, name, value)
+
     def pyafipws_verification_digit_modulo10(self, codigo):
         'Calculate the verification digit "modulo 10"'
         # http://www.consejo.org.ar/Bib_elect/diciembre04_CT/documentos/
@@ -2130,24 +3241,32 @@ class Invoice(metaclass=PoolMeta):
     def reset_sequence_from_ws(self, ws):
         '''
         Set next sequence number to be the last cbte_nro_afip + 1.
+
+        The numbers reserved by other requests still waiting for their CAE
+        are not given again.
         '''
+        pool = Pool()
+        LastAuthorized = pool.get('account.pos.last_authorized')
+        cursor = Transaction().connection.cursor()
+        table = self.__table__()
         sequence = self.invoice_type.invoice_sequence
         tipo_cbte = self.invoice_type.invoice_type
-        punto_vta = self.pos.number
         service = self.pos.pyafipws_electronic_invoice_service
 
-        if service == 'wsfe':
-            cbte_nro_afip = ws.CompUltimoAutorizado(tipo_cbte, punto_vta)
-        elif service == 'wsmtxca':
-            cbte_nro_afip = ws.ConsultarUltimoComprobanteAutorizado(
-                tipo_cbte, punto_vta)
-        elif service == 'wsfex':
-            cbte_nro_afip = ws.GetLastCMP(tipo_cbte, punto_vta)
-        else:
-            cbte_nro_afip = None
+        cbte_nro_afip = LastAuthorized.sync(ws, self.pos, tipo_cbte, service)
+        if cbte_nro_afip is None:
+            return
 
-        if cbte_nro_afip is not None:
-            sequence.update_sql_sequence(int(cbte_nro_afip) + 1)
+        self.lock_ws_sequence(self)
+        cursor.execute(*table.select(table.number,
+                where=(table.invoice_type == self.invoice_type.id)
+                & (table.id != self.id)
+                & (table.number != Null)
+                & ((table.pyafipws_cae == Null) | (table.pyafipws_cae == ''))
+                & (table.state != 'cancelled')))
+        pending = [int(n[-8:]) for n, in cursor if n[-8:].isdigit()]
+        sequence.update_sql_sequence(
+            max([int(cbte_nro_afip)] + pending) + 1)
 
 
 class InvoiceExportLicense(ModelSQL, ModelView):
@@ -2266,10 +3385,8 @@ class InvoiceReport(metaclass=PoolMeta):
         logger.debug('get_line_taxes: %s' % repr(taxes))
         res = []
         invoice_type_string = ''
-        if len(taxes) > 0 and hasattr(taxes[0].invoice.invoice_type,
-                'invoice_type'):
-            invoice_type_string = \
-                taxes[0].invoice.invoice_type.invoice_type_string[-1]
+        if len(taxes) > 0:
+            invoice_type_string = taxes[0].invoice.invoice_type_class or ''
 
         if invoice_type_string != 'A':
             for tax in taxes:
@@ -2282,10 +3399,8 @@ class InvoiceReport(metaclass=PoolMeta):
         logger.debug('get_taxes: %s' % repr(taxes))
         res = []
         invoice_type_string = ''
-        if len(taxes) > 0 and hasattr(taxes[0].invoice.invoice_type,
-                'invoice_type'):
-            invoice_type_string = \
-                taxes[0].invoice.invoice_type.invoice_type_string[-1]
+        if len(taxes) > 0:
+            invoice_type_string = taxes[0].invoice.invoice_type_class or ''
 
         if invoice_type_string == 'A':
             for tax in taxes:
@@ -2317,11 +3432,7 @@ class InvoiceReport(metaclass=PoolMeta):
 
     @classmethod
     def discrimina_impuestos(cls, invoice):
-        invoice_type_string = ''
-        if invoice.invoice_type:
-            invoice_type_string = invoice.invoice_type.invoice_type_string[-1]
-
-        if invoice_type_string == 'A':
+        if invoice.invoice_type_class == 'A':
             return True
         return False
 
@@ -2360,10 +3471,7 @@ class InvoiceReport(metaclass=PoolMeta):
 
     @classmethod
     def _get_tipo_comprobante(cls, Invoice, invoice):
-        if invoice.invoice_type:
-            return invoice.invoice_type.invoice_type_string[-1]
-        else:
-            return ''
+        return invoice.invoice_type_class or ''
 
     @classmethod
     def _get_nombre_comprobante(cls, Invoice, invoice):
@@ -2440,8 +3548,12 @@ class InvoiceReport(metaclass=PoolMeta):
             pto_vta = invoice.pos.number
             tipo_cmp = int(cls._get_codigo_comprobante(Invoice, invoice))
             nro_cmp = int(invoice.number[6:])
-            importe = float(invoice.total_amount)
-            moneda = invoice.currency.afip_code
+            if invoice.pyafipws_cae_imp_total is not None:
+                importe = float(invoice.pyafipws_cae_imp_total)
+                moneda = invoice.pyafipws_cae_moneda_id
+            else:
+                importe = float(invoice.total_amount)
+                moneda = invoice.currency.afip_code
             ctz = cls._get_ctz(invoice)
             tipo_doc, nro_doc = cls._obtiene_tipo_nro_doc(invoice)
             tipo_doc_rec = tipo_doc
@@ -2463,6 +3575,8 @@ class InvoiceReport(metaclass=PoolMeta):
 
     @classmethod
     def _get_ctz(cls, invoice):
+        if invoice.pyafipws_cae_moneda_ctz is not None:
+            return "{:.{}f}".format(invoice.pyafipws_cae_moneda_ctz, 6)
         # currency and rate
         moneda_id = invoice.currency.afip_code
         if not moneda_id:
@@ -2645,6 +3759,7 @@ class RecoverInvoice(Wizard):
         # get the electronic invoice type, point of sale and service:
         pool = Pool()
         Company = pool.get('company.company')
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
         if Transaction().context.get('company'):
             company = Company(Transaction().context['company'])
         else:
@@ -2656,30 +3771,21 @@ class RecoverInvoice(Wizard):
         if service == 'wsfe':
             from pyafipws.wsfev1 import WSFEv1  # local market
             ws = WSFEv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL')
         elif service == 'wsfex':
             from pyafipws.wsfexv1 import WSFEXv1  # foreign trade
             ws = WSFEXv1()
-            if company.pyafipws_mode_cert == 'homologacion':
-                WSDL = 'https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL'
-            elif company.pyafipws_mode_cert == 'produccion':
-                WSDL = (
-                    'https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL')
         else:
             message = 'WS no soportado: ' + repr(service)
             self.data.message = message
             return 'data'
+        WSDL = get_wsdl(service, company.pyafipws_mode_cert)
 
         ws.LanzarExcepciones = True
         cache = company.get_cache_dir()
 
         # authenticate against AFIP:
         try:
-            ta = company.pyafipws_authenticate(service=service, cache=cache)
+            ta = Ticket.get_ticket(company, service)
         except Exception as e:
             message = 'Service no soportado:' + repr(e)
             self.data.message = message
@@ -2688,7 +3794,7 @@ class RecoverInvoice(Wizard):
         # set AFIP webservice credentials:
         ws.SetTicketAcceso(ta)
         ws.Cuit = company.party.vat_number
-        ws.Conectar(wsdl=WSDL, cache=cache, cacert=True)
+        connect(ws, WSDL, cache)
 
         if self.start.cbte_nro is None:
             if service == 'wsfe' or service == 'wsmtxca':
@@ -2,7 +2,13 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
-from trytond.model import ModelView, ModelSQL, fields, Index
+from datetime import datetime, timedelta
+
+from sql import Literal
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields, Index, Unique
 from trytond.pool import Pool
 from trytond.pyson import Eval, Id
 from trytond.transaction import Transaction
@@ -36,6 +42,13 @@ INVOICE_TYPE_POS = [
     ('212', '212-Nota de Débito Electrónica MiPyMEs C'),
     ('213', '213-Nota de Crédito Electrónica MiPyMEs C'),
     ]
+# AFIP code of the invoice type: class letter (A, B, C or E)
+INVOICE_TYPE_CLASS = {c: n[-1] for c, n in INVOICE_TYPE_POS if c}
+
+# The last authorized number is asked again to AFIP after this delay
+LAST_NUMBER_STALENESS = timedelta(
+    seconds=config.getint('account_invoice_ar', 'last_number_staleness',
+        default=10 * 60))
 
 
 class Pos(ModelSQL, ModelView):
@@ -72,6 +85,12 @@ class Pos(ModelSQL, ModelView):
             'readonly': ~Eval('active', True),
             },
         help='Habilita la facturación electrónica por webservices AFIP')
+    pyafipws_async = fields.Boolean('Post in Background',
+        states={
+            'invisible': Eval('pos_type') != 'electronic',
+            'readonly': ~Eval('active', True),
+            },
+        help='Solicita el CAE a AFIP desde la cola de tareas')
     active = fields.Boolean('Active')
 
     del _states
@@ -80,9 +99,16 @@ class Pos(ModelSQL, ModelView):
     def __setup__(cls):
         super().__setup__()
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.active, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.number, Index.Equality())),
+                Index(
+                    t,
+                    (t.pos_type, Index.Equality()),
+                    where=t.active == Literal(True)),
+                })
 
     @classmethod
     def __register__(cls, module_name):
@@ -142,13 +168,19 @@ class PosSequence(ModelSQL, ModelView):
             ('company', '=', Eval('context', {}).get('company', -1)),
             ])
 
+    _sequences_cache = Cache(
+        'account.pos.sequence.get_sequences', context=False)
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.invoice_type, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.pos, Index.Equality()),
+                    (t.invoice_type, Index.Equality())),
+                })
 
     @classmethod
     def __register__(cls, module_name):
@@ -178,3 +210,118 @@ class PosSequence(ModelSQL, ModelView):
         if not self.invoice_type_string:
             return ''
         return self.invoice_type_string.split('-')[1]
+
+    @classmethod
+    def get_sequences(cls, pos, invoice_type):
+        '''
+        Return the sequences of the point of sale for the AFIP invoice type.
+
+        The result is cached until a sequence is created, modified or
+        deleted.
+        '''
+        key = (int(pos), invoice_type)
+        ids = cls._sequences_cache.get(key)
+        if ids is None:
+            ids = [s.id for s in cls.search([
+                        ('pos', '=', int(pos)),
+                        ('invoice_type', '=', invoice_type),
+                        ])]
+            cls._sequences_cache.set(key, ids)
+        return cls.browse(ids)
+
+    @classmethod
+    def create(cls, vlist):
+        sequences = super().create(vlist)
+        cls._sequences_cache.clear()
+        return sequences
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._sequences_cache.clear()
+
+    @classmethod
+    def delete(cls, sequences):
+        super().delete(sequences)
+        cls._sequences_cache.clear()
+
+
+class PosLastAuthorized(ModelSQL):
+    'Point of Sale Last Authorized Number'
+    __name__ = 'account.pos.last_authorized'
+
+    pos = fields.Many2One('account.pos', 'Point of Sale',
+        ondelete='CASCADE', required=True)
+    invoice_type = fields.Char('Tipo Comprobante AFIP', required=True)
+    service = fields.Char('Service', required=True)
+    number = fields.Integer('Number')
+    synced = fields.DateTime('Synced',
+        help='Last time the number was read from AFIP')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('pos_invoice_type_service_unique',
+                Unique(t, t.pos, t.invoice_type, t.service),
+                'account_invoice_ar.msg_pos_last_authorized_unique'),
+            ]
+
+    @classmethod
+    def _get(cls, pos, invoice_type, service):
+        with Transaction().set_context(_check_access=False):
+            records = cls.search([
+                    ('pos', '=', pos.id),
+                    ('invoice_type', '=', invoice_type),
+                    ('service', '=', service),
+                    ], limit=1)
+        if records:
+            return records[0]
+
+    @classmethod
+    def get_last_number(cls, ws, pos, invoice_type, service, expected=None):
+        '''
+        Return the last number authorized by AFIP.
+
+        The stored number is used unless it is stale or it differs from
+        expected, in which case it is read again from AFIP.
+        '''
+        record = cls._get(pos, invoice_type, service)
+        if (record and record.number is not None and record.synced
+                and record.synced + LAST_NUMBER_STALENESS > datetime.utcnow()
+                and (expected is None or record.number == expected)):
+            return record.number
+        return cls.sync(ws, pos, invoice_type, service)
+
+    @classmethod
+    def sync(cls, ws, pos, invoice_type, service):
+        "Read and store the last number authorized by AFIP"
+        if service == 'wsfe':
+            number = ws.CompUltimoAutorizado(invoice_type, pos.number)
+        elif service == 'wsmtxca':
+            number = ws.ConsultarUltimoComprobanteAutorizado(
+                invoice_type, pos.number)
+        elif service == 'wsfex':
+            number = ws.GetLastCMP(invoice_type, pos.number)
+        else:
+            return None
+        number = int(number or 0)
+        # the numbers are stored for any user posting invoices
+        with Transaction().set_context(_check_access=False):
+            record = cls._get(pos, invoice_type, service)
+            if not record:
+                record = cls(
+                    pos=pos, invoice_type=invoice_type, service=service)
+            record.number = number
+            record.synced = datetime.utcnow()
+            record.save()
+        return number
+
+    @classmethod
+    def advance(cls, pos, invoice_type, service, number):
+        "Store number as authorized by AFIP"
+        record = cls._get(pos, invoice_type, service)
+        if record and (record.number is None or number > record.number):
+            record.number = number
+            record.save()
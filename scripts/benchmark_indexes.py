@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from datetime import date
+
+from sql import Literal, Null
+from sql.aggregate import Max, Sum
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+try:
+    from trytond import backend
+    from trytond.config import config
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("trytond must be installed to use %s" % prog)
+
+INVOICE_TYPES = ['1', '3', '6', '8', '11', '13', '19', '201', '206', '211']
+INVOICE_CLASSES = ['A', 'A', 'B', 'B', 'C', 'C', 'E', 'A', 'B', 'C']
+# Created by Invoice.__register__ outside of _sql_indexes
+REF_RANGE_INDEX = 'account_invoice_ref_range_gist'
+USED_INDEX = re.compile(r'Index (?:Only )?Scan (?:Backward )?(?:using|on) '
+    r'"?([^\s"]+)"?')
+
+
+def copy_rows(cursor, table, template, size, overrides):
+    "Insert size copies of the template row of table"
+    cursor.execute('SELECT column_name FROM information_schema.columns '
+        'WHERE table_name = %s AND column_name != %s', (table, 'id'))
+    columns = [c for c, in cursor]
+    values = [overrides.get(c, 't."%s"' % c) for c in columns]
+    cursor.execute(
+        'INSERT INTO "%s" (%s) SELECT %s FROM "%s" AS t, '
+        'generate_series(1, %%s) AS g(i) WHERE t.id = %%s' % (
+            table, ', '.join('"%s"' % c for c in columns),
+            ', '.join(values), table),
+        (size, template))
+
+
+def seed(cursor, size):
+    "Fill the database with size invoices copied from existing records"
+    print("Seed %s invoices" % size, file=sys.stderr)
+    cursor.execute('SELECT MIN(id) FROM account_pos')
+    pos, = cursor.fetchone()
+    cursor.execute('SELECT MIN(id) FROM account_pos_sequence')
+    sequence, = cursor.fetchone()
+    cursor.execute('SELECT MIN(id) FROM account_invoice')
+    invoice, = cursor.fetchone()
+    if pos is None or sequence is None or invoice is None:
+        sys.exit("the database must have at least a POS, a POS sequence "
+            "and an invoice")
+
+    def array(values):
+        return "ARRAY[%s]" % ', '.join("'%s'" % v for v in values)
+
+    count = max(size // 100, 1)
+    copy_rows(cursor, 'account_pos', pos, count, {
+            'number': '10000 + i',
+            'pos_type': (
+                "CASE WHEN MOD(i, 50) = 0 THEN 'fiscal_printer' "
+                "ELSE 'electronic' END"),
+            'active': 'MOD(i, 10) != 0',
+            })
+    cursor.execute('SELECT ARRAY_AGG(id) FROM account_pos')
+    poss, = cursor.fetchone()
+
+    copy_rows(cursor, 'account_pos_sequence', sequence, count, {
+            'pos': '(ARRAY[%s])[1 + MOD(i, %s)]' % (
+                ', '.join(map(str, poss)), len(poss)),
+            'invoice_type': '(%s)[1 + MOD(i, %s)]' % (
+                array(INVOICE_TYPES), len(INVOICE_TYPES)),
+            'invoice_sequence': 'NULL',
+            })
+    cursor.execute('SELECT ARRAY_AGG(id ORDER BY id), '
+        'ARRAY_AGG(pos ORDER BY id) FROM account_pos_sequence')
+    sequences, sequence_poss = cursor.fetchone()
+
+    def by_sequence(values):
+        return '(ARRAY[%s])[1 + MOD(i, %s)]' % (
+            ', '.join(map(str, values)), len(values))
+    copy_rows(cursor, 'account_invoice', invoice, size, {
+            'type': "CASE WHEN MOD(i, 2) = 0 THEN 'in' ELSE 'out' END",
+            'state': "(ARRAY['draft', 'validated', 'posted', 'paid', "
+            "'cancelled'])[1 + MOD(i, 5)]",
+            'pos': by_sequence(sequence_poss),
+            'invoice_type': by_sequence(sequences),
+            'invoice_type_code': '(%s)[1 + MOD(i, %s)]' % (
+                array(INVOICE_TYPES), len(INVOICE_TYPES)),
+            'invoice_type_class': '(%s)[1 + MOD(i, %s)]' % (
+                array(INVOICE_CLASSES), len(INVOICE_CLASSES)),
+            'number': 'NULL',
+            'move': 'NULL',
+            'reference': "'BENCH-' || i",
+            'invoice_date': 'CURRENT_DATE - MOD(i, 730)',
+            'ref_pos_number': 'MOD(i, 100)',
+            'ref_voucher_number': 'i',
+            'ref_number_from': "CASE WHEN MOD(i, 2) = 1 THEN i * 10 END",
+            'ref_number_to': "CASE WHEN MOD(i, 2) = 1 THEN i * 10 + 9 END",
+            'ref_range_from': "CASE WHEN MOD(i, 2) = 1 THEN i * 10 END",
+            'ref_range_to': "CASE WHEN MOD(i, 2) = 1 THEN i * 10 + 9 END",
+            'pyafipws_cae_status': (
+                "CASE WHEN MOD(i, 1000) = 0 THEN 'pending' END"),
+            'pyafipws_cae_imp_total': "CASE WHEN MOD(i, 2) = 1 THEN i END",
+            })
+    cursor.execute('INSERT INTO account_invoice_ar_afip_transaction '
+        '(invoice, pyafipws_result, create_uid, create_date) '
+        "SELECT id, 'A', 0, NOW() FROM account_invoice "
+        "WHERE reference LIKE 'BENCH-%'")
+    for table in ['account_pos', 'account_pos_sequence', 'account_invoice',
+            'account_invoice_ar_afip_transaction']:
+        cursor.execute('ANALYZE "%s"' % table)
+    return sequences
+
+
+def index_names(Model, *columns):
+    "Return the names of the indexes of Model on columns"
+    table_h = Model.__table_handler__()
+    names = set()
+    for index in Model._sql_indexes:
+        if [getattr(e, 'name', None)
+                for e, _ in index.expressions] != list(columns):
+            continue
+        translator = table_h.index_translator_for(index)
+        if translator:
+            name, _, _ = translator.definition(index)
+            name = '_'.join([table_h.table_name, name])
+            names.add(
+                'idx_' + table_h.convert_name(name, reserved=len('idx_')))
+    assert names, "no index on %s%s" % (Model.__name__, columns)
+    return names
+
+
+def get_queries(sequences):
+    """
+    Return the hot searches of the module by name with the names of the
+    indexes expected to serve them
+    """
+    pool = Pool()
+    Pos = pool.get('account.pos')
+    Invoice = pool.get('account.invoice')
+    PosSequence = pool.get('account.pos.sequence')
+    AFIP_Transaction = pool.get('account_invoice_ar.afip_transaction')
+    pos_table = Pos.__table__()
+    invoice = Invoice.__table__()
+    other = Invoice.__table__()
+    sequence = PosSequence.__table__()
+    afip_transaction = AFIP_Transaction.__table__()
+    cursor = Transaction().connection.cursor()
+
+    cursor.execute(*invoice.select(invoice.company, invoice.party,
+            invoice.pos, where=invoice.reference == 'BENCH-42'))
+    company, party, pos = cursor.fetchone()
+    references = ['BENCH-%s' % i for i in range(2, 2002, 2)]
+    today = date.today()
+    month = (today.replace(day=1), today)
+    return {
+        'POS by company and number': (
+            pos_table.select(pos_table.id,
+                where=(pos_table.company == company)
+                & (pos_table.number == 10042)),
+            index_names(Pos, 'company', 'number')),
+        'active fiscal printers': (
+            pos_table.select(pos_table.id,
+                where=(pos_table.pos_type == 'fiscal_printer')
+                & (pos_table.active == Literal(True))),
+            index_names(Pos, 'pos_type')),
+        'POS sequence by POS and type': (
+            sequence.select(sequence.id,
+                where=(sequence.pos == pos) & (sequence.invoice_type == '6')),
+            index_names(PosSequence, 'pos', 'invoice_type')),
+        'invoices by POS, type and state': (
+            invoice.select(invoice.id,
+                where=(invoice.type == 'out') & (invoice.pos == pos)
+                & (invoice.invoice_type == sequences[0])
+                & (invoice.state == 'posted')),
+            index_names(Invoice, 'pos', 'invoice_type', 'type', 'state')),
+        'similar invoices': (
+            invoice.select(invoice.id,
+                where=(invoice.company == company) & (invoice.type == 'in')
+                & (invoice.party == party)
+                & (invoice.reference == 'BENCH-42')
+                & (invoice.state != 'cancelled')),
+            index_names(Invoice, 'reference')),
+        'duplicated supplier references': (
+            invoice.select(invoice.id,
+                where=invoice.reference.in_(references)
+                & invoice.party.in_([party]) & (invoice.type == 'in')
+                & (invoice.state != 'cancelled')),
+            index_names(Invoice, 'reference')),
+        'supplier vouchers by POS and number': (
+            invoice.select(invoice.id,
+                where=(invoice.type == 'in') & (invoice.ref_pos_number == 42)
+                & (invoice.ref_voucher_number >= 1000)
+                & (invoice.ref_voucher_number <= 5000)),
+            index_names(Invoice, 'ref_pos_number', 'ref_voucher_number')),
+        'invoices with pending CAE': (
+            invoice.select(invoice.id,
+                where=invoice.pyafipws_cae_status == 'pending'),
+            index_names(Invoice, 'pyafipws_cae_status')),
+        'monthly AFIP totals': (
+            invoice.select(Sum(invoice.pyafipws_cae_imp_total),
+                where=(invoice.company == company)
+                & (invoice.invoice_date >= month[0])
+                & (invoice.invoice_date <= month[1])
+                & (invoice.pyafipws_cae_imp_total != Null)),
+            index_names(Invoice, 'company', 'invoice_date')),
+        'customer invoices by type code': (
+            invoice.select(invoice.id,
+                where=(invoice.type == 'out') & (invoice.company == company)
+                & (invoice.invoice_type_code == '6')
+                & (invoice.invoice_date >= month[0])
+                & (invoice.invoice_date <= month[1])),
+            index_names(
+                Invoice, 'company', 'invoice_type_code', 'invoice_date')),
+        'customer invoices by type class': (
+            invoice.select(invoice.id,
+                where=(invoice.type == 'out') & (invoice.company == company)
+                & (invoice.invoice_type_class == 'B')
+                & (invoice.invoice_date >= month[0])
+                & (invoice.invoice_date <= month[1])),
+            index_names(
+                Invoice, 'company', 'invoice_type_class', 'invoice_date')),
+        'last AFIP transaction': (
+            afip_transaction.join(invoice,
+                condition=afip_transaction.invoice == invoice.id
+                ).select(afip_transaction.invoice, Max(afip_transaction.id),
+                where=invoice.reference.in_(references[:100]),
+                group_by=afip_transaction.invoice),
+            index_names(AFIP_Transaction, 'invoice', 'id')),
+        'overlapping daily reports': (
+            invoice.join(other,
+                condition=(other.pos == invoice.pos)
+                & (other.invoice_type == invoice.invoice_type)
+                & (other.type == invoice.type)
+                & (other.id != invoice.id)
+                ).select(invoice.id,
+                where=(invoice.reference == 'BENCH-43')
+                & (other.state != 'cancelled')
+                & Invoice._ref_range_overlap(invoice, other),
+                limit=1),
+            {REF_RANGE_INDEX}),
+        }
+
+
+def benchmark(database, size=100000):
+    with Transaction().start(database, 0) as transaction:
+        if backend.name != 'postgresql':
+            sys.exit("the benchmark requires PostgreSQL")
+        cursor = transaction.connection.cursor()
+        failures = []
+        try:
+            sequences = seed(cursor, size)
+            for name, (query, expected) in get_queries(sequences).items():
+                query, params = tuple(query)
+                cursor.execute('EXPLAIN ANALYZE ' + query, params)
+                plan = [l for l, in cursor]
+                timing = [l for l in plan if l.startswith('Execution')]
+                used = [i for l in plan for i in USED_INDEX.findall(l)]
+                print(name, *timing, sep=': ')
+                print('    expected: %s' % ', '.join(sorted(expected)))
+                print('    picked: %s' % (', '.join(used) or 'no index'))
+                if not expected.intersection(used):
+                    failures.append(name)
+        finally:
+            transaction.rollback()
+    if failures:
+        sys.exit("expected index not picked for: %s" % ', '.join(failures))
+
+
+def run():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-c', '--config', dest='config_file',
+        help='the trytond config file')
+    parser.add_argument('-s', '--size', dest='size', type=int,
+        default=100000, help='the number of invoices to seed')
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+    config.update_etc(args.config_file)
+    Pool(args.database).init()
+    benchmark(args.database, args.size)
+
+
+if __name__ == '__main__':
+    run()
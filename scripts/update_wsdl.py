@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import sys
+from argparse import ArgumentParser
+from urllib.request import urlopen
+
+try:
+    import argcomplete
+except ImportError:
+    argcomplete = None
+
+try:
+    from trytond.modules.account_invoice_ar.afip import (
+        SERVICES, WSDL_DIR, get_wsdl_filename)
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("account_invoice_ar must be installed to use %s" % prog)
+
+
+def update_wsdl(services=None, directory=WSDL_DIR):
+    print("Update WSDL", file=sys.stderr)
+    os.makedirs(directory, exist_ok=True)
+    for service, (_, urls) in SERVICES.items():
+        if services and service not in services:
+            continue
+        for mode, url in urls.items():
+            filename = os.path.join(directory,
+                os.path.basename(get_wsdl_filename(service, mode)))
+            print(service, mode, file=sys.stderr)
+            with urlopen(url, timeout=60) as response:
+                content = response.read()
+            with open(filename + '.tmp', 'wb') as fd:
+                fd.write(content)
+            os.replace(filename + '.tmp', filename)
+
+
+def run():
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--service', dest='services',
+        action='append', choices=sorted(SERVICES),
+        help='the service to update (default: all)')
+    parser.add_argument('-o', '--output', dest='directory', default=WSDL_DIR,
+        help='the directory where the WSDL are written')
+    if argcomplete:
+        argcomplete.autocomplete(parser)
+
+    args = parser.parse_args()
+    update_wsdl(args.services, args.directory)
+
+
+if __name__ == '__main__':
+    run()
@@ -3,11 +3,15 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
+import ast
 import io
 import os
 import re
 from configparser import ConfigParser
+from urllib.request import urlopen
+
 from setuptools import find_packages, setup
+from setuptools.command.build_py import build_py
 
 MODULE = 'account_invoice_ar'
 PREFIX = 'trytonar'
@@ -27,6 +31,45 @@ def read(fname):
     return content
 
 
+def get_wsdl_urls():
+    "Return the URL of the WSDL of the AFIP services by filename"
+    # afip can not be imported without trytond
+    module = ast.parse(read('afip.py'))
+    for node in module.body:
+        if (isinstance(node, ast.Assign)
+                and [getattr(t, 'id', None) for t in node.targets]
+                == ['SERVICES']):
+            services = ast.literal_eval(node.value)
+            break
+    else:
+        return {}
+    return {'%s-%s.wsdl' % (version, mode): url
+        for version, urls in services.values()
+        for mode, url in urls.items()}
+
+
+class BuildPy(build_py):
+    "Build the module with the WSDL of the AFIP services"
+
+    def run(self):
+        super().run()
+        if self.dry_run:
+            return
+        directory = os.path.join(
+            self.build_lib, 'trytond', 'modules', MODULE, 'wsdl')
+        os.makedirs(directory, exist_ok=True)
+        for filename, url in get_wsdl_urls().items():
+            try:
+                with urlopen(url, timeout=60) as response:
+                    content = response.read()
+            except OSError as exception:
+                # the WSDL is downloaded on the first connection instead
+                self.warn('unable to download %s: %s' % (url, exception))
+                continue
+            with open(os.path.join(directory, filename), 'wb') as fd:
+                fd.write(content)
+
+
 def get_require_version(name):
     if name in LINKS:
         return ''  # '%s @ %s' % (name, LINKS[name])
@@ -129,10 +172,15 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'test': tests_require,
         },
     zip_safe=False,
+    cmdclass={
+        'build_py': BuildPy,
+        },
     entry_points="""
     [trytond.modules]
     %s = trytond.modules.%s
     [console_scripts]
     trytond_update_currencies_afip = trytond.modules.%s.scripts.update_currencies:run
-    """ % (MODULE, MODULE, MODULE),
+    trytond_update_wsdl_afip = trytond.modules.%s.scripts.update_wsdl:run
+    trytond_benchmark_indexes_afip = trytond.modules.%s.scripts.benchmark_indexes:run
+    """ % (MODULE, MODULE, MODULE, MODULE, MODULE),
     )
@@ -1,13 +1,1522 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest.mock import Mock, patch
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from sql import Null
+
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_invoice(company, type='out', **values):
+    "Return a draft invoice of type for a new party of company"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Address = pool.get('party.address')
+    Invoice = pool.get('account.invoice')
+    Party = pool.get('party.party')
+
+    kind = 'receivable' if type == 'out' else 'payable'
+    account, = Account.search([
+            ('company', '=', company.id),
+            ('type.%s' % kind, '=', True),
+            ], limit=1)
+    party = Party(name='Party', iva_condition='consumidor_final',
+        addresses=[Address()])
+    party.save()
+    invoice = Invoice(company=company, type=type, party=party,
+        invoice_address=party.addresses[0], currency=company.currency,
+        account=account, **values)
+    invoice.save()
+    return invoice
 
 
 class InvoiceArTestCase(CompanyTestMixin, ModuleTestCase):
     'Test account_invoice_ar module'
     module = 'account_invoice_ar'
 
+    def test_get_ticket_expiration(self):
+        'Test get_ticket_expiration'
+        from trytond.modules.account_invoice_ar.afip import (
+            get_ticket_expiration)
+
+        ticket = (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<loginTicketResponse version="1.0"><header>'
+            '<generationTime>2024-03-01T10:00:00.000-03:00</generationTime>'
+            '<expirationTime>2024-03-01T22:00:00.000-03:00</expirationTime>'
+            '</header><credentials><token>T</token><sign>S</sign>'
+            '</credentials></loginTicketResponse>')
+        self.assertEqual(get_ticket_expiration(ticket),
+            datetime(2024, 3, 2, 1, 0))
+        self.assertEqual(get_ticket_expiration(''), None)
+        self.assertEqual(get_ticket_expiration('<invalid'), None)
+
+    def test_chunk_sizer(self):
+        'Test ChunkSizer'
+        from trytond.modules.account_invoice_ar.afip import ChunkSizer
+
+        sizer = ChunkSizer(latency=10, max_bytes=1000)
+        key = ('wsfe', 'homologacion')
+        fetch = Mock(return_value=100)
+        self.assertEqual(sizer.get_limit(key, fetch), 100)
+        self.assertEqual(sizer.get_limit(key, fetch), 100)
+        fetch.assert_called_once_with()
+        self.assertEqual(sizer.get_size(key, 100), 100)
+
+        self.assertEqual(sizer.record(key, 100, 20), 50)
+        self.assertEqual(sizer.record(key, 50, 1, timeout=True), 25)
+        self.assertEqual(sizer.record(key, 25, 1), 31)
+        self.assertEqual(sizer.record(key, 10, 1), 31)
+        self.assertEqual(sizer.record(key, 31, 1, nbytes=3100), 10)
+        self.assertEqual(sizer.record(key, 10, 30, timeout=True), 5)
+        self.assertEqual(sizer.record(key, 1, 60), 1)
+        self.assertEqual(sizer.get_size(key, 100), 1)
+        for _ in range(50):
+            sizer.record(key, sizer.get_size(key, 100), 1)
+        self.assertEqual(sizer.get_size(key, 100), 100)
+
+        stats = sizer.stats()[key]
+        self.assertEqual(stats['limit'], 100)
+        self.assertEqual(stats['size'], 100)
+        self.assertEqual(len(stats['chunks']), 20)
+
+        sizer = ChunkSizer(limit_cache=0)
+        sizer.get_limit(key, fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_ws_pool(self):
+        'Test WebServicePool'
+        from trytond.modules.account_invoice_ar.afip import WebServicePool
+
+        class WS(object):
+            def inicializar(self):
+                self.CAE = ''
+
+        pool = WebServicePool(size=1)
+        key = ('db', 1, 'wsfe', 'homologacion')
+        valid = datetime.utcnow() + timedelta(hours=1)
+        ws = WS()
+        pool.add(key, ws, valid)
+        ws.CAE = '1234'
+        pool.release(ws)
+
+        reused = pool.checkout(key)
+        self.assertIs(reused, ws)
+        self.assertEqual(reused.CAE, '')
+        self.assertIsNone(pool.checkout(key))
+
+        pool.release(ws)
+        self.assertIsNone(
+            pool.checkout(('db', 1, 'wsfe', 'produccion')))
+        self.assertIsNone(pool.checkout(key))
+
+        expired = WS()
+        pool.add(key, expired, datetime.utcnow())
+        pool.release(expired)
+        self.assertIsNone(pool.checkout(key))
+
+    @with_transaction()
+    def test_afip_ticket_invalidate_access(self):
+        'Test company write invalidates tickets without access to them'
+        pool = Pool()
+        Company = pool.get('company.company')
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
+        transaction = Transaction()
+
+        company = create_company()
+        Ticket.create([{
+                    'company': company.id,
+                    'service': 'wsfe',
+                    'mode': 'homologacion',
+                    }])
+        with transaction.set_user(1), \
+                transaction.set_context(_check_access=True):
+            Company.write([company], {'pyafipws_mode_cert': 'produccion'})
+        self.assertEqual(Ticket.search([]), [])
+
+    @with_transaction()
+    def test_afip_ticket_renew(self):
+        'Test get_ticket renews the ticket in its own transaction'
+        pool = Pool()
+        Company = pool.get('company.company')
+        Ticket = pool.get('account_invoice_ar.afip_ticket')
+
+        def access_ticket(hours):
+            expiration = datetime.utcnow().replace(microsecond=0) + timedelta(
+                hours=hours)
+            return expiration, (
+                '<loginTicketResponse><header><expirationTime>'
+                '%s+00:00</expirationTime></header>'
+                '</loginTicketResponse>' % expiration.isoformat())
+
+        company = create_company()
+        expiration, ta = access_ticket(12)
+        Ticket._tickets_cache.clear()
+        with patch.object(Company, 'pyafipws_authenticate',
+                    return_value=ta) as authenticate, \
+                patch.object(Company, 'get_cache_dir',
+                    return_value='/tmp/afip'), \
+                patch.object(Transaction, 'commit'):
+            self.assertEqual(Ticket.get_ticket(company, 'wsfe'), ta)
+            authenticate.assert_called_once_with(
+                service='wsfe', cache='/tmp/afip')
+            ticket, = Ticket.search([])
+            self.assertEqual(
+                (ticket.ticket, ticket.expiration), (ta, expiration))
+
+            # reused from memory then from the database
+            self.assertEqual(Ticket.get_ticket(company, 'wsfe'), ta)
+            Ticket._tickets_cache.clear()
+            self.assertEqual(Ticket.get_ticket(company, 'wsfe'), ta)
+            self.assertEqual(authenticate.call_count, 1)
+
+            # renewed before it expires
+            Ticket.write([ticket], {
+                    'expiration': datetime.utcnow() + timedelta(minutes=1),
+                    })
+            Ticket._tickets_cache.clear()
+            expiration, authenticate.return_value = access_ticket(24)
+            self.assertEqual(
+                Ticket.get_ticket(company, 'wsfe'),
+                authenticate.return_value)
+            self.assertEqual(authenticate.call_count, 2)
+            ticket, = Ticket.search([])
+            self.assertEqual(ticket.expiration, expiration)
+
+    @with_transaction()
+    def test_pos_last_authorized(self):
+        'Test PosLastAuthorized sync, advance and get_last_number'
+        pool = Pool()
+        Pos = pool.get('account.pos')
+        LastAuthorized = pool.get('account.pos.last_authorized')
+        transaction = Transaction()
+
+        company = create_company()
+        pos, = Pos.create([{
+                    'company': company.id,
+                    'number': 4,
+                    'pos_type': 'electronic',
+                    'pyafipws_electronic_invoice_service': 'wsfe',
+                    }])
+        ws = Mock()
+        ws.CompUltimoAutorizado.return_value = '41'
+
+        with transaction.set_user(1), \
+                transaction.set_context(_check_access=True):
+            self.assertEqual(LastAuthorized.sync(ws, pos, '6', 'wsfe'), 41)
+            ws.CompUltimoAutorizado.assert_called_once_with('6', 4)
+
+            LastAuthorized.advance(pos, '6', 'wsfe', 45)
+            LastAuthorized.advance(pos, '6', 'wsfe', 43)
+            LastAuthorized.advance(pos, '1', 'wsfe', 10)
+            self.assertEqual(LastAuthorized.get_last_number(
+                    ws, pos, '6', 'wsfe', expected=45), 45)
+            self.assertEqual(ws.CompUltimoAutorizado.call_count, 1)
+
+            self.assertEqual(LastAuthorized.get_last_number(
+                    ws, pos, '6', 'wsfe', expected=46), 41)
+            self.assertEqual(ws.CompUltimoAutorizado.call_count, 2)
+
+        record, = LastAuthorized.search([])
+        self.assertEqual(record.number, 41)
+        self.assertEqual(record.invoice_type, '6')
+
+    @with_transaction()
+    def test_pos_sequence_get_sequences(self):
+        'Test PosSequence.get_sequences follows the changes of sequences'
+        pool = Pool()
+        Pos = pool.get('account.pos')
+        PosSequence = pool.get('account.pos.sequence')
+
+        company = create_company()
+        pos, = Pos.create([{
+                    'company': company.id,
+                    'number': 2,
+                    'pos_type': 'manual',
+                    }])
+        self.assertEqual(PosSequence.get_sequences(pos, '1'), [])
+
+        invoice_a, = PosSequence.create([{
+                    'pos': pos.id,
+                    'invoice_type': '1',
+                    }])
+        self.assertEqual(PosSequence.get_sequences(pos, '1'), [invoice_a])
+        self.assertEqual(PosSequence.get_sequences(pos.id, '6'), [])
+
+        PosSequence.write([invoice_a], {'invoice_type': '6'})
+        self.assertEqual(PosSequence.get_sequences(pos, '1'), [])
+        self.assertEqual(PosSequence.get_sequences(pos, '6'), [invoice_a])
+
+        PosSequence.delete([invoice_a])
+        self.assertEqual(PosSequence.get_sequences(pos, '6'), [])
+
+    def test_get_wsdl(self):
+        'Test get_wsdl'
+        from io import BytesIO
+
+        from trytond.modules.account_invoice_ar import afip
+        from trytond.modules.account_invoice_ar.scripts import update_wsdl
+
+        self.assertIsNone(afip.get_wsdl('wsfe', 'unknown'))
+        self.assertIsNone(afip.get_wsdl('wsmtxca', 'homologacion'))
+
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(afip, 'WSDL_DIR', directory):
+            # without bundled WSDL, the URL is used
+            self.assertEqual(afip.get_wsdl('wsfe', 'produccion'),
+                'https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL')
+
+            # the WSDL bundled at build time are used for every service
+            with patch.object(update_wsdl, 'urlopen',
+                    side_effect=lambda url, timeout: BytesIO(
+                        url.encode())):
+                update_wsdl.update_wsdl(directory=directory)
+            for service, (_, urls) in afip.SERVICES.items():
+                for mode, url in urls.items():
+                    filename = afip.get_wsdl(service, mode)
+                    self.assertEqual(os.path.dirname(filename), directory)
+                    with open(filename) as fd:
+                        self.assertEqual(fd.read(), url)
+
+    def test_connect(self):
+        'Test connect holds the cache lock only to parse a new WSDL'
+        from trytond.modules.account_invoice_ar import afip
+
+        events = []
+
+        @contextmanager
+        def lock(cache):
+            events.append('lock')
+            yield
+            events.append('unlock')
+
+        ws = Mock()
+        ws.Conectar.side_effect = lambda **kwargs: events.append('connect')
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(afip, 'wsdl_cache_lock', lock), \
+                patch.object(afip, 'fetch_wsdl') as fetch_wsdl, \
+                patch.object(afip, '_parsed_wsdl', set()):
+            wsdl = os.path.join(directory, 'wsfev1-homologacion.wsdl')
+            with open(wsdl, 'w') as fd:
+                fd.write('<definitions/>')
+            afip.connect(ws, wsdl, directory)
+            afip.connect(ws, wsdl, directory)
+            fetch_wsdl.assert_not_called()
+            self.assertEqual(events, ['lock', 'connect', 'unlock', 'connect'])
+
+            # a WSDL updated is parsed again
+            os.utime(wsdl, (0, 0))
+            del events[:]
+            afip.connect(ws, wsdl, directory)
+            self.assertEqual(events, ['lock', 'connect', 'unlock'])
+        ws.Conectar.assert_called_with(wsdl=wsdl,
+            cache=os.path.join(directory, 'wsdl'), cacert=True)
+
+    def test_fetch_wsdl(self):
+        'Test fetch_wsdl'
+        from io import BytesIO
+
+        from trytond.modules.account_invoice_ar import afip
+
+        url = afip.SERVICES['wsfe'][1]['homologacion']
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(afip, 'urlopen',
+                    return_value=BytesIO(b'<definitions/>')) as urlopen:
+            path = afip.fetch_wsdl(url, directory)
+            self.assertEqual(
+                path, os.path.join(directory, 'wsfev1-homologacion.wsdl'))
+            with open(path, 'rb') as fd:
+                self.assertEqual(fd.read(), b'<definitions/>')
+            self.assertEqual(afip.fetch_wsdl(url, directory), path)
+            self.assertEqual(urlopen.call_count, 1)
+
+            urlopen.side_effect = OSError
+            with patch.object(afip, 'WSDL_REFRESH', 0):
+                self.assertEqual(afip.fetch_wsdl(url, directory), path)
+            os.remove(path)
+            with self.assertRaises(OSError):
+                afip.fetch_wsdl(url, directory)
+
+    def test_afip_payload(self):
+        'Test AfipPayload'
+        from trytond.modules.account_invoice_ar.afip import AfipPayload
+
+        class WS(object):
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args: self.calls.append((name, args))
+
+        payload = AfipPayload(service='wsfex', tipo_cbte='19', punto_vta=1,
+            cbte_nro=None, header=('19', 1, None, '20240301'),
+            items=((0, '-', 1, 7, 0, 0, None),))
+        numbered = payload.set_number(12)
+        self.assertEqual(numbered.cbte_nro, 12)
+        self.assertEqual(numbered.header, ('19', 1, 12, '20240301'))
+        self.assertEqual(payload.header[2], None)
+        self.assertFalse(numbered.error)
+        self.assertIsNone(numbered.totals)
+        totaled = payload._replace(totals={'pyafipws_cae_imp_total': 1})
+        self.assertEqual(totaled.set_number(13).totals,
+            {'pyafipws_cae_imp_total': 1})
+        self.assertTrue(AfipPayload(error=True).error)
+
+        ws = WS()
+        numbered.apply(ws)
+        self.assertEqual(ws.calls, [
+                ('CrearFactura', ('19', 1, 12, '20240301')),
+                ('AgregarItem', (0, '-', 1, 7, 0, 0, None)),
+                ])
+
+    def test_rate_limiter(self):
+        'Test RateLimiter'
+        from trytond.modules.account_invoice_ar.afip import RateLimiter
+
+        limiter = RateLimiter(100)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+        limiter = RateLimiter(0)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_request_collector(self):
+        'Test RequestCollector'
+        from trytond.modules.account_invoice_ar.afip import RequestCollector
+
+        collector = RequestCollector(0.1)
+        sent = []
+
+        def send(payloads):
+            sent.append(list(payloads))
+            return [p * 10 for p in payloads]
+
+        results = {}
+
+        def request(payloads):
+            results[payloads[0]] = collector.request(
+                'key', payloads, send, size=4)
+
+        threads = [threading.Thread(target=request, args=(p,))
+            for p in [[1], [2, 3], [4], [5]]]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sent, [[1, 2, 3, 4], [5]])
+        self.assertEqual(results, {1: [10], 2: [20, 30], 4: [40], 5: [50]})
+
+        collector = RequestCollector(0)
+        self.assertEqual(collector.request('key', [1], send), [10])
+
+    def test_compress_xml(self):
+        'Test compress_xml and decompress_xml'
+        from trytond.modules.account_invoice_ar.afip import (
+            compress_xml, decompress_xml)
+
+        xml = '<FECAESolicitar>%s</FECAESolicitar>' % ('ñ' * 1000)
+        data = compress_xml(xml)
+        self.assertLess(len(data), len(xml))
+        self.assertEqual(decompress_xml(data), xml)
+        self.assertEqual(decompress_xml(compress_xml(xml.encode('utf-8'))),
+            xml)
+        self.assertIsNone(compress_xml(''))
+        self.assertIsNone(decompress_xml(None))
+        # not compressed
+        self.assertEqual(decompress_xml(xml.encode('utf-8')), xml)
+
+    @with_transaction()
+    def test_check_pyafipws_invoices(self):
+        'Test check_pyafipws_invoices reports the errors by invoice'
+        from trytond.i18n import gettext
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 3,
+                        'pos_type': 'electronic',
+                        'pyafipws_electronic_invoice_service': 'wsfe',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '1'},
+                                    {'invoice_type': '2'},
+                                    ])],
+                        }])
+            invoice_type, debit_type = sorted(
+                pos.pos_sequences, key=lambda s: int(s.invoice_type))
+            invoice = create_invoice(company, pos=pos,
+                invoice_type=invoice_type, pyafipws_concept='1')
+            debit = create_invoice(company, pos=pos,
+                invoice_type=debit_type, pyafipws_concept='')
+
+            currency = gettext(
+                'account_invoice_ar.msg_missing_currency_afip_code')
+            self.assertEqual(
+                Invoice.check_pyafipws_invoices([invoice, debit]), {
+                    invoice.id: [currency],
+                    debit.id: [
+                        gettext(
+                            'account_invoice_ar.msg_missing_pyafipws_concept'),
+                        currency,
+                        gettext('account_invoice_ar.msg_missing_cmp_asoc'),
+                        ],
+                    })
+
+            company.currency.afip_code = 'PES'
+            company.currency.save()
+            Invoice.write([debit], {
+                    'pyafipws_concept': '1',
+                    'pyafipws_cmp_asoc_desde': date(2024, 3, 1),
+                    'pyafipws_cmp_asoc_hasta': date(2024, 3, 31),
+                    })
+            self.assertEqual(
+                Invoice.check_pyafipws_invoices([invoice, debit]), {})
+
+    @with_transaction()
+    def test_get_pyafipws_payload_batch_errors(self):
+        'Test the batch payload reports the errors without changing invoice'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+        Rate = pool.get('currency.currency.rate')
+        BankAccount = pool.get('bank.account')
+        Sequence = pool.get('ir.sequence')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            company.currency.afip_code = 'PES'
+            company.currency.save()
+            Rate.create([{
+                        'currency': company.currency.id,
+                        'rate': Decimal(1),
+                        'date': date(2024, 1, 1),
+                        }])
+            wsfe, wsfex = Pos.create([{
+                        'company': company.id,
+                        'number': number,
+                        'pos_type': 'electronic',
+                        'pyafipws_electronic_invoice_service': service,
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': t} for t in types])],
+                        } for number, service, types in [
+                        (8, 'wsfe', ['2', '201']),
+                        (9, 'wsfex', ['19']),
+                        ]])
+            debit, fce = sorted(
+                wsfe.pos_sequences, key=lambda s: int(s.invoice_type))
+            invoices = [create_invoice(company, pos=pos, invoice_type=t,
+                    pyafipws_concept='1', invoice_date=date(2024, 3, 1))
+                for pos, t in [
+                    (wsfe, debit),
+                    (wsfe, fce),
+                    (wsfex, wsfex.pos_sequences[0]),
+                    ]]
+            fce_invoice = invoices[1]
+
+            # missing cmp_asoc, CBU and cuit_pais
+            for invoice in invoices:
+                payload = invoice.get_pyafipws_payload(None, batch=True)
+                self.assertTrue(payload.error)
+            self.assertIsNone(fce_invoice.pyafipws_cbu)
+
+            cbu = BankAccount(1)
+            with patch.object(Invoice, 'get_pyafipws_cbu',
+                        return_value=cbu.id), \
+                    patch.object(BankAccount, 'get_cbu_number',
+                        return_value='0' * 22):
+                payload = fce_invoice.get_pyafipws_payload(
+                    None, batch=True, checked=True)
+            self.assertFalse(payload.error)
+            self.assertIn((2101, '0' * 22), payload.opcionales)
+            self.assertIsNone(payload.cbte_nro)
+            # the CBU is stored only when the number is reserved
+            self.assertIsNone(fce_invoice.pyafipws_cbu)
+
+            # the number is not previewed from the sequence out of batch
+            with patch.object(Invoice, 'get_pyafipws_cbu',
+                        return_value=cbu.id), \
+                    patch.object(BankAccount, 'get_cbu_number',
+                        return_value='0' * 22), \
+                    patch.object(Sequence, 'get_number_next') as number_next:
+                payload = fce_invoice.get_pyafipws_payload(
+                    Mock(Reprocesar=False), checked=True)
+            number_next.assert_not_called()
+            self.assertIsNone(payload.cbte_nro)
+            self.assertEqual(payload.set_number(12).header[5:7], (12, 12))
+
+    @with_transaction()
+    def test_get_pyafipws_payload_checks(self):
+        'Test the payload relies on the pre-flight checks for the FCE CBU'
+        from trytond.exceptions import UserError
+        from trytond.i18n import gettext
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+        Rate = pool.get('currency.currency.rate')
+        BankAccount = pool.get('bank.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            company.currency.afip_code = 'PES'
+            company.currency.save()
+            Rate.create([{
+                        'currency': company.currency.id,
+                        'rate': Decimal(1),
+                        'date': date(2024, 1, 1),
+                        }])
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 10,
+                        'pos_type': 'electronic',
+                        'pyafipws_electronic_invoice_service': 'wsfe',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '201'},
+                                    ])],
+                        }])
+            fce, other = [create_invoice(company, pos=pos,
+                    invoice_type=pos.pos_sequences[0], pyafipws_concept='1',
+                    invoice_date=date(2024, 3, 1)) for _ in range(2)]
+            cbu_emisor = gettext('account_invoice_ar.msg_fce_10168_cbu_emisor')
+
+            self.assertEqual(Invoice.check_pyafipws_invoices([fce]),
+                {fce.id: [cbu_emisor]})
+            with self.assertRaises(UserError) as cm:
+                fce.get_pyafipws_payload(Mock(Reprocesar=False))
+            self.assertEqual(cm.exception.message, cbu_emisor)
+            self.assertTrue(fce.get_pyafipws_payload(None, batch=True).error)
+
+            # the invoices are checked at once and the payload builder does
+            # not check them again
+            with patch.object(Invoice, 'check_pyafipws_invoices',
+                        return_value={fce.id: [cbu_emisor]}) as check, \
+                    patch.object(Invoice, 'get_pyafipws_cbu',
+                        return_value=1), \
+                    patch.object(BankAccount, 'get_cbu_number',
+                        return_value='0' * 22):
+                payloads = Invoice.get_pyafipws_batch_payloads([fce, other])
+            check.assert_called_once_with([fce, other])
+            self.assertTrue(payloads[fce.id].error)
+            self.assertFalse(payloads[other.id].error)
+            self.assertIn((2101, '0' * 22), payloads[other.id].opcionales)
+
+    @with_transaction()
+    def test_invoice_type_sequence_cached(self):
+        'Test the changes of an invoice do not search its POS sequence again'
+        pool = Pool()
+        Pos = pool.get('account.pos')
+        PosSequence = pool.get('account.pos.sequence')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 3,
+                        'pos_type': 'manual',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '11'},
+                                    ])],
+                        }])
+            sequence, = pos.pos_sequences
+            invoice = create_invoice(company, pos=pos,
+                invoice_type=sequence)
+
+            PosSequence._sequences_cache.clear()
+            with patch.object(PosSequence, 'search',
+                    wraps=PosSequence.search) as search:
+                for _ in range(5):
+                    self.assertEqual(
+                        invoice.on_change_with_invoice_type(), sequence.id)
+                self.assertEqual(search.call_count, 1)
+
+                # a new sequence is searched again
+                PosSequence.create([{'pos': pos.id, 'invoice_type': '13'}])
+                self.assertEqual(
+                    invoice.on_change_with_invoice_type(), sequence.id)
+                self.assertEqual(search.call_count, 2)
+
+    @with_transaction()
+    def test_get_pyafipws_amounts(self):
+        'Test get_pyafipws_amounts from the lines and the stored amounts'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Tax = pool.get('account.tax')
+        TaxGroup = pool.get('account.tax.group')
+        names = ['pyafipws_imp_neto', 'pyafipws_imp_tot_conc',
+            'pyafipws_imp_op_ex', 'pyafipws_imp_iva', 'pyafipws_imp_trib']
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search(
+                [('type.revenue', '=', True)], limit=1)
+            taxes = {}
+            for kind, rate in [
+                    ('gravado', '0.21'),
+                    ('no_gravado', '0'),
+                    ('exento', '0'),
+                    ]:
+                group, = TaxGroup.create([{
+                            'name': kind,
+                            'code': kind,
+                            'kind': 'sale',
+                            'afip_kind': kind,
+                            }])
+                taxes[kind], = Tax.create([{
+                            'name': kind,
+                            'description': kind,
+                            'type': 'percentage',
+                            'rate': Decimal(rate),
+                            'group': group.id,
+                            'company': company.id,
+                            'invoice_account': revenue.id,
+                            'credit_note_account': revenue.id,
+                            }])
+            invoice = create_invoice(company)
+            InvoiceLine.create([{
+                        'invoice': invoice.id,
+                        'type': 'line',
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'account': revenue.id,
+                        'quantity': quantity,
+                        'unit_price': Decimal(unit_price),
+                        'taxes': [('add', [taxes[kind].id])],
+                        } for kind, quantity, unit_price in [
+                        ('gravado', 3, '10.333'),
+                        ('gravado', 1, '5'),
+                        ('no_gravado', 1, '7'),
+                        ('exento', 2, '4.5'),
+                        ]])
+            Invoice.update_taxes([invoice])
+            invoice = Invoice(invoice.id)
+
+            amounts = Invoice.get_pyafipws_amounts([invoice], names)
+            self.assertEqual({n: amounts[n][invoice.id] for n in names}, {
+                    'pyafipws_imp_neto': Decimal('36.00'),
+                    'pyafipws_imp_tot_conc': Decimal('7.00'),
+                    'pyafipws_imp_op_ex': Decimal('9.00'),
+                    'pyafipws_imp_iva': Decimal('7.56'),
+                    'pyafipws_imp_trib': Decimal('0'),
+                    })
+            for name in names:
+                self.assertEqual(amounts[name][invoice.id],
+                    getattr(invoice, 'on_change_with_' + name)())
+
+            # reading the fields of many invoices computes them at once
+            others = [create_invoice(company) for _ in range(3)]
+            ids = [invoice.id] + [o.id for o in others]
+            with patch.object(Invoice, 'get_pyafipws_amounts',
+                    wraps=Invoice.get_pyafipws_amounts) as getter:
+                values = {v['id']: v for v in Invoice.read(ids, names)}
+            getter.assert_called_once()
+            self.assertEqual(sorted(i.id for i in getter.call_args[0][0]),
+                sorted(ids))
+            for name in names:
+                self.assertEqual(values[invoice.id][name],
+                    amounts[name][invoice.id])
+                for other in others:
+                    self.assertEqual(values[other.id][name], Decimal('0'))
+
+            # the amounts sent with the CAE are kept
+            Invoice.write([invoice], {
+                    'pyafipws_cae_imp_total': Decimal('60.56'),
+                    'pyafipws_cae_imp_neto': Decimal('36.00'),
+                    'pyafipws_cae_imp_iva': Decimal('7.56'),
+                    })
+            InvoiceLine.delete(invoice.lines[:1])
+            invoice = Invoice(invoice.id)
+            amounts = Invoice.get_pyafipws_amounts([invoice], names)
+            self.assertEqual({n: amounts[n][invoice.id] for n in names}, {
+                    'pyafipws_imp_neto': Decimal('36.00'),
+                    'pyafipws_imp_tot_conc': Decimal('0'),
+                    'pyafipws_imp_op_ex': Decimal('0'),
+                    'pyafipws_imp_iva': Decimal('7.56'),
+                    'pyafipws_imp_trib': Decimal('0'),
+                    })
+
+    @with_transaction()
+    def test_check_daily_reports(self):
+        'Test the ranges of daily reports do not overlap'
+        from trytond.exceptions import UserError
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 5,
+                        'pos_type': 'fiscal_printer',
+                        'pos_daily_report': True,
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '6'},
+                                    ])],
+                        }])
+
+            def report(number_from, number_to):
+                return create_invoice(company, pos=pos,
+                    invoice_type=pos.pos_sequences[0],
+                    ref_number_from=number_from, ref_number_to=number_to)
+
+            first = report('100', '199')
+            self.assertEqual((first.ref_range_from, first.ref_range_to),
+                (100, 199))
+            second = report(' 200', '250')
+            Invoice.write([second], {'state': 'cancelled'})
+            report('230', '300')
+
+            for number_from, number_to in [
+                    ('150', '210'),
+                    ('50', '100'),
+                    ('120', '130'),
+                    ('300', '2x0'),
+                    ('400', '399'),
+                    ]:
+                with self.assertRaises(UserError):
+                    report(number_from, number_to)
+
+            # Migration fills the ranges of the existing reports at once
+            third = report('0400', '0450')
+            table = Invoice.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update(
+                    [table.ref_range_from, table.ref_range_to], [Null, Null]))
+            Invoice.__register__('account_invoice_ar')
+            cursor.execute(*table.select(
+                    table.id, table.ref_range_from, table.ref_range_to,
+                    where=table.id.in_([first.id, second.id, third.id]),
+                    order_by=table.id))
+            self.assertEqual(cursor.fetchall(), [
+                    (first.id, 100, 199),
+                    (second.id, 200, 250),
+                    (third.id, 400, 450),
+                    ])
+
+    @with_transaction()
+    def test_get_duplicate_references(self):
+        'Test get_duplicate_references resolves the keys of supplier invoices'
+        from trytond.exceptions import UserError
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            reference = '00001-00000010'
+            invoice = create_invoice(company, 'in', reference=reference)
+            other = create_invoice(company, 'in', reference=reference)
+            key = (invoice.party.id, invoice.tipo_comprobante, reference)
+            keys = [
+                key,
+                (other.party.id, '001', reference),
+                (invoice.party.id, invoice.tipo_comprobante, '00001-0099'),
+                (None, invoice.tipo_comprobante, reference),
+                (invoice.party.id, invoice.tipo_comprobante, ''),
+                ]
+            self.assertEqual(
+                Invoice.get_duplicate_references(keys), {key: [invoice.id]})
+            Invoice.check_duplicate_references([invoice, other])
+
+            duplicate = create_invoice(company, 'in', reference=reference)
+            cancelled = create_invoice(company, 'in', reference=reference,
+                state='cancelled')
+            customer = create_invoice(company, 'out', reference=reference)
+            Invoice.write([duplicate, cancelled, customer], {
+                    'party': invoice.party.id,
+                    'invoice_address': invoice.invoice_address.id,
+                    })
+            duplicates = Invoice.get_duplicate_references(iter(keys))
+            self.assertEqual(sorted(duplicates[key]),
+                sorted([invoice.id, duplicate.id]))
+            self.assertEqual(list(duplicates), [key])
+            with self.assertRaises(UserError):
+                Invoice.check_duplicate_references([invoice])
+
+            # an import is checked with one query for all its invoices
+            imported = [create_invoice(company, 'in',
+                    reference='00002-%08d' % i) for i in range(5)]
+            with patch.object(Invoice, 'get_duplicate_references',
+                    wraps=Invoice.get_duplicate_references) as get:
+                Invoice.check_duplicate_references(imported)
+            get.assert_called_once()
+            with patch.object(Invoice, 'get_duplicate_references',
+                    wraps=Invoice.get_duplicate_references) as get, \
+                    self.assertRaises(UserError):
+                Invoice.check_duplicate_references(imported + [duplicate])
+            get.assert_called_once()
+
+    @with_transaction()
+    def test_invoice_type_code(self):
+        'Test the AFIP code and class of the invoice type are stored'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+        PosSequence = pool.get('account.pos.sequence')
+        InvoiceReport = pool.get('account.invoice', type='report')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 6,
+                        'pos_type': 'manual',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '1'},
+                                    {'invoice_type': '6'},
+                                    ])],
+                        }])
+            invoice_a, invoice_b = sorted(
+                pos.pos_sequences, key=lambda s: int(s.invoice_type))
+
+            invoice = create_invoice(company, pos=pos, invoice_type=invoice_a)
+            self.assertEqual(
+                (invoice.invoice_type_code, invoice.invoice_type_class),
+                ('1', 'A'))
+            self.assertEqual(invoice.invoice_type_tree, '1')
+
+            Invoice.write([invoice], {'invoice_type': invoice_b.id})
+            self.assertEqual(
+                (invoice.invoice_type_code, invoice.invoice_type_class),
+                ('6', 'B'))
+            self.assertEqual(
+                Invoice.search([('invoice_type_tree', '=', '6')]), [invoice])
+            self.assertEqual(
+                Invoice.search([('invoice_type_tree', '=', '1')]), [])
+            # searched on the invoice without joining the sequence
+            self.assertEqual(
+                Invoice.search_comprobante(
+                    'invoice_type_tree', ('invoice_type_tree', '=', '6')),
+                [('invoice_type_code', '=', '6')])
+
+            # the reports use the stored class of the invoice
+            self.assertEqual(
+                InvoiceReport._get_tipo_comprobante(Invoice, invoice), 'B')
+            self.assertFalse(InvoiceReport.discrimina_impuestos(invoice))
+            Invoice.write([invoice], {'invoice_type': invoice_a.id})
+            self.assertEqual(
+                InvoiceReport._get_tipo_comprobante(Invoice, invoice), 'A')
+            self.assertTrue(InvoiceReport.discrimina_impuestos(invoice))
+            Invoice.write([invoice], {'invoice_type': invoice_b.id})
+
+            # the code follows a sequence changed after the invoice
+            PosSequence.write([invoice_b], {'invoice_type': '11'})
+            self.assertEqual(
+                InvoiceReport._get_tipo_comprobante(Invoice, invoice), 'B')
+            Invoice.update_invoice_type_code([invoice])
+            self.assertEqual(
+                (invoice.invoice_type_code, invoice.invoice_type_class),
+                ('11', 'C'))
+
+            Invoice.write([invoice], {'invoice_type': None})
+            self.assertEqual(
+                (invoice.invoice_type_code, invoice.invoice_type_class),
+                (None, None))
+
+    @with_transaction()
+    def test_reserve_numbers(self):
+        'Test reserve_numbers and get_invoice_number_after'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        ModelData = pool.get('ir.model.data')
+        Sequence = pool.get('ir.sequence')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            sequence_type = ModelData.get_id(
+                'account_invoice', 'sequence_type_account_invoice')
+            sequence, other = Sequence.create([{
+                        'name': name,
+                        'sequence_type': sequence_type,
+                        'company': company.id,
+                        'number_next': 5,
+                        'number_increment': 2,
+                        } for name in ['Factura A', 'Factura B']])
+
+            self.assertEqual(Invoice.reserve_numbers(sequence, 0), [])
+            self.assertEqual(Invoice.reserve_numbers(sequence, 3), [5, 7, 9])
+            self.assertEqual(Sequence(sequence.id).get(), '11')
+            self.assertEqual(Sequence(other.id).get(), '5')
+
+            self.assertIsNone(Invoice.get_invoice_number_after({}))
+            invoices = [create_invoice(company, sequence=s.id,
+                    invoice_date=d, accounting_date=a)
+                for s, d, a in [
+                    (sequence, date(2024, 3, 4), None),
+                    (sequence, date(2024, 3, 1), date(2024, 3, 6)),
+                    (other, date(2024, 3, 9), None),
+                    ]]
+            self.assertEqual(Invoice.get_invoice_number_after({
+                        sequence.id: date(2024, 3, 6),
+                        other.id: date(2024, 3, 9),
+                        }), None)
+            self.assertEqual(Invoice.get_invoice_number_after({
+                        sequence.id: date(2024, 3, 2),
+                        other.id: date(2024, 3, 9),
+                        }), (sequence.id, invoices[1]))
+            self.assertEqual(Invoice.get_invoice_number_after({
+                        sequence.id: date(2024, 3, 2),
+                        other.id: date(2024, 3, 8),
+                        }), (other.id, invoices[2]))
+
+    @with_transaction()
+    def test_process_pyafipws_cae_failure(self):
+        'Test process_pyafipws_cae does not leave invoices pending'
+        from trytond.exceptions import UserError
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        task_transaction = Transaction()
+
+        for exception, status in [
+                (UserError('rejected'), 'rejected'),
+                (ConnectionError('timeout'), 'failed')]:
+            invoices = [Invoice(i, state='validated', pyafipws_cae=None,
+                    pyafipws_cae_status='pending') for i in [1, 2]]
+            transactions = []
+
+            def post(invoices):
+                transaction = Transaction()
+                self.assertIsNot(transaction, task_transaction)
+                self.assertTrue(transaction.context.get('pyafipws_sync'))
+                transactions.append(transaction)
+                raise exception
+
+            with patch.object(Invoice, 'post', side_effect=post), \
+                    patch.object(Invoice, 'browse', return_value=invoices), \
+                    patch.object(Invoice, 'write') as write, \
+                    patch.object(Transaction, 'commit', autospec=True) \
+                    as commit, \
+                    patch.object(Transaction, 'rollback', autospec=True) \
+                    as rollback:
+                Invoice.process_pyafipws_cae(invoices)
+            # only the posting is rolled back and the task reads the result
+            self.assertEqual(rollback.call_args_list,
+                [((t,),) for t in transactions])
+            commit.assert_called_once_with(task_transaction)
+            write.assert_called_with(invoices, {
+                    'pyafipws_cae_status': status,
+                    })
+
+    @with_transaction()
+    def test_post_queue_pyafipws(self):
+        'Test post queues the asynchronous invoices without posting them'
+        from trytond.modules.account_invoice_ar import invoice as module
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        parent = Invoice.__mro__[Invoice.__mro__.index(module.Invoice) + 1]
+
+        queued = Invoice(1, state='validated')
+        other = Invoice(2, state='validated')
+        with patch.object(Invoice, 'is_pyafipws_async', autospec=True,
+                    side_effect=lambda i: i is queued), \
+                patch.object(Invoice, 'queue_pyafipws_cae') as queue:
+            self.assertEqual(module.queue_pyafipws(
+                    lambda cls, invoices: invoices)(Invoice, [queued, other]),
+                [other])
+            queue.assert_called_once_with([queued])
+
+            queue.reset_mock()
+            with patch.object(parent, 'post') as post, \
+                    patch.object(Invoice, 'write') as write, \
+                    patch.object(Transaction, 'commit'):
+                Invoice.post([queued])
+            queue.assert_called_once_with([queued])
+            post.assert_called_once_with([])
+            # the transition does not see the queued invoice
+            write.assert_not_called()
+
+    @with_transaction()
+    def test_pyafipws_sync(self):
+        'Test refunds request the CAE synchronously'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+
+        pos = Pos(pos_type='electronic', pyafipws_async=True)
+        invoice = Invoice(type='out', state='draft', pos=pos,
+            pyafipws_cae=None)
+        self.assertTrue(invoice.is_pyafipws_async())
+        with Transaction().set_context(pyafipws_sync=True):
+            self.assertFalse(invoice.is_pyafipws_async())
+
+    @with_transaction()
+    def test_post_ws_batches_payload_error(self):
+        'Test post_ws_batches raises payload errors before posting'
+        from trytond.exceptions import UserError
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        batches = [[Invoice(i, invoice_date=date(2024, 3, 1))
+                for i in range(j * 10 + 1, j * 10 + 4)] for j in range(3)]
+
+        def get_payload(invoice, ws, batch=False, checked=False):
+            if invoice.id == 22:
+                raise UserError('invalid')
+            return Mock(error=False)
+
+        with patch.object(Invoice, 'get_pyafipws_payload', get_payload), \
+                patch.object(Invoice, 'post_ws_batch') as post_ws_batch, \
+                patch.object(Invoice, '_post_ws_batch_worker') as worker, \
+                patch.object(Transaction, 'commit') as commit:
+            with self.assertRaises(UserError):
+                Invoice.post_ws_batches(batches)
+        post_ws_batch.assert_not_called()
+        worker.assert_not_called()
+        commit.assert_not_called()
+
+    @with_transaction()
+    def test_post_pyafipws_batch_results(self):
+        'Test post keeps the results saved by the batch workers'
+        from trytond.exceptions import UserError
+        from trytond.modules.account_invoice_ar import invoice as module
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+        parent = Invoice.__mro__[Invoice.__mro__.index(module.Invoice) + 1]
+        table = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 7,
+                        'pos_type': 'electronic',
+                        'pyafipws_electronic_invoice_service': 'wsfe',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '6'},
+                                    ])],
+                        }])
+            invoice = create_invoice(company, pos=pos,
+                invoice_type=pos.pos_sequences[0], state='validated')
+
+            def get_payloads(invoices):
+                for invoice in invoices:
+                    invoice.invoice_date = date(2024, 3, 1)
+                return {i.id: Mock(error=False) for i in invoices}
+
+            def post_ws_batches(batches, payloads=None):
+                # a worker rejects the invoice in its own transaction
+                cursor.execute(*table.update(
+                        [table.invoice_date], [None],
+                        where=table.id == invoice.id))
+                return [([], Invoice(invoice.id), None)]
+
+            with patch.object(Invoice, 'check_invoice_type'), \
+                    patch.object(Invoice, 'check_pyafipws_invoices',
+                        return_value={}), \
+                    patch.object(Invoice, 'get_pyafipws_batch_payloads',
+                        side_effect=get_payloads), \
+                    patch.object(Invoice, 'post_ws_batches',
+                        side_effect=post_ws_batches), \
+                    patch.object(parent, 'post') as post, \
+                    patch.object(Transaction, 'commit'):
+                with self.assertRaises(UserError):
+                    Invoice.post([invoice])
+            post.assert_called_once_with([])
+            cursor.execute(*table.select(table.invoice_date,
+                    where=table.id == invoice.id))
+            self.assertEqual(cursor.fetchone(), (None,))
+
+    @with_transaction()
+    def test_post_ws_batch_scaling(self):
+        'Test post_ws_batch finalizes each chunk once after its request'
+        from trytond.modules.account_invoice_ar import invoice as module
+        from trytond.modules.account_invoice_ar.afip import (
+            AfipPayload, ChunkSizer)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        # the class called by super().post() of the module
+        parent = Invoice.__mro__[Invoice.__mro__.index(module.Invoice) + 1]
+
+        calls = []
+
+        class WS(object):
+            XmlRequest = ''
+
+            def __init__(self, size):
+                self.size = size
+
+            def CompTotXRequest(self):
+                return self.size
+
+            def CAESolicitarX(self):
+                calls.append('request')
+                return self.size
+
+            def __getattr__(self, name):
+                return lambda *args: None
+
+        def set_number(invoices):
+            for invoice in invoices:
+                invoice.number = '00001-%08d' % invoice.id
+
+        payload = AfipPayload(service='wsfe', header=(None,) * 7)
+        size = 10
+        for chunks in [1, 2, 4, 8, 16]:
+            invoices = [Invoice(i, invoice_date=date(2024, 3, 1))
+                for i in range(1, chunks * size + 1)]
+            del calls[:]
+            with patch.object(Invoice, 'get_ws_afip',
+                        return_value=WS(size)), \
+                    patch.object(Invoice, 'get_afip_company',
+                        return_value=Mock(id=1,
+                            pyafipws_mode_cert='homologacion')), \
+                    patch.object(module, 'chunk_sizer', ChunkSizer()), \
+                    patch.object(Invoice, 'release_ws_afip'), \
+                    patch.object(Invoice, 'lock_ws_sequence',
+                        side_effect=lambda i: calls.append('lock')), \
+                    patch.object(Invoice, 'set_number',
+                        side_effect=set_number), \
+                    patch.object(Invoice, 'get_pyafipws_payload',
+                        return_value=payload), \
+                    patch.object(Invoice, 'process_afip_result',
+                        return_value='A'), \
+                    patch.object(Invoice, 'save',
+                        side_effect=lambda i: calls.append(('save', i))), \
+                    patch.object(parent, 'post',
+                        side_effect=lambda i: calls.append(('post', i))), \
+                    patch.object(Transaction, 'commit',
+                        side_effect=lambda: calls.append('commit')):
+                approved, pre_rejected, rejected = Invoice.post_ws_batch(
+                    invoices)
+            self.assertEqual(approved, invoices)
+            self.assertIsNone(pre_rejected)
+            self.assertIsNone(rejected)
+            expected = []
+            for i in range(0, len(invoices), size):
+                chunk = invoices[i:i + size]
+                # the numbering is locked only until the numbers are
+                # committed, before the request, and the results are saved
+                # and posted once for the chunk only
+                expected.extend(['lock',
+                        ('save', chunk), 'commit', 'request',
+                        ('save', chunk), 'commit',
+                        ('post', chunk), 'commit'])
+            self.assertEqual(calls, expected)
+
+    @with_transaction()
+    def test_post_ws_batch_posts_chunk_once(self):
+        'Test post_ws_batch posts the approved invoices of each chunk once'
+        from trytond.modules.account_invoice_ar import invoice as module
+        from trytond.modules.account_invoice_ar.afip import (
+            AfipPayload, ChunkSizer)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        PosSequence = pool.get('account.pos.sequence')
+        Party = pool.get('party.party')
+        parent = Invoice.__mro__[Invoice.__mro__.index(module.Invoice) + 1]
+
+        ws = Mock(XmlRequest='', CompTotXRequest=lambda: 3)
+        posted, saved = [], []
+
+        def set_number(invoices):
+            for invoice in invoices:
+                invoice.number = '00001-%08d' % invoice.id
+
+        def process_afip_result(invoice, ws, payload=None):
+            # AFIP rejects the second invoice of the second chunk
+            return 'R' if invoice.id == 5 else 'A'
+
+        payload = AfipPayload(service='wsfe', header=(None,) * 7)
+        # the rejected invoice is logged with its type and party
+        invoices = [Invoice(i, invoice_date=date(2024, 3, 1),
+                invoice_type=PosSequence(invoice_type='6'),
+                party=Party(rec_name='Supplier'))
+            for i in range(1, 7)]
+        with patch.object(Invoice, 'get_ws_afip', return_value=ws), \
+                patch.object(Invoice, 'get_afip_company',
+                    return_value=Mock(id=1,
+                        pyafipws_mode_cert='homologacion')), \
+                patch.object(module, 'chunk_sizer', ChunkSizer()), \
+                patch.object(module, 'BATCH_WINDOW', 0), \
+                patch.object(Invoice, 'release_ws_afip'), \
+                patch.object(Invoice, 'lock_ws_sequence'), \
+                patch.object(Invoice, 'set_number', side_effect=set_number), \
+                patch.object(Invoice, 'get_pyafipws_payload',
+                    return_value=payload), \
+                patch.object(Invoice, '_request_ws_chunk',
+                    side_effect=lambda ws, payloads, key=None: [ws] * len(
+                        payloads)), \
+                patch.object(Invoice, 'process_afip_result',
+                    process_afip_result), \
+                patch.object(Invoice, 'reset_sequence_from_ws') as reset, \
+                patch.object(Invoice, 'save',
+                    side_effect=lambda i: saved.append(list(i))), \
+                patch.object(parent, 'post',
+                    side_effect=lambda i: posted.append(list(i))), \
+                patch.object(Transaction, 'commit'):
+            approved, pre_rejected, rejected = Invoice.post_ws_batch(
+                invoices)
+        first, second = invoices[:3], invoices[3:]
+        self.assertEqual(approved, first + [invoices[3], invoices[5]])
+        self.assertIsNone(pre_rejected)
+        self.assertEqual(rejected, invoices[4])
+        # the approved invoices of the first chunk are not posted or saved
+        # again with the second chunk
+        self.assertEqual(posted, [first, [invoices[3], invoices[5]]])
+        self.assertEqual(saved, [first, first, second, second])
+        reset.assert_called_once_with(ws)
+
+    @with_transaction()
+    def test_post_ws_reserved_number(self):
+        'Test post_ws requests the CAE with the reserved number'
+        from trytond.exceptions import UserError
+        from trytond.modules.account_invoice_ar.afip import (
+            AfipPayload, BatchChunkResult)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        LastAuthorized = pool.get('account.pos.last_authorized')
+
+        payload = AfipPayload(service='wsfe', tipo_cbte='6', punto_vta=1,
+            header=(None,) * 7)
+
+        def reserve(invoices, payloads):
+            for invoice in invoices:
+                invoice.number = '00001-00000012'
+                payloads[invoice] = payloads[invoice].set_number(12)
+
+        for last_number in [11, 12]:
+            ws = Mock(Reprocesar=False)
+            invoice = Mock(spec=Invoice, invoice_date=date(2024, 3, 1))
+            invoice.get_pyafipws_payload.return_value = payload
+            invoice.request_cae.side_effect = lambda ws: (ws, '')
+            invoice.process_afip_result.return_value = 'A'
+            with patch.object(Invoice, 'get_ws_afip', return_value=ws), \
+                    patch.object(Invoice, 'release_ws_afip'), \
+                    patch.object(Invoice, '_reserve_ws_chunk',
+                        side_effect=reserve), \
+                    patch.object(Invoice, '_finalize_ws_chunk') as finalize, \
+                    patch.object(LastAuthorized, 'get_last_number',
+                        return_value=last_number) as get_last_number, \
+                    patch.object(Transaction, 'commit'):
+                if last_number == 11:
+                    self.assertEqual(
+                        Invoice.post_ws(invoice), (invoice, None, None))
+                    ws.CrearFactura.assert_called_once_with(
+                        None, None, None, None, None, 12, 12)
+                    finalize.assert_called_once_with(
+                        BatchChunkResult([invoice], [invoice], []))
+                else:
+                    # AFIP waits for another number
+                    with self.assertRaises(UserError):
+                        Invoice.post_ws(invoice)
+                    ws.CrearFactura.assert_not_called()
+                    self.assertIsNone(invoice.number)
+                    finalize.assert_called_once_with(
+                        BatchChunkResult([invoice], [], [invoice]))
+                    invoice.reset_sequence_from_ws.assert_called_once_with(
+                        ws)
+            invoice.get_pyafipws_payload.assert_called_once_with(
+                ws, batch=False, checked=False)
+            self.assertEqual(get_last_number.call_args[1], {'expected': 11})
+
+    @with_transaction()
+    def test_post_ws_chunk_rejected(self):
+        'Test the sequence is synchronized after a rejected request'
+        from trytond.modules.account_invoice_ar.afip import (
+            AfipPayload, BatchChunkResult)
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        calls = []
+        invoice = Mock(spec=Invoice)
+        invoice.reset_sequence_from_ws.side_effect = (
+            lambda ws: calls.append('sync'))
+        result = BatchChunkResult([invoice], [], [invoice])
+        payloads = {invoice: AfipPayload(service='wsfe', header=(None,) * 7)}
+
+        with patch.object(Invoice, 'get_afip_company',
+                    return_value=Mock(id=1,
+                        pyafipws_mode_cert='homologacion')), \
+                patch.object(Invoice, '_reserve_ws_chunk',
+                    side_effect=lambda *a: calls.append('reserve')), \
+                patch.object(Invoice, '_request_ws_chunk',
+                    side_effect=lambda ws, p, key: calls.append('request')
+                    or [None]), \
+                patch.object(Invoice, '_apply_ws_chunk',
+                    return_value=result), \
+                patch.object(Invoice, '_finalize_ws_chunk',
+                    side_effect=lambda r: calls.append('finalize')), \
+                patch.object(Transaction, 'commit',
+                    side_effect=lambda: calls.append('commit')):
+            self.assertIs(
+                Invoice._post_ws_chunk(Mock(), [invoice], payloads), result)
+        self.assertEqual(calls,
+            ['reserve', 'request', 'finalize', 'sync', 'commit'])
+
+    @with_transaction()
+    def test_reset_sequence_from_ws(self):
+        'Test the sequence is not reset below the numbers waiting for a CAE'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Pos = pool.get('account.pos')
+        PosSequence = pool.get('account.pos.sequence')
+        LastAuthorized = pool.get('account.pos.last_authorized')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            pos, = Pos.create([{
+                        'company': company.id,
+                        'number': 1,
+                        'pos_type': 'manual',
+                        'pos_sequences': [('create', [
+                                    {'invoice_type': '6'},
+                                    ])],
+                        }])
+            invoice_type, = pos.pos_sequences
+            rejected = create_invoice(company, pos=pos,
+                invoice_type=invoice_type, number='00001-00000011')
+            pending = create_invoice(company, pos=pos,
+                invoice_type=invoice_type, number='00001-00000012')
+
+            with patch.object(Invoice, 'lock_ws_sequence') as lock, \
+                    patch.object(LastAuthorized, 'sync',
+                        return_value='10'), \
+                    patch.object(PosSequence, 'invoice_sequence') as seq:
+                rejected.reset_sequence_from_ws(Mock())
+                # the number of the rejected invoice is given again but not
+                # the one still waiting for its CAE
+                lock.assert_called_once_with(rejected)
+                seq.update_sql_sequence.assert_called_once_with(13)
+
+                Invoice.write([pending], {'pyafipws_cae': '1' * 14})
+                seq.reset_mock()
+                rejected.reset_sequence_from_ws(Mock())
+                seq.update_sql_sequence.assert_called_once_with(11)
+
+    @with_transaction()
+    def test_set_ref_numbers(self):
+        'Test reference numbers are kept only on supplier invoices'
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        self.assertEqual(
+            Invoice._set_ref_numbers({
+                    'type': 'in',
+                    'ref_pos_number': 3,
+                    'ref_voucher_number': 41,
+                    }), {
+                'type': 'in',
+                'reference': '00003-00000041',
+                'ref_pos_number': 3,
+                'ref_voucher_number': 41,
+                })
+        supplier = Invoice(type='in', reference='00003-00000041',
+            ref_pos_number=3, ref_voucher_number=41)
+        self.assertEqual(
+            Invoice._set_ref_numbers({'ref_voucher_number': 42}, supplier),
+            {
+                'reference': '00003-00000042',
+                'ref_pos_number': 3,
+                'ref_voucher_number': 42,
+                })
+        self.assertEqual(
+            Invoice._set_ref_numbers({'reference': 'FC 7'}, supplier), {
+                'reference': 'FC 7',
+                'ref_pos_number': None,
+                'ref_voucher_number': None,
+                })
+        self.assertEqual(
+            Invoice._set_ref_numbers({
+                    'type': 'out',
+                    'reference': '00003-00000041',
+                    }), {
+                'type': 'out',
+                'reference': '00003-00000041',
+                'ref_pos_number': None,
+                'ref_voucher_number': None,
+                })
+        self.assertEqual(
+            Invoice._set_ref_numbers({'type': 'out'}, supplier), {
+                'type': 'out',
+                'ref_pos_number': None,
+                'ref_voucher_number': None,
+                })
+        self.assertEqual(Invoice._set_ref_numbers({'comment': 'x'}), {
+                'comment': 'x',
+                })
+
+    @with_transaction()
+    def test_afip_transaction_xml(self):
+        'Test the XML of AFIP transaction is stored compressed'
+        from trytond.modules.account_invoice_ar.afip import compress_xml
+        pool = Pool()
+        AfipTransaction = pool.get('account_invoice_ar.afip_transaction')
+        table = AfipTransaction.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            invoice = create_invoice(company)
+            ws = Mock(Obs='', ErrMsg='', Resultado='A',
+                XmlRequest='<FECAESolicitar>ñ</FECAESolicitar>',
+                XmlResponse=b'<FECAESolicitarResponse/>')
+            afip_tr = invoice.save_afip_tr(ws)
+
+            afip_tr = AfipTransaction(afip_tr.id)
+            self.assertEqual(afip_tr.pyafipws_xml_request,
+                '<FECAESolicitar>ñ</FECAESolicitar>')
+            self.assertEqual(afip_tr.pyafipws_xml_response,
+                '<FECAESolicitarResponse/>')
+            self.assertEqual(bytes(afip_tr.pyafipws_xml_request_data),
+                compress_xml('<FECAESolicitar>ñ</FECAESolicitar>'))
+
+            # the text written to the stored field is compressed
+            AfipTransaction.write([afip_tr], {
+                    'pyafipws_xml_response_data': '<Error/>',
+                    })
+            afip_tr = AfipTransaction(afip_tr.id)
+            self.assertEqual(bytes(afip_tr.pyafipws_xml_response_data),
+                compress_xml('<Error/>'))
+            self.assertEqual(afip_tr.pyafipws_xml_response, '<Error/>')
+
+            # the data stored in the table are moved to the filestore
+            cursor.execute(*table.update(
+                    [table.pyafipws_xml_request_data,
+                        table.pyafipws_xml_request_id],
+                    [AfipTransaction.pyafipws_xml_request_data.sql_format(
+                            compress_xml('<Old/>')), None],
+                    where=table.id == afip_tr.id))
+            AfipTransaction._migrate_pyafipws_xml_filestore()
+            cursor.execute(*table.select(table.pyafipws_xml_request_data,
+                    where=(table.id == afip_tr.id)
+                    & (table.pyafipws_xml_request_id != Null)))
+            self.assertEqual(cursor.fetchall(), [(None,)])
+            afip_tr = AfipTransaction(afip_tr.id)
+            self.assertEqual(afip_tr.pyafipws_xml_request, '<Old/>')
 
 del ModuleTestCase